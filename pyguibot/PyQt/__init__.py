@@ -28,7 +28,7 @@ if __name__ == '__main__':
 logging.getLogger(__name__).setLevel(getattr(logging, os.environ.get('LOGGING_' + __name__.replace('.', '_').upper(), os.environ.get('LOGGING', 'WARNING'))))
 
 try:
-	from PyQt5 import QtCore, QtGui, QtWidgets, uic
+	from PyQt5 import QtCore, QtGui, QtWidgets  # uic is imported on first access (see __getattr__)
 	try:
 		from PyQt5 import QtSvg
 	except ImportError:
@@ -59,3 +59,12 @@ except ImportError:
 #         QtCore.qInstallMessageHandler = QtCore.qInstallMsgHandler
 #     except ImportError as e2:
 #         raise ImportError('%s, %s' % (e1, e2))
+
+
+def __getattr__(name):
+	"""Imports uic (needed only to compile .ui-files) on first access"""
+	if name == 'uic':
+		from PyQt5 import uic
+		globals()['uic'] = uic
+		return uic
+	raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
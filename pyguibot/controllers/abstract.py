@@ -8,13 +8,12 @@ import ast
 import contextlib
 import datetime
 import logging
-import numpy
 import os
-import re
 import signal
 import subprocess
 import sys
 import textwrap
+import threading
 import time
 
 if __name__ == '__main__':
@@ -33,6 +32,10 @@ if __name__ == '__main__':
 	logging.getLogger(__name__).setLevel(logging.DEBUG)
 
 from models.abstract import ObservableAttrDict, ObservableList
+from models.document import Document
+from models.program import Program
+from models.template import Template
+from models.variables import Variables
 from models.devices import (
 	Screen,
 )
@@ -56,6 +59,10 @@ class AbstractController(object):
 		state_model.tmp_directory_path = tmp_directory_path = os.path.join(dst_directory_path, '.tmp.pyguibot')
 		state_model.exception = ''
 
+		self._variables = Variables(os.environ)  # Variables of scenario, child processes get their snapshot as environment
+		self._data = None  # (path, version, lines) of the last saved lines, are re-used while the document is not changed
+		self._data_lock = threading.Lock()
+
 		if not os.path.exists(tmp_directory_path):
 			os.makedirs(tmp_directory_path)
 
@@ -63,6 +70,7 @@ class AbstractController(object):
 
 	@contextlib.contextmanager
 	def _with_data(self, src_path=None, dst_path=None):
+		"""Yields lines as ObservableList, saves their changes (only changed lines are appended to a journal of the scenario)"""
 		state_model = self._state_model
 
 		# Loads lines
@@ -70,34 +78,53 @@ class AbstractController(object):
 			if src_path is None:
 				src_path = state_model.src_path
 
-			with (
-					open(src_path)
-					if src_path is not None and os.path.exists(src_path) else
-					contextlib.nullcontext(enter_result=(None if sys.stdin.isatty() else sys.stdin))  # From stdin or nowhere
-			) as src:
-				lines = ObservableList(src.readlines() if src is not None else [])
-
-			# Monitors if list was changed
-			state = dict(changed=False)
+			version, data = None, None
+			if src_path is not None and os.path.exists(src_path):
+				with self._data_lock:
+					data, self._data = (self._data if self._data is not None and self._data[0] == src_path else None), None  # A nested or concurrent block reads a copy
+				version, lines = Document.get(src_path).read(since=(data[1] if data is not None else None))  # Reads only changes since the previous time
+				lines = ObservableList(lines) if lines is not None else data[2]  # Is not copied if not changed
+			else:
+				with contextlib.nullcontext(enter_result=(None if sys.stdin.isatty() else sys.stdin)) as src:  # From stdin or nowhere
+					lines = ObservableList(src.readlines() if src is not None else [])
+
+			# Monitors if list was changed, collects changes [(from_index, to_index, lines), ...]
+			changes = []
 			def on_updated(model=None, previous=(None, ), current=(None, )):
 				if previous[0] != current[0]:
-					state['changed'] = True
+					(from_index, to_index), = previous[0].keys()
+					values, = current[0].values()
+					changes.append((from_index, to_index, list(values)))
 			lines.changed.bind(on_updated)
 
-		yield lines
+		try:
+			yield lines
+		finally:
+			lines.changed.unbind(on_updated)
 
 		# Saves lines
 		if True:
 			if dst_path is None:
 				dst_path = state_model.src_path
 
-			if state['changed'] or dst_path != src_path:
+			if changes or dst_path != src_path:
 				if not dst_path:
 					dst_path = self._save()
 
 				if dst_path:
-					with open(dst_path, 'w') as dst:
-						print(''.join(lines), end='', file=dst)
+					if version is not None and dst_path == src_path:
+						version = Document.get(dst_path).write(changes, version=version, lines=lines)
+					else:
+						version = Document.get(dst_path).save(lines) if dst_path == src_path else None
+
+			# Keeps lines for the next time (not if the block failed, they could be changed but not saved)
+			if version is not None:
+				with self._data_lock:
+					self._data = (src_path, version, lines)
+
+	def _compile(self, lines):
+		"""Returns compiled program of lines (loaded from or stored to an on-disk cache in ~/.cache/pyguibot/programs, keyed by sha1 of the source file's real path)"""
+		return Program.load(lines, restore=self._restore, path=self._state_model.src_path)
 
 	def _dump(self, event):
 		"""Dumps event to string with a trailing newline"""
@@ -167,6 +194,12 @@ class AbstractController(object):
 					value=template.get('value', None),
 				)
 
+			elif event_type in ('join', 'kill'):
+				event['value'] = self._interactive_input_value(
+					message='Enter job name (empty for every job)',
+					value=template.get('value', None),
+				)
+
 			elif event_type == 'keyboard_type':
 				event['value'] = self._interactive_input_value(
 					message='Enter string to type',
@@ -279,32 +312,13 @@ class AbstractController(object):
 		"""Returns filename named by current datetime"""
 		return datetime.datetime.now().strftime('%Y-%m-%d_%H:%M:%S.%f')[:-3]
 
-	@staticmethod
-	def _substitute_variables_with_values(value, env=None, default=None):
-		"""Replaces every {key} (or {env[key]}) with its environment variable"""
-		value = re.sub('\{(\w+)\}', '{env[\\1]}', value)  # Allows to write {X} instead of {env[X]}
-		env = os.environ if env is None else env
-		if default is not None:
-			env = _DefaultDict(
-				env,
-				default=(lambda x: (lambda k: (x)))(default),  # Allows to see default value if not set)
-			)
-		value = value.format(env=env)
-		return value
+	def _substitute_variables_with_values(self, value, env=None, default=None):
+		"""Replaces every {key} (or {env[key]}) with its variable"""
+		return Template.compile(value).render(self._variables if env is None else env, **({} if default is None else dict(default=default)))  # Allows to see default value if not set
 
-	@staticmethod
-	def _substitute_variables_with_keys_values(value, env=None, default=None):
+	def _substitute_variables_with_keys_values(self, value, env=None, default=None):
 		"""Replaces every {key} (or {env[key]}) with {key}(value|default)"""
-		# value = re.sub('\{(\w+)\}', '{{\\1}}({env[\\1]})', value)  # Allows to see a variable name with its current value
-		value = re.sub('\{(\w+)\}', '\\1[{env[\\1]}]', value)  # Allows to see a variable name with its current value
-		env = os.environ if env is None else env
-		if default is not None:
-			env = _DefaultDict(
-				env,
-				default=(lambda x: (lambda k: (x)))(default),  # Allows to see default value if not set)
-			)
-		value = value.format(env=env)
-		return value
+		return Template.compile(value).render_keys_values(self._variables if env is None else env, **({} if default is None else dict(default=default)))  # Allows to see a variable name with its current value
 
 	@staticmethod
 	def _interactive_select_event_type():
@@ -317,6 +331,8 @@ class AbstractController(object):
 			'equation',
 			'condition',
 			'shell_command',
+			'join',
+			'kill',
 			'keyboard_tap',
 			'keyboard_press',
 			'keyboard_release',
@@ -404,16 +420,6 @@ class AbstractController(object):
 		result = subprocess.check_output(command, shell=True, text=True)
 
 
-class _DefaultDict(dict):
-	"""Dict that calls default function and returns its result if no key found"""
-	def __init__(self, items, default):
-		self._default = default
-		super(_DefaultDict, self).__init__(items)
-
-	def __missing__(self, key):
-		return self._default(key)
-
-
 def run_show_event_types_selector():
 	"""Only for developing purposes"""
 	AbstractController._interactive_select_event_type()
@@ -4,7 +4,6 @@
 "exec" "python3" "-B" "$0" "$@"
 # (c) gehrmann
 
-import contextlib
 import logging
 import os
 import signal
@@ -79,18 +78,17 @@ class CaptureController(AbstractController):
 					pass
 				else:
 					def create():
-						with (
-								contextlib.nullcontext(enter_result=sys.stdout)
-								if not state_model.src_path or os.path.exists(state_model.src_path) and os.path.isdir(state_model.src_path) else
-								open(state_model.src_path, 'a')
-						) as dst:
-							event = self._create(
-								with_exceptions=True,
-								# with_exceptions=False,
-							)
-
-							print(self._dump(event), end='', file=dst)
-							dst.flush()
+						event = self._create(
+							with_exceptions=True,
+							# with_exceptions=False,
+						)
+
+						if not state_model.src_path or os.path.exists(state_model.src_path) and os.path.isdir(state_model.src_path):
+							print(self._dump(event), end='', file=sys.stdout)
+							sys.stdout.flush()
+						else:
+							with self._with_data() as lines:
+								lines.append(self._dump(event))  # Is appended to journal of scenario
 					self._log_event_thread = thread = threading.Thread(target=create)
 					thread.setDaemon(True)
 					thread.start()
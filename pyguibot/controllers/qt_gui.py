@@ -15,8 +15,11 @@ Todo
 """
 
 import ast
+import collections
 import contextlib
 import datetime
+import hashlib
+import importlib.util
 import logging
 import os
 import pipes
@@ -24,19 +27,9 @@ import re
 import signal
 import subprocess
 import sys
+import tempfile
 import threading
 import time
-try:
-	import watchdog.events
-	import watchdog.observers
-except ImportError:
-	print('', file=sys.stderr)
-	print('', file=sys.stderr)
-	print('  Library possibly is not found. Try to install it using:', file=sys.stderr)
-	print('    # pip3 install watchdog', file=sys.stderr)
-	print('', file=sys.stderr)
-	print('', file=sys.stderr)
-	raise
 
 if __name__ == '__main__':
 	# Sets utf-8 (instead of latin1) as default encoding for every IO
@@ -54,15 +47,20 @@ if __name__ == '__main__':
 	)
 logging.getLogger(__name__).setLevel(logging.DEBUG)
 
-from PyQt import QtCore, QtGui, QtWidgets, uic
+from PyQt import QtCore, QtGui, QtWidgets
 
 from controllers.abstract import AbstractController
+from helpers.cache import FileCache
 from helpers.caller import Caller
+from helpers.channel import ChannelReader
+from models.commands_tree import CommandsTreeModel
+from models.document import Document
+from models.program import Program
 # from models.settings import Settings
 
 
 class MainController(AbstractController):
-	def __init__(self, path, verbose, geometry, autorun, autostop, autoexit, with_close_on_escape, with_screencast, with_observer, shell_command_prefix):
+	def __init__(self, path, verbose, geometry, autorun, autostop, autoexit, with_close_on_escape, with_screencast, with_observer, shell_command_prefix, pixmap_cache_size=None, with_pixmap_disk_cache=False, with_runner=None):
 		super(MainController, self).__init__(path=path)
 		state_model = self._state_model
 
@@ -78,6 +76,7 @@ class MainController(AbstractController):
 		state_model.with_screencast = with_screencast
 		state_model.with_observer = with_observer
 		state_model.shell_command_prefix = shell_command_prefix
+		state_model.with_runner = with_runner
 		state_model.status = 'Click "Play" to (re)run or "Record" to add new events...'
 
 		###
@@ -98,15 +97,32 @@ class MainController(AbstractController):
 		self._level_separator = ''  # Can be ['⎯']
 		self._level_passive_point = '◯'  # Can be ['◯']
 		self._level_active_point = '⬤'  # Can be ['⬤']
-
-		self._drag_entries = None
-		self._drag_from = None
-		self._drag_to = None
+		self._pattern_scale = 2.  # Scales patterns in order to prevent them to be found on a screen-shot
+
+		# Keeps icons, scaled patterns and combined pixmaps of patterns (invalidated if a file is changed)
+		self._pixmaps_cache = FileCache(
+			capacity=(64 if pixmap_cache_size is None else pixmap_cache_size) * 2**20,
+			get_size=lambda x: (x.width() * x.height() * x.depth() // 8),
+			directory=(os.path.join(os.path.expanduser('~'), '.cache', 'pyguibot', 'pixmaps') if with_pixmap_disk_cache else None),
+			directory_capacity=256 * 2**20,
+			serialize=self.__dump_pixmap,
+			deserialize=self.__parse_pixmap,
+		)
+
+		# Statuses, variables and calls from subprocess threads, applied by a timer on GUI thread (latest state per row, once per frame)
+		self._pending_lock = threading.Lock()
+		self._pending_statuses = collections.OrderedDict()  # {index: code}
+		self._pending_env = dict()
+		self._pending_calls = []
+		self._pending_timer = timer = QtCore.QTimer()
+		timer.setInterval(16)  # ~60 fps
+		timer.timeout.connect(self._apply_pending)
+		timer.start()
 
 		# self.settings_model = settings_model = Settings()
 
 		# Views
-		self.__view = view = uic.loadUi(os.path.join(sys.path[0], 'views/main.ui'))
+		self.__view = view = self._load_ui(os.path.join(sys.path[0], 'views/main.ui'))
 
 		if geometry is not None:
 			width, height, x, y = ([int(x) for x in geometry.replace('+', ' +').replace('-', ' -').replace('x', ' ').split()] + [60] * 4)[:4]
@@ -117,10 +133,20 @@ class MainController(AbstractController):
 			self.__restore_window_geometry()
 		view.closeEvent = self.__on_close
 		view.keyPressEvent = self.__on_key_pressed
+		self._commands_model = commands_model = CommandsTreeModel(
+			render=self._render_entry,
+			columns=5,
+			state_colors=self._state_colors,
+			status_texts=dict(ready='  ', current=''),
+		)
+		self._tracked_lines = None  # Lines the commands model was loaded with (changes of them are applied to rows)
+		view.commands_tree.setModel(commands_model)
+		# Spans comments after the view has handled changes of the model (resetting clears its spans)
+		commands_model.modelReset.connect(lambda: (self._span_comments(0, commands_model.rowCount())))
+		commands_model.rowsInserted.connect(lambda parent, from_index, to_index: (self._span_comments(from_index, to_index + 1)))
+		commands_model.dataChanged.connect(lambda top_left, bottom_right, roles=(): (self._span_comments(top_left.row(), bottom_right.row() + 1)))
+		commands_model.dropped.connect(self.__on_commands_tree_dropped)
 		view.commands_tree.doubleClicked.connect(self.__on_commands_tree_double_clicked)
-		# view.commands_tree.dragEvent = (lambda widget, previous_callback: (lambda event: (self.__on_commands_tree_dragping(event, widget, previous_callback))))(view.commands_tree, view.commands_tree.dragEvent)
-		view.commands_tree.dragEnterEvent = (lambda widget, previous_callback: (lambda event: (self.__on_commands_tree_dragging(event, widget, previous_callback))))(view.commands_tree, view.commands_tree.dragEnterEvent)
-		view.commands_tree.dropEvent = (lambda widget, previous_callback: (lambda event: (self.__on_commands_tree_dropping(event, widget, previous_callback))))(view.commands_tree, view.commands_tree.dropEvent)
 		view.open_button.triggered.connect(self.__on_open_triggered)
 		view.save_button.triggered.connect(self.__on_save_triggered)
 		view.run_button.triggered.connect(self.__on_run_triggered)
@@ -286,25 +312,10 @@ class MainController(AbstractController):
 
 		self._edit(index=index.row())
 
-	def __on_commands_tree_dragging(self, event, widget, previous_callback):
-		state_model = self._state_model
-		view = self.__view
-		tree = view.commands_tree
-
-		self._drag_entries = [tree.topLevelItem(x.row()) for x in tree.selectedIndexes()]
-		self._drag_from = [x.row() for x in tree.selectedIndexes()]
-
-		previous_callback(event)
-
-	def __on_commands_tree_dropping(self, event, widget, previous_callback):
-		view = self.__view
-		tree = view.commands_tree
-
-		previous_callback(event)
-
-		self._drag_to = [index for index in range(tree.topLevelItemCount()) if tree.topLevelItem(index) in self._drag_entries]
-
-		Caller.call_once_after(.1, self._move, from_index=min(self._drag_from), to_index=min(self._drag_to), count=len(self._drag_entries))
+	def __on_commands_tree_dropped(self, from_index, to_index, count):
+		# Converts row to insert before into row after removing of dragged rows
+		if not from_index <= to_index <= from_index + count:
+			Caller.call_once_after(.1, self._move, from_index=from_index, to_index=(to_index - count if to_index > from_index else to_index), count=count)
 
 	def __on_open_triggered(self, event):
 		path = self._open()
@@ -458,30 +469,47 @@ class MainController(AbstractController):
 		return path
 
 	def _reset_tree_entries_states(self):
-		view = self.__view
-		tree = view.commands_tree
+		self._commands_model.reset_statuses()
+
+	def _span_comments(self, from_index, to_index):
+		"""Spans the first column of commented rows in [from_index, to_index) over the whole row"""
+		tree = self.__view.commands_tree
+		model = self._commands_model
 
-		for entry in (tree.topLevelItem(index) for index in range(tree.topLevelItemCount())):
-			if not entry.isFirstColumnSpanned():
-				entry.setText(0, '  ')
-				# entry.setBackground(0, QtGui.QBrush(QtGui.QColor(self._state_colors['ready'] or '#fff')))
-				entry.setForeground(1, QtGui.QBrush(QtGui.QColor(self._state_colors['ready'] or '#999')))
-				entry.setBackground(2, QtGui.QBrush(QtGui.QColor(self._state_colors['ready'] or QtCore.Qt.transparent)))
-				entry.setBackground(3, QtGui.QBrush(QtGui.QColor(self._state_colors['ready'] or QtCore.Qt.transparent)))
-				# entry.setSelected(False)
+		for index in range(from_index, min(to_index, model.rowCount())):
+			is_comment = model.is_comment(index)
+			if tree.isFirstColumnSpanned(index, QtCore.QModelIndex()) != is_comment:
+				tree.setFirstColumnSpanned(index, QtCore.QModelIndex(), is_comment)
 
 	def _set_src_path_events_observer(self):
 		state_model = self._state_model
 
 		if state_model.with_observer:
+			try:
+				import watchdog.events
+				import watchdog.observers
+			except ImportError:
+				print('', file=sys.stderr)
+				print('', file=sys.stderr)
+				print('  Library possibly is not found. Try to install it using:', file=sys.stderr)
+				print('    # pip3 install watchdog', file=sys.stderr)
+				print('', file=sys.stderr)
+				print('', file=sys.stderr)
+				raise
+
 			def on_modified(event):
-				if os.path.realpath(event.src_path) == os.path.realpath(state_model.src_path):
-					Caller.call_once_after(.1, self._fill)
+				path = getattr(event, 'dest_path', '') or event.src_path  # Saves are renames of temporary files
+				if os.path.realpath(path) in (os.path.realpath(state_model.src_path), Document.get_journal_path(state_model.src_path)):
+					Caller.call_once_after(.1, self._fill_if_modified)
 			handler = watchdog.events.PatternMatchingEventHandler()
 			handler.on_modified = on_modified
+			handler.on_moved = on_modified
 
 			state_model.src_path_events_observer = thread = watchdog.observers.Observer()
 			thread.schedule(handler, path=os.path.dirname(os.path.realpath(state_model.src_path)))
+			journal_directory = os.path.dirname(Document.get_journal_path(state_model.src_path))
+			os.makedirs(journal_directory, mode=0o700, exist_ok=True)
+			thread.schedule(handler, path=journal_directory)  # Changes of other processes are appended there
 			thread.start()
 
 	# def _get_entry_fingerprint(self, index):
@@ -492,73 +520,86 @@ class MainController(AbstractController):
 	#     # return str(index) + ':' + ''.join([''.join([xx for xx in unicode(entry.text(x)) if xx.isalnum()]) for x in range(tree.columnCount()) if x != 1])
 	#     return str(index)
 
-	def _fill(self):
+	@contextlib.contextmanager
+	def _with_data(self, src_path=None, dst_path=None):
+		"""Applies changes of lines to the commands tree as they are done (from their slice events, without comparing lines)"""
+		state = dict(changed=False)
+
+		with super(MainController, self)._with_data(src_path=src_path, dst_path=dst_path) as lines:
+			is_tracked = all((
+				src_path is None and dst_path is None,
+				threading.current_thread() is threading.main_thread(),
+				lines is self._tracked_lines,  # Are the same (re-used) lines the tree was filled with, if the document was not changed by somebody else
+			))
+			def on_updated(model=None, previous=(None, ), current=(None, )):
+				state['changed'] = True
+				if is_tracked:
+					self._apply_lines_change(previous[0], current[0])
+				elif lines is self._tracked_lines:
+					self._tracked_lines = None  # Rows are not of these lines anymore
+			lines.changed.bind(on_updated)
+			try:
+				yield lines
+			finally:
+				lines.changed.unbind(on_updated)
+
+		if state['changed'] and src_path is None and dst_path is None and not is_tracked:
+			Caller.call_once_after(0, self._fill)
+
+	def _apply_lines_change(self, previous, current):
+		"""Replaces changed rows of the commands tree, previous and current are slice diffs {(from_index, to_index): lines} of ObservableList"""
 		state_model = self._state_model
+
+		(from_index, to_index), = previous.keys()
+		lines, = current.values()
+		program = Program.compile(lines, self._restore, directory=(os.path.dirname(os.path.realpath(state_model.src_path)) if state_model.src_path is not None else None))
+		self._commands_model.replace(from_index, to_index, lines, program)
+
+	def _fill_if_modified(self):
+		"""Fills if scenario was modified by somebody else (changes by the editor itself are already applied)"""
+		with self._with_data() as lines:
+			if lines is self._tracked_lines:
+				return
+		self._fill()
+
+	def _fill(self):
 		view = self.__view
 		tree = view.commands_tree
 
-		selected_rows = [x.row() for x in tree.selectedIndexes()]
-
 		logging.getLogger(__name__).info('Filling...')
-		scroll_y_position = tree.verticalScrollBar().value()  # Save scroll-y position
 		tree.setIconSize(QtCore.QSize(65535, 64))
-		tree.clear()
 
 		self._fill_tree_entries()
-		self._reset_tree_entries_states()
-
-		for index in range(tree.topLevelItemCount()):
-			if index in selected_rows:
-				entry = tree.topLevelItem(index)
-				entry.setSelected(True)
 
-		# tree.sortItems(0, QtCore.Qt.AscendingOrder)
-
-		for index in range(tree.columnCount()):
-			tree.resizeColumnToContents(index)
-		tree.verticalScrollBar().setValue(scroll_y_position)  # Restore scroll-y position
+		for index in range(self._commands_model.columnCount()):
+			tree.resizeColumnToContents(index)  # Considers only visible rows
 		logging.getLogger(__name__).info('Filled')
 
 	def _fill_tree_entries(self):
-		"""Re-fills tree entries without clearing tree"""
-		state_model = self._state_model
-		view = self.__view
-		tree = view.commands_tree
-
+		"""Updates tree entries of changed lines only (rows are rendered by the model when they are shown)"""
 		with self._with_data() as lines:
-			index = 0
-			# Appends or updates entries
-			for index, line in enumerate((x for x in lines)):
-				entry = tree.topLevelItem(index)
-				if entry is None:
-					# Creates entry if not exists
-					entry = QtWidgets.QTreeWidgetItem(tree)
-					entry.setFlags(entry.flags() ^ QtCore.Qt.ItemIsDropEnabled)  # Disallow dropping inside item
-					tree.addTopLevelItem(entry)
-
-				self._fill_tree_entry(index, entry, line)
-
-			# Removes superfluous entries
-			for index in range(index + 1, tree.topLevelItemCount()):
-				entry = tree.topLevelItem(index)
-				tree.takeTopLevelItem(index)
-
-	def _fill_tree_entry(self, index, entry, line):
+			program = self._compile(lines)  # Parses only changed lines (or loads from cache)
+		self._commands_model.load(lines, program)
+		self._tracked_lines = lines
+
+	def _render_entry(self, line, event=None, patterns_paths=None):
+		"""Returns dict(text={column: text}, icons={column: icon}, foreground={column: color}) of line"""
 		state_model = self._state_model
-		view = self.__view
-		tree = view.commands_tree
 
-		line_number = index + 1
-		text = {k: '' for k in range(tree.columnCount())}
+		text = collections.defaultdict(str)
 		icons = dict()
+		foreground = dict()
 
-		event = self._restore(line)
+		if event is None:
+			event = self._restore(line)
 
-		text[0] += '{line_number}. '.format(**locals())
 		if 'comments' in event:  # If line is commented
-			text[0] += event['comments'].lstrip()
-			entry.setFirstColumnSpanned(True)
-			entry.setForeground(0, QtGui.QBrush(QtGui.QColor('#666')))
+			text[0] = event['comments'].lstrip()
+			foreground[0] = '#666'
+
+		if 'error' in event:  # If line can not be parsed
+			text[3] = line.strip()
+			foreground[3] = '#c00'
 
 		if 'type' in event:
 			filename = 'unknown'
@@ -566,11 +607,11 @@ class MainController(AbstractController):
 				filename = 'keyboard'
 			elif event['type'].startswith('mouse_'):
 				filename = 'mouse'
-			elif event['type'].endswith('_command'):
+			elif event['type'].endswith('_command') or event['type'] in ('join', 'kill'):
 				filename = 'command'
 
 			text[1] += '' + (self._level_separator + self._level_passive_point) * (len(line) - len(line.lstrip())) + self._level_separator + self._level_active_point + ' '
-			icons[2] = self.__load_pixmap(os.path.join(sys.path[0], 'images/16/{}.png'.format(filename)))
+			icons[2] = self._pixmaps_cache.get(os.path.join(sys.path[0], 'images/16/{}.png'.format(filename)), load=self.__load_pixmap)
 			text[2] += event['type'].replace(filename, '').strip('_')
 
 		if 'value' in event:
@@ -585,51 +626,61 @@ class MainController(AbstractController):
 			text[3] += (text[3] and ', ') + '"' + self._substitute_variables_with_keys_values(event['message'], default='<none>') + '"'
 
 		if event is not None and 'patterns' in event:
-			border = 1
-			spacing = 2
 			patterns_paths = [
-				os.path.join(
+				x if x is not None else os.path.join(
 					(os.path.dirname(os.path.realpath(state_model.src_path)) if state_model.src_path is not None else '.'),
-					self._substitute_variables_with_values(x, default='default'),
-				) for x in event['patterns']
+					self._substitute_variables_with_values(xx, default='default'),
+				) for x, xx in zip(patterns_paths or [None] * len(event['patterns']), event['patterns'])
 			]
 			for pattern_path in patterns_paths:
 				if not os.path.exists(pattern_path):
 					logging.getLogger(__name__).error('Pattern not exists: %s', pattern_path.rsplit(os.path.sep, 1)[1])
-			pixmaps = [self.__load_pixmap(x if os.path.exists(x) else os.path.join(sys.path[0], 'images/16/not-found.png')) for x in patterns_paths]
+			patterns_paths = [x if os.path.exists(x) else os.path.join(sys.path[0], 'images/16/not-found.png') for x in patterns_paths]
 
-			# Scales pixmaps in order to prevent it to be found on a screen-shot
-			pixmaps = [x.scaled(QtCore.QSize(int(2. * x.width()), int(2. * x.height())), QtCore.Qt.IgnoreAspectRatio) for x in pixmaps]
+			icons[3] = self._pixmaps_cache.get_many(patterns_paths, load=self.__combine_patterns_pixmaps, key=('combined', self._pattern_scale))
 
-			# Stores a combined pixmap somewhere in order to prevent its destroying
-			entry._combined_pixmap = combined_pixmap = QtGui.QPixmap(
-				2 * border + spacing * (len(pixmaps) + 1) + sum(x.width() for x in pixmaps),
-				2 * border + 2 * spacing + max(x.height() for x in pixmaps),
-			)
-
-			combined_pixmap.fill(QtGui.QColor('#fc0'))
-			painter = QtGui.QPainter(combined_pixmap)
-			painter.setPen(QtGui.QColor('#fff'))
-			painter.drawRect(0, 0, combined_pixmap.width() - 1, combined_pixmap.height() - 1)
-			for _index, x in enumerate(pixmaps):
-				painter.drawPixmap(
-					border + spacing + sum((spacing + pixmaps[x].width()) for x in range(_index)),
-					(combined_pixmap.height() - x.height()) // 2,
-					x,
-				)
+		return dict(text=dict(text), icons={k: QtGui.QIcon(v) for k, v in icons.items()}, foreground=foreground)
 
-			icons[3] = QtGui.QIcon(combined_pixmap)
-
-		# self._tree_items_to_lines[view] = line
-		for _index in range(tree.columnCount()):
-			if _index in text:
-				entry.setText(_index, text[_index])
-				entry.setToolTip(_index, '#{}  {}'.format(line_number, line))
-				entry.setStatusTip(_index, '#{}  {}'.format(line_number, line))
-			if _index in icons:
-				entry.setIcon(_index, QtGui.QIcon(icons[_index]))
-				entry.setToolTip(_index, '#{}  {}'.format(line_number, line))
-				entry.setStatusTip(_index, '#{}  {}'.format(line_number, line))
+	@staticmethod
+	def _load_ui(path):
+		"""Returns view of .ui-file, compiles it once into a Python module (cached in ~/.cache/pyguibot/ui, only if it is private) instead of parsing XML on every launch"""
+		stat = os.stat(path)
+		directory = os.path.join(os.path.expanduser('~'), '.cache', 'pyguibot', 'ui')
+		name = '{}_{}'.format(
+			os.path.splitext(os.path.basename(path))[0],
+			hashlib.sha1(repr((os.path.realpath(path), stat.st_mtime_ns, stat.st_size, QtCore.PYQT_VERSION_STR)).encode('utf-8')).hexdigest()[:16],
+		)
+		module_path = os.path.join(directory, name + '.py')
+
+		def is_private(path):
+			"""Returns True if path is owned by this user and can not be written by others (otherwise its code could be replaced)"""
+			stat = os.lstat(path)
+			return stat.st_uid == os.getuid() and not stat.st_mode & 0o022
+
+		os.makedirs(directory, mode=0o700, exist_ok=True)
+		if is_private(directory) and not os.path.exists(module_path):
+			import xml.etree.ElementTree
+			from PyQt import uic
+			logging.getLogger(__name__).info('Compiling "%s" into "%s"', path, module_path)
+			with tempfile.NamedTemporaryFile('w', dir=directory, prefix='.' + name + '.', suffix='.py', delete=False) as dst:
+				uic.compileUi(path, dst)
+				print('\n_widget_class = {!r}'.format(xml.etree.ElementTree.parse(path).getroot().find('widget').get('class')), file=dst)  # Class of the top widget (like uic.loadUi creates)
+			os.replace(dst.name, module_path)
+		if not (is_private(directory) and is_private(module_path)):
+			from PyQt import uic
+			logging.getLogger(__name__).warning('Cache "%s" is not private, "%s" is loaded without it', directory, path)
+			return uic.loadUi(path)
+
+		spec = importlib.util.spec_from_file_location('_ui_' + name, module_path)
+		module = importlib.util.module_from_spec(spec)
+		spec.loader.exec_module(module)
+
+		ui = next(v for k, v in vars(module).items() if k.startswith('Ui_'))()
+		view = getattr(QtWidgets, module._widget_class)()
+		ui.setupUi(view)
+		for key, value in vars(ui).items():  # Exposes widgets as attributes of the view (like uic.loadUi does)
+			setattr(view, key, value)
+		return view
 
 	@staticmethod
 	def _show_exception(message):
@@ -650,7 +701,9 @@ class MainController(AbstractController):
 			from_line, to_line = min(selected_indices or [None]), max(selected_indices or [None])
 			to_line = None if from_line == to_line else to_line
 
-			# Resets icons
+			# Resets icons (and forgets statuses of a previous run)
+			with self._pending_lock:
+				self._pending_statuses.clear()
 			self._reset_tree_entries_states()
 
 			command = [os.path.join(sys.path[0], './controllers/restore.py')]
@@ -666,19 +719,47 @@ class MainController(AbstractController):
 				command += ['--with-screencast']
 			if state_model.shell_command_prefix is not None:
 				command += ['--shell-command-prefix', pipes.quote(state_model.shell_command_prefix)]
+			if state_model.with_runner is not None:
+				command += ['--with-runner'] + ([pipes.quote(state_model.with_runner)] if state_model.with_runner else [])
+			status_src_fd, status_dst_fd = os.pipe()  # Framed channel for statuses and variables
+			command += ['--status-fd', status_dst_fd]
 			logging.getLogger(__name__).info('Running subprocess: %s', command)
 
-			state_model.process = process = subprocess.Popen(
-				cwd=os.getcwd(),
-				shell=True, text=True, args=' '.join([str(x) for x in command]),
-				start_new_session=True,  # Daemonizes process, the same as preexec_fn=os.setsid
-				bufsize=1,
-				stdin=subprocess.PIPE,
-				stdout=subprocess.PIPE,
-				stderr=subprocess.PIPE,
-			)
+			try:
+				state_model.process = process = subprocess.Popen(
+					cwd=os.getcwd(),
+					shell=True, text=True, args=' '.join([str(x) for x in command]),
+					start_new_session=True,  # Daemonizes process, the same as preexec_fn=os.setsid
+					bufsize=1,
+					stdin=subprocess.PIPE,
+					stdout=subprocess.PIPE,
+					stderr=subprocess.PIPE,
+					pass_fds=(status_dst_fd, ),
+					env=self._variables.snapshot(),  # Variables changed by previous runs are kept
+				)
+			except BaseException:
+				os.close(status_src_fd)  # Nobody writes it
+				raise
+			finally:
+				os.close(status_dst_fd)  # Is owned by subprocess now (or by nobody)
 			error_messages = []
 
+			def read_status():
+				reader = ChannelReader(status_src_fd)
+				try:
+					for record in reader:
+						try:
+							self._queue_pending(statuses=record.get('status', []), env=record.get('env'))
+						except Exception as e:
+							print('Exception in thread:', file=sys.stderr); sys.stderr.flush()
+							print(e, file=sys.stderr); sys.stderr.flush()
+				finally:
+					reader.close()
+				logging.getLogger(__name__).debug('Subprocess status loop is closed')
+			status_thread = threading.Thread(target=read_status)
+			status_thread.daemon = True
+			status_thread.start()
+
 			def read_stdout():
 				try:
 					for line in (x.rstrip() for x in iter(process.stdout.readline, '')):
@@ -702,25 +783,15 @@ class MainController(AbstractController):
 						if not line:  # Probably process was terminated
 							break
 						try:
-							if line.startswith('Status='):
+							if line.startswith('Status='):  # Legacy protocol (without status channel)
 								value = line.split('=', 1)[1]
 								if value.startswith('{'):
 									status = ast.literal_eval(value)
-									entry = tree.topLevelItem(int(status['index']))
-									if entry is not None:
-										if status.get('code', False):
-											entry.setText(0, '' if status['code'] == 'current' else '')
-											entry.setForeground(1, QtGui.QBrush(QtGui.QColor(self._state_colors[status['code']])))
-											entry.setBackground(2, QtGui.QBrush(QtGui.QColor(self._state_colors[status['code']])))
-											entry.setBackground(3, QtGui.QBrush(QtGui.QColor(self._state_colors[status['code']])))
-										tree.scrollToItem(entry, tree.EnsureVisible)
-										tree.viewport().update()  # Force update (fix for Qt5)
-							elif line.startswith('Env='):
+									self._queue_pending(statuses=[[int(status['index']), int(status['index']), status.get('code', '')]])
+							elif line.startswith('Env='):  # Legacy protocol (without status channel)
 								value = line.split('=', 1)[1]
 								if value.startswith('{'):
-									env = ast.literal_eval(value)
-									os.environ.update(env)
-									Caller.call_once_after(0, self._fill_tree_entries)
+									self._queue_pending(env=ast.literal_eval(value))
 							elif '[DEBUG]  ' in line:
 								logging.getLogger(__name__).debug(line)
 							elif '[INFO]  ' in line:
@@ -765,6 +836,52 @@ class MainController(AbstractController):
 			is_alive_thread.daemon = True
 			is_alive_thread.start()
 
+	def _queue_pending(self, statuses=(), env=None, calls=()):
+		"""Queues statuses [[from_index, to_index, code], ...], variables and calls (from any thread) till the next _apply_pending()"""
+		with self._pending_lock:
+			self._pending_calls.extend(calls)
+			for from_index, to_index, code in statuses:
+				for index in range(from_index, to_index + 1):
+					self._pending_statuses.pop(index, None)  # Keeps the latest one at the end
+					self._pending_statuses[index] = code
+			if env:
+				self._pending_env.update(env)
+
+	def _apply_pending(self):
+		"""Applies queued statuses and variables, makes queued calls (on GUI thread), scrolls and repaints tree at most once"""
+		tree = self.__view.commands_tree
+
+		with self._pending_lock:
+			if not self._pending_statuses and not self._pending_env and not self._pending_calls:
+				return
+			statuses, self._pending_statuses = self._pending_statuses, collections.OrderedDict()
+			env, self._pending_env = self._pending_env, dict()
+			calls, self._pending_calls = self._pending_calls, []
+
+		for call in calls:
+			call()
+
+		if env:
+			changed = self._variables.update(env)
+			self._commands_model.refresh(variables=changed)  # Renders only rows using changed variables again
+
+		if statuses:
+			tree.setUpdatesEnabled(False)
+			try:
+				entry_index = None
+				for index, code in statuses.items():
+					entry_index = self._set_entry_status(index, code) or entry_index
+				if entry_index is not None and entry_index.isValid():
+					tree.scrollTo(entry_index, tree.EnsureVisible)
+			finally:
+				tree.setUpdatesEnabled(True)
+			tree.viewport().update()  # Force update (fix for Qt5)
+
+	def _set_entry_status(self, index, code):
+		"""Colors entry of line index by status code, returns its model index (or None)"""
+		if code:
+			return self._commands_model.set_status(index, code)
+
 	def _stop(self):
 		state_model = self._state_model
 
@@ -827,15 +944,7 @@ class MainController(AbstractController):
 							if value.startswith('{'):
 								status = ast.literal_eval(value)
 								logging.getLogger(__name__).warning('status["index"]=' + '%s', status["index"])
-								entry = tree.topLevelItem(int(status['index']))
-								if entry is not None:
-									if status.get('code', False):
-										entry.setText(0, '' if status['code'] == 'current' else '')
-										entry.setForeground(1, QtGui.QBrush(QtGui.QColor(self._state_colors[status['code']])))
-										entry.setBackground(2, QtGui.QBrush(QtGui.QColor(self._state_colors[status['code']])))
-										entry.setBackground(3, QtGui.QBrush(QtGui.QColor(self._state_colors[status['code']])))
-									tree.scrollToItem(entry, tree.EnsureVisible)
-								tree.viewport().update()  # Force update (fix for Qt5)
+								self._queue_pending(statuses=[[int(status['index']), int(status['index']), status.get('code', '')]])
 						elif '[DEBUG]  ' in line:
 							logging.getLogger(__name__).debug(line)
 						elif '[INFO]  ' in line:
@@ -860,7 +969,9 @@ class MainController(AbstractController):
 				exit_code = process.returncode
 				logging.getLogger(__name__).info('Subprocess is terminated with exit code %s', exit_code)
 				state_model.process = None
+				self._queue_pending(calls=[move_new_lines])  # Touches selection and scrolling of the tree, so is called on GUI thread
 
+			def move_new_lines():
 				# Moves new lines to selection
 				indices = set([x.row() for x in tree.selectedIndexes()])
 				if indices:
@@ -902,10 +1013,14 @@ class MainController(AbstractController):
 			cut, lines[from_index:(from_index + count or None)] = lines[from_index:(from_index + count or None)], []
 			lines[to_index:to_index] = cut
 
-		entry = tree.topLevelItem(to_index)
-		tree.scrollToItem(entry, tree.EnsureVisible)
-		# tree.viewport().update()  # Force update (fix for Qt5)
-		entry.setSelected(True)
+		entry_index = self._commands_model.index(to_index, 0)
+		if entry_index.isValid():
+			tree.scrollTo(entry_index, tree.EnsureVisible)
+			# tree.viewport().update()  # Force update (fix for Qt5)
+			tree.selectionModel().select(
+				QtCore.QItemSelection(entry_index, self._commands_model.index(min(to_index + count, self._commands_model.rowCount()) - 1, 0)),
+				QtCore.QItemSelectionModel.Select | QtCore.QItemSelectionModel.Rows,
+			)
 
 	def _edit(self, index):
 		state_model = self._state_model
@@ -979,6 +1094,34 @@ class MainController(AbstractController):
 					command = 'gimp ' + ' '.join(pipes.quote(x) for x in patterns)
 					subprocess.check_output(command, shell=True, text=True)
 
+	def __combine_patterns_pixmaps(self, paths):
+		"""Returns a pixmap of scaled patterns side by side in a frame"""
+		border = 1
+		spacing = 2
+		pixmaps = [self._pixmaps_cache.get(x, load=self.__load_scaled_pixmap, key=('scaled', self._pattern_scale)) for x in paths]
+
+		combined_pixmap = QtGui.QPixmap(
+			2 * border + spacing * (len(pixmaps) + 1) + sum(x.width() for x in pixmaps),
+			2 * border + 2 * spacing + max(x.height() for x in pixmaps),
+		)
+
+		combined_pixmap.fill(QtGui.QColor('#fc0'))
+		painter = QtGui.QPainter(combined_pixmap)
+		painter.setPen(QtGui.QColor('#fff'))
+		painter.drawRect(0, 0, combined_pixmap.width() - 1, combined_pixmap.height() - 1)
+		for _index, x in enumerate(pixmaps):
+			painter.drawPixmap(
+				border + spacing + sum((spacing + pixmaps[x].width()) for x in range(_index)),
+				(combined_pixmap.height() - x.height()) // 2,
+				x,
+			)
+		painter.end()
+		return combined_pixmap
+
+	def __load_scaled_pixmap(self, path):
+		pixmap = self.__load_pixmap(path)
+		return pixmap.scaled(QtCore.QSize(int(self._pattern_scale * pixmap.width()), int(self._pattern_scale * pixmap.height())), QtCore.Qt.IgnoreAspectRatio)
+
 	@staticmethod
 	def __load_pixmap(path):
 		pixmap = QtGui.QPixmap()
@@ -986,6 +1129,23 @@ class MainController(AbstractController):
 			raise Exception('Exception during loading pixmap from "{path}"'.format(**locals()))
 		return pixmap
 
+	@staticmethod
+	def __dump_pixmap(pixmap):
+		data = QtCore.QByteArray()
+		buffer = QtCore.QBuffer(data)
+		buffer.open(QtCore.QIODevice.WriteOnly)
+		if not pixmap.save(buffer, 'PNG'):
+			raise Exception('Exception during saving pixmap')
+		buffer.close()
+		return bytes(data)
+
+	@staticmethod
+	def __parse_pixmap(data):
+		pixmap = QtGui.QPixmap()
+		if not pixmap.loadFromData(data, 'PNG'):
+			raise Exception('Exception during parsing pixmap')
+		return pixmap
+
 
 def run_init():
 	"""Shows Qt GUI."""
@@ -1002,6 +1162,9 @@ def run_init():
 	parser.add_argument('-r', '--with-screencast', action='store_true', help='Writes a video screencast')
 	parser.add_argument('-d', '--with-observer', action='store_true', default=True, help='Enables observing data for external updates and reloading them')
 	parser.add_argument('--shell-command-prefix', default='', help='Adds prefix to every event named "shell_command"')
+	parser.add_argument('--pixmap-cache-size', type=int, metavar='MB', help='Limits memory for icons and previews of patterns (default: 64)')
+	parser.add_argument('--with-pixmap-disk-cache', action='store_true', help='Keeps previews of patterns also in ~/.cache/pyguibot/pixmaps between launches')
+	parser.add_argument('--with-runner', nargs='?', const='', metavar='SOCKET', help='Runs tests in a long-lived runner with warm devices and caches (started on the first run) on socket (default: $PYGUIBOT_RUNNER_SOCKET or $XDG_RUNTIME_DIR/pyguibot-runner-<uid>-<display>.sock)')
 	parser.add_argument('PATH', nargs='?', help='Directory path where to load tests')
 	kwargs = vars(parser.parse_known_args()[0])  # Breaks here if something goes wrong
 	kwargs['path'] = next((x for x in [kwargs['path']] + [kwargs.pop('PATH')] if x is not None), None)  # Mixes positional argument "PATH" into named argument "path"
@@ -1009,6 +1172,17 @@ def run_init():
 	sys.exit(MainController(**kwargs).loop())
 
 
+def run_import_time():
+	"""Measures cold import of this module, exits with 1 if it is over budget (heavy libraries should be imported on first use)"""
+	import argparse
+	from helpers.timer import check_import_time
+	parser = argparse.ArgumentParser(description=run_import_time.__doc__)
+	parser.add_argument('--budget', type=float, default=250., metavar='MS', help='Fails if import takes longer (default: 250)')
+	kwargs = vars(parser.parse_known_args()[0])  # Breaks here if something goes wrong
+
+	sys.exit(0 if check_import_time('controllers.qt_gui', budget=kwargs['budget']) else 1)
+
+
 def main():
 	import argparse
 	parser = argparse.ArgumentParser(add_help=False)
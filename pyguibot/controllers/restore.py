@@ -9,14 +9,10 @@
 __doc__ = """
 """
 
+import contextlib
 import datetime
 import logging
-import multiprocessing
-import numpy
-import numexpr
 import os
-import screeninfo
-import shutil
 import signal
 import subprocess
 import sys
@@ -44,35 +40,114 @@ if __name__ == '__main__':
 	)
 logging.getLogger(__name__).setLevel(logging.DEBUG)
 
-from controllers.abstract import _DefaultDict, AbstractController
+from controllers.abstract import AbstractController
+from helpers.cache import FileCache
+from helpers.channel import ChannelWriter
+from helpers.jobs import Jobs, JobError
+from helpers.shell import ShellPool
 from helpers.timer import Timer
 from models.abstract import is_numeric
+from models.expression import Expression, ExpressionError
+from models.template import Template
+from models.variables import Variables
 from models.devices import (
 	Keyboard,
 	Mouse,
 	Screen,
+	VirtualDisplay,
 )
 
-try:
-	import cv2
-except ImportError:
-	print('', file=sys.stderr)
-	print('', file=sys.stderr)
-	print('  Library is not found. Try to install it using:', file=sys.stderr)
-	print('    # pip install opencv-python', file=sys.stderr)
-	print('', file=sys.stderr)
-	print('', file=sys.stderr)
-	raise
+# Heavy libraries (numpy, cv2, numexpr, screeninfo) are imported on first use, so that scenarios without patterns start at once
+
+
+def _import_cv2():
+	try:
+		import cv2
+	except ImportError:
+		print('', file=sys.stderr)
+		print('', file=sys.stderr)
+		print('  Library is not found. Try to install it using:', file=sys.stderr)
+		print('    # pip install opencv-python', file=sys.stderr)
+		print('', file=sys.stderr)
+		print('', file=sys.stderr)
+		raise
+	return cv2
 
 
 class Break(Exception):
 	pass
 
 
+class _StatusReporter(object):
+	"""Reports statuses of lines and changed variables to GUI in batches (at most every interval seconds, or on flush)
+
+	Writes coalesced records into channel if it is set, otherwise "Status=" and "Env=" lines into stderr.
+	"""
+
+	def __init__(self, channel=None, interval=.05):
+		self._channel = channel
+		self._interval = interval
+		self._statuses = []  # [[from_index, to_index, code], ...]
+		self._env = dict()
+		self._flushed_time = time.monotonic()
+
+	def status(self, index, code, to_index=None):
+		"""Sets status code of line index (or of lines from index to to_index)"""
+		to_index = index if to_index is None else to_index
+		statuses = self._statuses
+		if statuses and statuses[-1][:2] == [index, to_index]:
+			statuses.pop()  # Overrides previous status of the same lines
+		if statuses and statuses[-1][2] == code and statuses[-1][1] + 1 == index:
+			statuses[-1][1] = to_index  # Extends previous range
+		else:
+			statuses.append([index, to_index, code])
+		self._flush_if_needed()
+
+	def env(self, values):
+		self._env.update(values)
+		self._flush_if_needed()
+
+	def flush(self):
+		if self._statuses or self._env:
+			if self._channel is not None:
+				self._channel.send(dict(status=self._statuses, env=self._env))
+			else:
+				for from_index, to_index, code in self._statuses:
+					for index in range(from_index, to_index + 1):
+						print('Status={}'.format(dict(index=index, code=code)), file=sys.stderr)
+				if self._env:
+					print('Env={}'.format(self._env), file=sys.stderr)
+				sys.stderr.flush()
+			self._statuses, self._env = [], dict()
+		sys.stdout.flush()
+		self._flushed_time = time.monotonic()
+
+	def close(self):
+		self.flush()
+		if self._channel is not None:
+			self._channel.close()  # Lets reader see the end of stream (even if this process keeps running)
+			self._channel = None
+
+	"""Helpers"""
+
+	def _flush_if_needed(self):
+		if time.monotonic() - self._flushed_time >= self._interval:
+			self.flush()
+
+
 class RestoreController(AbstractController):
 	""""""
 
-	def __init__(self, path, verbose=0, from_line=None, to_line=None, with_screencast=False, shell_command_prefix=''):
+	_control_types = ('label', 'equation', 'condition', 'goto', 'delay', 'jump', 'break', 'join', 'kill')  # Steps never touching the screen, go without GUI-sync waits
+
+	_patterns_cache = FileCache(capacity=256 * 2**20, get_size=lambda x: (sum(xx.nbytes for xx in x) if isinstance(x, list) else x.nbytes))  # Process-wide, keeps decoded patterns (and their pyramids) between steps (and loops), level 0 of a pyramid is counted too: it outlives the evicted pattern
+	_pyramid_levels = 2  # Pyramid matching searches at 1/4 of resolution at first
+	_pyramid_min_size = 8  # Patterns are not downscaled below this size (in px)
+	_matching_executor = None  # Process-wide thread pool for (pattern x method)-jobs, OpenCV releases GIL while matching
+	_matching_threads = os.cpu_count() or 1
+	_expressions = dict()  # Process-wide, {text: compiled expression or None (if not supported)}
+
+	def __init__(self, path, verbose=0, from_line=None, to_line=None, with_screencast=False, shell_command_prefix='', screen_backend=None, pattern_cache_size=None, matching='pyramid', matching_threads=None, stable_frames=3, min_wait=.2, status_fd=None, expression_engine='builtin', shell_workers=0, max_jobs=None, stop_event=None):
 		super(RestoreController, self).__init__(path=path)
 		state_model = self._state_model
 		state_model.verbose = verbose
@@ -80,6 +155,23 @@ class RestoreController(AbstractController):
 		state_model.to_line = to_line
 		state_model.with_screencast = with_screencast
 		state_model.shell_command_prefix = shell_command_prefix
+		state_model.matching = matching
+		state_model.expression_engine = expression_engine
+		state_model.shell_workers = shell_workers
+		state_model.max_jobs = max_jobs
+		state_model.stable_frames = stable_frames
+		state_model.min_wait = min_wait
+		state_model.status_fd = status_fd
+		state_model.stop_event = stop_event  # Is set (by runner) to interrupt the run between steps (and in its sleeps)
+
+		self._variables['UPLOAD_PATH'] = state_model.tmp_directory_path  # Is seen by shell commands
+
+		if screen_backend is not None:
+			Screen.backend = screen_backend
+		if pattern_cache_size is not None:
+			self._patterns_cache.capacity = pattern_cache_size * 2**20
+		if matching_threads is not None:
+			RestoreController._matching_threads = matching_threads
 
 	"""Helpers"""
 
@@ -100,6 +192,7 @@ class RestoreController(AbstractController):
 			except Exception:
 				pass
 
+			import screeninfo
 			screen = screeninfo.get_monitors()[0]
 			logging.getLogger(__name__).warning('screen=' + '%s', screen)
 
@@ -140,63 +233,71 @@ class RestoreController(AbstractController):
 			record_screen_thread.setDaemon(False)  # Keeps a thread alive if an exception in main thread occurred
 			record_screen_thread.start()
 
+		reporter = _StatusReporter(channel=(ChannelWriter(state_model.status_fd) if state_model.status_fd is not None else None))
+		on_variables_changed = lambda values: (reporter.env({k: Variables.to_text(v) for k, v in values.items()}))  # Sends only changed variables (as texts)
+		self._variables.changed.bind(on_variables_changed)
+		shells = ShellPool(state_model.shell_workers, prefix=state_model.shell_command_prefix) if state_model.shell_workers else None  # Are started on demand
+		jobs = Jobs(os.path.join(state_model.tmp_directory_path, 'jobs'), max_jobs=state_model.max_jobs)  # Shell commands which are not waited for
+
 		try:
 			with self._with_data() as lines:
-				# for index, line in enumerate(lines):
-				index, next_index, skip_level = -1, None, None
+				program = self._compile(lines)  # Parses every line once (or loads it from cache)
+				index, next_index = -1, None
 				while True:
 					if next_index is None:
 						next_index = index + 1
 
 					index, next_index = next_index, None
 
-					if index >= len(lines):
+					if index >= len(program):
 						break
 
-					line = lines[index]
+					# Is interrupted here (not inside of a step) if asked for
+					if state_model.stop_event is not None and state_model.stop_event.is_set():
+						raise KeyboardInterrupt
 
 					# Skips if outside selected lines
 					if from_line is not None and index < from_line or to_line is not None and to_line < index:
 						continue
 
-					event = self._restore(line)
+					event = program[index]
+					level = event['level']
 
 					# Skips empty lines and comments
 					if 'comments' in event:  # If line is commented
-						print('Status={}'.format(dict(index=index, code='')), file=sys.stderr); sys.stderr.flush()
+						reporter.status(index, '')
 						continue
 
-					# Skips level with exception occurred
-					logging.getLogger(__name__).debug('level: %s', event['level'])
-					if skip_level is not None:
-						logging.getLogger(__name__).debug('skip_level: %s', skip_level)
-						if event['level'] >= skip_level:
-							print('Status={}'.format(dict(index=index, code='')), file=sys.stderr); sys.stderr.flush()
-							continue
-						else:
-							skip_level = None
+					# Fails on a line which can not be parsed (only if it is reached)
+					if 'error' in event:
+						reporter.status(index, 'failed')
+						reporter.flush()
+						raise SyntaxError('Line {} can not be parsed: {}'.format(index + 1, event['error']))
+
+					# Control steps (without patterns) go on a fast path: no GUI-sync waits, no device queries, batched status
+					is_control = event['type'] in self._control_types and 'patterns' not in event
 
 					try:
-						print('Status={}'.format(dict(index=index, code='current')), file=sys.stderr); sys.stderr.flush()
-						print('Doing step #{line_number}'.format(line_number=(index + 1))); sys.stdout.flush()
-						time.sleep(.1)  # Gives time to update status to "current" (GUI-side)
+						reporter.status(index, 'current')
+						print('Doing step #{line_number}'.format(line_number=(index + 1)))
+						if not is_control:
+							reporter.flush()
+							self._wait_until_stable(event, 'wait_before_step', .1 if state_model.status_fd is None else 0.)  # Gives time to update status to "current" (GUI-side, not needed with a status channel)
 
-						event_x, event_y = Mouse.position()
+						event_x, event_y = Mouse.position() if event['type'].startswith('mouse_') and 'patterns' not in event else (0, 0)
 
 						if 'patterns' in event:
-							# Delays before screen-shot
-							waiting_before_screenshot_time = 2.
-							logging.getLogger(__name__).debug('Waiting %ss before looking for patterns', waiting_before_screenshot_time)
-							time.sleep(waiting_before_screenshot_time)
+							# Delays before screen-shot (till the screen is stable)
+							self._wait_until_stable(event, 'wait_before_patterns', 2.)
 
 							# Looks for image patterns on the screen
 							try:
 								patterns_paths = [
-									os.path.join(
+									x if x is not None else os.path.join(
 										state_model.dst_directory_path,
-										self._substitute_variables_with_values(x)
+										self._substitute_variables_with_values(xx)
 									)
-									for x in event['patterns']
+									for x, xx in zip(program.patterns[index], event['patterns'])
 								]
 								event_x, event_y = self._locate_image_patterns(
 									paths=patterns_paths,
@@ -209,6 +310,7 @@ class RestoreController(AbstractController):
 										method: float(event[key])
 										for key in event if key.endswith('_threshold') for method in [key[:-len('_threshold')].upper()]
 									}),
+									matching=event.get('matching', state_model.matching),
 								)
 							except Exception as e:
 								# raise e.__class__(e.__class__(str(e) + ' [DEBUG: {}]'.format(locals()))).with_traceback(sys.exc_info()[2])
@@ -231,34 +333,25 @@ class RestoreController(AbstractController):
 								# Is number
 								next_index = (index + int(value)) if value.startswith('+') or value.startswith('-') else int(value)
 							else:
-								# Is label
-								_iterator = enumerate(lines)
-								if value.startswith('+'):
-									# Looks for label downward from current
-									value, _filter = value[1:], lambda i, index: (i > index)
-								elif value.startswith('-'):
-									# Looks for label upward from current in reversed order
-									value, _iterator, _filter = value[1:], zip(range(len(lines) - 1, -1, -1), lines[::-1]), lambda i, index: (i < index)
-								else:
-									# Looks for label downward from the beginning
-									_filter = lambda i, index: (True)
-								next_index = next((i for i, x in _iterator if _filter(i, index) for xx in [self._restore(x)] if xx.get('type', '') == 'label' and xx.get('value', '') == value), None)
-								if index is None:
+								# Is label (downward from current if "+label", upward if "-label", from the beginning otherwise)
+								next_index = program.find_label(value, index=index)
+								if next_index is None:
 									raise Break('Label "{value}" not found'.format(**locals()))
 							from_line, to_line = None, None  # Re-sets selected range (because no sense to go up/down only inside it)
 						elif event['type'] == 'label':
 							pass
 						elif event['type'] == 'delay':
 							value = self._substitute_variables_with_values(event['value'])
-							time.sleep(float(value))
+							reporter.flush()
+							self._sleep(float(value))
 						elif event['type'] in ('jump', 'break'):
 							value = self._substitute_variables_with_values(event['value'])
 							if str(value)[:1] in '-+':
-								event['level'] += 1 + int(value)
+								level += 1 + int(value)
 							else:
-								event['level'] = int(value)
+								level = int(value)
 							raise Break(
-								'{type}ing to {event[level]}'.format(
+								'{type}ing to {level}'.format(
 									type=event['type'].title(),
 									**locals()
 								) + (
@@ -267,37 +360,56 @@ class RestoreController(AbstractController):
 							)
 						elif event['type'] == 'equation':
 							key, equation = [x.strip() for x in event['value'].split('=', 1)]
-							equation = self._substitute_variables_with_values(equation, env=_DefaultDict(
-								os.environ,
-								default=lambda k: (None),  # Allows to write "X = {X} or 0" in order to initiate variable X
-							))
-							value = str(numexpr.evaluate(equation))
-							os.environ[key] = value
-							print('Env={}'.format({key: value}), file=sys.stderr); sys.stderr.flush()
+							self._variables[key] = self._evaluate(equation, event, default=None)  # Default allows to write "X = {X} or 0" in order to initiate variable X
 						elif event['type'] == 'condition':
-							condition = self._substitute_variables_with_values(event['value'])
-							value = bool(numexpr.evaluate(condition))
+							value = bool(self._evaluate(event['value'], event))
 							if not value:
 								raise Break('Condition not satisfied, breaking with{message}.'.format(
 									message=' message "{event[message]}"'.format(**locals()) if 'message' in event else ' no message',
 									**locals()
 								))
 						elif event['type'] == 'shell_command':
-							shell_command = state_model.shell_command_prefix + self._substitute_variables_with_values(event['value'])
+							shell_command = self._substitute_variables_with_values(event['value'])
 							logging.getLogger(__name__).debug('Command: %s', shell_command)
-							process = subprocess.Popen(
-								shell_command,
-								shell=True, text=True,
-								stdout=sys.stdout,
-								stderr=sys.stderr,
-								env=dict(os.environ, **dict(UPLOAD_PATH=state_model.tmp_directory_path)),
-							)
-							if event.get('wait', True):
-								# logging.getLogger(__name__).warning('<shell command output>')
+							if not event.get('wait', True):
+								try:
+									jobs.start(
+										state_model.shell_command_prefix + shell_command,
+										env=self._variables.snapshot(),
+										name=(self._substitute_variables_with_values(event['job']) if 'job' in event else None),
+										timeout=float(event.get('timeout', 60.)),  # Waits for a free slot (with --max-jobs) not longer
+									)
+								except JobError as e:
+									raise Break('{}.'.format(e))
+								exit_code = 0
+							elif shells is not None and not event.get('isolated', False):
+								sys.stdout.flush()
+								exit_code = shells.run(shell_command, env=self._variables.snapshot())  # Prefix is applied by the shell
+							else:
+								process = subprocess.Popen(
+									state_model.shell_command_prefix + shell_command,
+									shell=True, text=True,
+									stdout=sys.stdout,
+									stderr=sys.stderr,
+									env=self._variables.snapshot(),  # Is copied only if variables were changed since the previous command
+								)
 								exit_code = process.wait()
-								# logging.getLogger(__name__).warning('</shell command output>')
-								if exit_code:
-									raise Break('Command was terminated with exit code {exit_code}.'.format(**locals()))
+							if exit_code:
+								raise Break('Command was terminated with exit code {exit_code}.'.format(**locals()))
+						elif event['type'] in ('join', 'kill'):
+							name = self._substitute_variables_with_values(event.get('value', '')) or None  # Every job if not set
+							reporter.flush()
+							try:
+								if event['type'] == 'join':
+									exit_codes = jobs.join(name, timeout=(float(event['timeout']) if 'timeout' in event else None))
+								else:
+									jobs.kill(name, timeout=float(event.get('timeout', 5.)))
+									exit_codes = dict()
+							except JobError as e:
+								raise Break('{}.'.format(e))
+							exit_codes = {k: v for k, v in (exit_codes.items() if name is None else [(name, exit_codes)]) if v}
+							if exit_codes:
+								raise Break(', '.join('Job "{}" was terminated with exit code {}'.format(k, v) for k, v in exit_codes.items()) + '.')
 						elif event['type'] == 'keyboard_press':
 							self._tap(self._substitute_variables_with_values(event['value']), delay=.08)
 						elif event['type'] == 'keyboard_release':
@@ -315,60 +427,111 @@ class RestoreController(AbstractController):
 							Mouse.slide(event_x, event_y)
 						elif event['type'] == 'mouse_press':
 							Mouse.slide(event_x, event_y)
-							time.sleep(.2)  # Waits till reaction is shown
+							self._wait_until_stable(event, 'wait_before_click', .2)  # Waits till reaction is shown
 							Mouse.press(event_x, event_y)
 						elif event['type'] == 'mouse_release':
 							Mouse.slide(event_x, event_y)
-							time.sleep(.2)  # Waits till reaction is shown
+							self._wait_until_stable(event, 'wait_before_click', .2)  # Waits till reaction is shown
 							Mouse.release(event_x, event_y)
 						elif event['type'] == 'mouse_click':
 							Mouse.slide(event_x, event_y)
-							time.sleep(.2)  # Waits till reaction is shown
+							self._wait_until_stable(event, 'wait_before_click', .2)  # Waits till reaction is shown
 							Mouse.click(event_x, event_y, button=1, count=1)
 						elif event['type'] == 'mouse_double_click':
 							Mouse.slide(event_x, event_y)
-							time.sleep(.2)  # Waits till reaction is shown
+							self._wait_until_stable(event, 'wait_before_click', .2)  # Waits till reaction is shown
 							Mouse.click(event_x, event_y, button=1, count=1)  # Fix: clicks once at first
-							time.sleep(.8)  # Waits till reaction is shown
+							self._wait_until_stable(event, 'wait_between_clicks', .8)  # Waits till reaction is shown
 							Mouse.click(event_x, event_y, button=1, count=2)
 						elif event['type'] == 'mouse_right_click':
 							Mouse.slide(event_x, event_y)
-							time.sleep(.2)  # Waits till reaction is shown
+							self._wait_until_stable(event, 'wait_before_click', .2)  # Waits till reaction is shown
 							Mouse.click(event_x, event_y, button=2, count=1)
 						elif event['type'] == 'mouse_scroll':
 							Mouse.scroll(horizontal=event_x, vertical=event_y)
 
-						print('Status={}'.format(dict(index=index, code='completed')), file=sys.stderr); sys.stderr.flush()
-						time.sleep(.2)  # Waits till reaction to event is shown and gives time to update status (GUI-side)
+						reporter.status(index, 'completed')
+						if not is_control:
+							reporter.flush()
+							self._wait_until_stable(event, 'wait_after_step', .2)  # Waits till reaction to event is shown and gives time to update status (GUI-side)
 
 					except Break as e:
 						# Updates status (GUI-side)
 						if event['type'] in ('jump', 'condition'):
-							print('Status={}'.format(dict(index=index, code=('completed'))), file=sys.stderr); sys.stderr.flush()
+							reporter.status(index, 'completed')
 						else:
-							print('Status={}'.format(dict(index=index, code=('failed'))), file=sys.stderr); sys.stderr.flush()
-
-						if event['level'] > 0:
-							logging.getLogger(__name__).debug('Skipping level %s for %s', event['level'], event)
-							skip_level = event['level']
+							reporter.status(index, 'failed')
+
+						if level > 0:
+							logging.getLogger(__name__).debug('Skipping level %s for %s', level, event)
+							# Skips the rest of the branch at once
+							next_index = program.skip(index, level=level)
+							_from_index, _to_index = max(index + 1, from_line or 0), min(next_index, len(program) if to_line is None else (to_line + 1)) - 1
+							if _from_index <= _to_index:
+								reporter.status(_from_index, '', to_index=_to_index)
 						elif event['type'] == 'jump':
+							reporter.flush()
 							print(repr(e)); sys.stdout.flush()
 							break
 						else:
 							# raise e.__class__, e.__class__(unicode(e) + ' [DEBUG: {}]'.format(dict(line=index, event=event))), sys.exc_info()[2]
 							# print(repr(e), file=sys.stderr); sys.stderr.flush()
+							reporter.flush()
 							print(str(e), file=sys.stderr); sys.stderr.flush()
 							sys.exit(1)
 
 		except KeyboardInterrupt:
-			pass
+			jobs.kill(signum=signal.SIGINT, timeout=1.)  # Are interrupted with the run (like commands in its process group), are left running only if the run is over
 
 		finally:
+			self._variables.changed.unbind(on_variables_changed)
+			if shells is not None:
+				shells.close()
+			jobs.close()
+			reporter.close()
 			if state_model.with_screencast:
 				# Stops screen record thread and saves a screen record
 				screen_record_is_running = False
 				record_screen_thread.join()
 
+	def _evaluate(self, text, event, default=Expression._missing):
+		"""Returns value of expression (compiled once), evaluates it with numexpr if selected (or not supported)"""
+		expression = None
+		if event.get('expression_engine', self._state_model.expression_engine) == 'builtin':
+			if text not in self._expressions:
+				try:
+					self._expressions[text] = Expression.compile(text)
+				except ExpressionError as e:
+					logging.getLogger(__name__).warning('%s, is evaluated with numexpr', e)
+					self._expressions[text] = None
+			expression = self._expressions[text]
+
+		if expression is not None:
+			return expression.evaluate(self._variables, default=default)
+
+		import numexpr  # Starts a thread pool, is imported only if needed
+		value = numexpr.evaluate(Template.compile(text).render(self._variables, **({} if default is Expression._missing else dict(default=default))))
+		return value.item() if value.shape == () else value  # Keeps a scalar as a number (not as a 0-d array)
+
+	def _wait_until_stable(self, event, key, default):
+		"""Waits till the screen is stable, but not shorter than min_wait and not longer than event[key] (or default) seconds"""
+		timeout = float(self._substitute_variables_with_values(str(event.get(key, default))))
+		if timeout > 0:
+			logging.getLogger(__name__).debug('Waiting up to %ss (%s) till the screen is stable', timeout, key)
+			Screen.wait_until_stable(
+				timeout,
+				frames=int(event.get('stable_frames', self._state_model.stable_frames)),
+				minimum=float(event.get('min_wait', self._state_model.min_wait)),
+			)
+
+	def _sleep(self, seconds):
+		"""Sleeps, but raises KeyboardInterrupt at once if the run is asked to stop"""
+		stop_event = self._state_model.stop_event
+		if stop_event is None:
+			time.sleep(seconds)
+		elif stop_event.wait(seconds):
+			raise KeyboardInterrupt
+
 	def _tap(self, keys, delay=.08):
 		for key in keys.split(','):
 			if key:
@@ -384,13 +547,23 @@ class RestoreController(AbstractController):
 				except KeyError as e:
 					raise Break('Wrong key {key}'.format(**locals()))
 
-	def _locate_image_patterns(self, paths, timeout, delay, threshold):
+	def _locate_image_patterns(self, paths, timeout, delay, threshold, matching='pyramid'):
 		"""Looks for image patterns on the screen, returns centered position or None"""
+		import concurrent.futures
+		import numpy
+		from models.matching import build_pyramid, get_changed_regions, match_exhaustive, match_pyramid
 		state_model = self._state_model
 
-		logging.getLogger(__name__).debug('Looking for patterns "%s"...', paths)
+		logging.getLogger(__name__).debug('Looking for patterns "%s" (%s matching)...', paths, matching)
 
-		patterns = [self._load_array(x) for x in paths]
+		if matching == 'pyramid':
+			patterns_pyramids = [self._patterns_cache.get(x, load=self._load_pattern_pyramid, key='pyramid') for x in paths]
+		else:
+			patterns_pyramids = [[self._patterns_cache.get(x, load=self._load_pattern)] for x in paths]
+		patterns = [x[0] for x in patterns_pyramids]
+		logging.getLogger(__name__).debug('Patterns cache: %s', self._patterns_cache)
+		margin = tuple(max(x.shape[1 - i] for x in patterns if x is not None) - 1 for i in range(2))  # Patterns overlapping a change
+		previous_array = None  # Already matched screen shot (without success)
 		_timeout = timeout
 
 		while True:
@@ -401,54 +574,69 @@ class RestoreController(AbstractController):
 			for _subpath in [x for x in _files if x.startswith('pattern-') and x.endswith('.png')]:
 				os.unlink(os.path.join(_path, _subpath))
 
-			# Makes screen shot
+			# Makes screen shot (as BGR numpy-array)
 			logging.getLogger(__name__).debug('Capturing screen shot...')
 			with Timer('capturing screenshot'):
-				screenshot = Screen.get_screenshot()
-
-			# Converts PIL image to numpy array
-			# with Timer('converting screenshot to numpy-array'):
-			screenshot_array = self._convert_image_to_array(screenshot)
-
-			patterns_correlations = []
-			for pattern_index, (path, pattern) in enumerate(zip(paths, patterns), start=1):
-				if pattern is None:
-					logging.getLogger(__name__).warning('Pattern #%s is None, path: %s, ignoring...', pattern_index, path)
-				else:
-					# Looks for an image pattern
+				screenshot_array = Screen.get_screenshot_array()
+
+			# Matches only regions changed since the previous screen shot (the rest was already matched without success)
+			regions = get_changed_regions(previous_array, screenshot_array, margin=margin)
+			if not regions:
+				logging.getLogger(__name__).debug('Screen is not changed, skipping matching')
+			elif len(regions) > 1 or regions[0] != (0, 0) + screenshot_array.shape[1::-1]:
+				logging.getLogger(__name__).debug('Screen is changed in regions %s', regions)
+
+			# Matches every pattern with every method in parallel, stops at the first correlation above its threshold
+			jobs = dict()
+			for region in regions:
+				x0, y0, width, height = region
+				region_array = screenshot_array[y0:y0 + height, x0:x0 + width]
+				if matching == 'pyramid':
+					region_pyramid = build_pyramid(region_array, levels=max(len(x) for x in patterns_pyramids) - 1)
+				for pattern_index, (path, pattern, pattern_pyramid) in enumerate(zip(paths, patterns, patterns_pyramids), start=1):
+					if pattern is None:
+						logging.getLogger(__name__).warning('Pattern #%s is None, path: %s, ignoring...', pattern_index, path)
+					elif pattern.shape[0] <= height and pattern.shape[1] <= width:
+						for method in threshold:
+							job = self._get_matching_executor().submit(
+								*((match_pyramid, region_pyramid, pattern_pyramid, method) if matching == 'pyramid' else (match_exhaustive, region_array, pattern, method))
+							)
+							jobs[job] = (pattern_index, path, pattern, region)
+			try:
+				for job in concurrent.futures.as_completed(jobs):
+					pattern_index, path, pattern, (x0, y0, _width, _height) = jobs[job]
+					correlation = job.result()
+					for key in ('min_location', 'max_location'):
+						correlation[key] = (correlation[key][0] + x0, correlation[key][1] + y0)
 					height, width = pattern.shape[:2]
-					methods = list(threshold.keys())
-					# with Timer('finding correlations'):
-					correlations = [
-						dict([['method', method]] + list(zip(
-							('min_correlation', 'max_correlation', 'min_location', 'max_location'),
-							cv2.minMaxLoc(cv2.matchTemplate(screenshot_array, pattern, getattr(cv2, method))),  # ~0.7s for each call of "cv2.matchTemplate"
-						)))
-						for method in methods
-					]
-					patterns_correlations += [correlations]
 
 					# Prints out and saves found parts into files
-					if any(x['max_correlation'] >= (.8 * threshold[x['method']]) for x in correlations):
-						print('Correlation:', ', '.join([
-							'{max_correlation:.1%} for {method} {max_location}'.format(**x) for x in sorted(correlations, key=lambda x: (x['method']))
-						])); sys.stdout.flush()
-						for correlation in correlations:
-							if correlation['max_correlation'] >= (.8 * threshold[correlation['method']]):
-								self._save_array(
-									screenshot_array[
-										correlation['max_location'][1]:correlation['max_location'][1] + height,
-										correlation['max_location'][0]:correlation['max_location'][0] + width,
-									],
-									os.path.join(state_model.tmp_directory_path, 'pattern-{0}-{1[method]}-{1[max_correlation]:.1%}.png'.format(pattern_index, correlation)),
-								)
-
-					for correlation in correlations:
-						if correlation['max_correlation'] >= threshold[correlation['method']]:
-							logging.getLogger(__name__).debug('Pattern "%s" is found', path)
-							x, y = correlation['max_location']
-							return x + width // 2, y + height // 2
-							# cv2.rectangle(screenshot_array, (x, y), (x + width, y + height), (0, 0, 255), 1)
+					if correlation['max_correlation'] >= (.8 * threshold[correlation['method']]):
+						print('Correlation: {max_correlation:.1%} for {method} {max_location} of pattern #{pattern_index}'.format(pattern_index=pattern_index, **correlation)); sys.stdout.flush()
+						self._save_array(
+							screenshot_array[
+								correlation['max_location'][1]:correlation['max_location'][1] + height,
+								correlation['max_location'][0]:correlation['max_location'][0] + width,
+							],
+							os.path.join(state_model.tmp_directory_path, 'pattern-{0}-{1[method]}-{1[max_correlation]:.1%}.png'.format(pattern_index, correlation)),
+						)
+
+					if correlation['max_correlation'] >= threshold[correlation['method']]:
+						logging.getLogger(__name__).debug('Pattern "%s" is found', path)
+						x, y = correlation['max_location']
+						return x + width // 2, y + height // 2
+						# cv2.rectangle(screenshot_array, (x, y), (x + width, y + height), (0, 0, 255), 1)
+			finally:
+				# Cancels jobs which are not started yet (if found or failed), waits for running ones (they read the screen shot, which is re-used by the next one)
+				for job in jobs:
+					job.cancel()
+				concurrent.futures.wait(jobs)
+
+			# Keeps the screen shot (its buffer can be re-used by the next one) to compare with the next one
+			if previous_array is None or previous_array.shape != screenshot_array.shape:
+				previous_array = screenshot_array.copy()
+			else:
+				numpy.copyto(previous_array, screenshot_array)
 			# else:
 			# Prints out correlation values in order to calculate threshold value precisely
 			# if any(xx['max_correlation'] >= (.8 * threshold[xx['method']]) for x in patterns_correlations for xx in x):
@@ -464,7 +652,7 @@ class RestoreController(AbstractController):
 				)))
 			)
 			if _delay > 0:
-				time.sleep(_delay)
+				self._sleep(_delay)
 			else:
 				logging.getLogger(__name__).warning('Screenshot overtime %s', -_delay)
 			t2 = time.monotonic()
@@ -477,6 +665,7 @@ class RestoreController(AbstractController):
 				# if logging.getLevelName(logging.getLogger(__name__).getEffectiveLevel()) in ('DEBUG', 'INFO'):
 				if True:
 					# Stores failed patterns
+					import shutil
 					for index, path in enumerate(paths, start=1):
 						shutil.copyfile(path, os.path.join(state_model.tmp_directory_path, 'pattern-{}.png'.format(index)))
 
@@ -500,6 +689,7 @@ class RestoreController(AbstractController):
 
 	@staticmethod
 	def _load_array(path):
+		cv2 = _import_cv2()
 		mode = getattr(cv2, 'CV_LOAD_IMAGE_UNCHANGED', cv2.IMREAD_UNCHANGED)
 		# mode = getattr(cv2, 'CV_LOAD_IMAGE_GRAYSCALE', cv2.IMREAD_GRAYSCALE)
 		# mode = getattr(cv2, 'CV_LOAD_IMAGE_COLOR', cv2.IMREAD_COLOR)
@@ -510,21 +700,40 @@ class RestoreController(AbstractController):
 			raise Exception('Unknown error: cv2.imread("{}") returns None'.format(path))
 		return image
 
-	@staticmethod
-	def _save_array(array, path):
-		cv2.imwrite(path, array)
+	@classmethod
+	def _load_pattern(cls, path):
+		"""Loads image pattern, returns BGR-array (alpha is dropped, gray is expanded) comparable with screen shots"""
+		cv2 = _import_cv2()
+		image = cls._load_array(path)
+		if image.ndim == 2:
+			image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+		elif image.shape[2] == 4:
+			image = cv2.cvtColor(image, cv2.COLOR_BGRA2BGR)
+		image.flags.writeable = False  # Is shared between steps
+		return image
+
+	@classmethod
+	def _get_matching_executor(cls):
+		if cls._matching_executor is None:
+			import concurrent.futures
+			RestoreController._matching_executor = concurrent.futures.ThreadPoolExecutor(max_workers=cls._matching_threads, thread_name_prefix='matching')
+		return cls._matching_executor
+
+	@classmethod
+	def _load_pattern_pyramid(cls, path):
+		"""Returns downscaled copies of a (cached) pattern for coarse-to-fine matching, the first one is the pattern itself"""
+		from models.matching import build_pyramid
+		return build_pyramid(cls._patterns_cache.get(path, load=cls._load_pattern), levels=cls._pyramid_levels, min_size=cls._pyramid_min_size)
 
 	@staticmethod
-	def _convert_image_to_array(image):
-		"""Converts PIL image to numpy array, returns array"""
-		array = numpy.array(image)  # Convert to numpy array
-		# array = numpy.array(image, dtype='uint8')  # Convert to numpy array
-		array = cv2.cvtColor(array, cv2.COLOR_RGB2BGR)  # Revert color order: RGB -> BGR
-		return array
+	def _save_array(array, path):
+		_import_cv2().imwrite(path, array)
 
 
 def run_find_template():
 	"""Only for developing purposes"""
+	import numpy
+	cv2 = _import_cv2()
 	src_path = 'data/scenario.pyguibot'
 	template = RestoreController._load_array(os.path.join(os.path.dirname(os.path.realpath(src_path)), '.pattern.png'))
 	screenshot = RestoreController._load_array(os.path.join(os.path.dirname(os.path.realpath(src_path)), '.screenshot.png'))
@@ -558,14 +767,58 @@ def run_init():
 	parser.add_argument('-t', '--to-line', type=int, help='Line to end to')
 	parser.add_argument('-s', '--with-screencast', action='store_true', help='Writes a video screencast')
 	parser.add_argument('--shell-command-prefix', default='', help='Adds prefix to every event named "shell_command"')
+	parser.add_argument('--shell-workers', type=int, default=0, metavar='N', help='Runs waiting "shell_command" events in up to N long-lived shells (default: 0, a new shell for every command; step\'s "isolated" runs it in a new shell anyway)')
+	parser.add_argument('--max-jobs', type=int, metavar='N', help='Limits background jobs ("shell_command" events with "wait": false) running at once, the next one waits up to step\'s "timeout" (default: 60s) and fails then (default: no limit)')
+	parser.add_argument('--status-fd', type=int, help='Writes statuses of lines and changed variables (as length-prefixed JSON-records) into this file descriptor instead of stderr')
+	parser.add_argument('--screen-backend', choices=Screen.backends, help='Selects how screen shots are made (default: $PYGUIBOT_SCREEN_BACKEND or "{}", "scrot" is too slow to end waits when the screen is stable)'.format(Screen.backend))
+	parser.add_argument('--matching', choices=('pyramid', 'exhaustive'), default='pyramid', help='Selects template matching: coarse-to-fine (default) or exhaustive at full resolution (can be overridden by step\'s "matching")')
+	parser.add_argument('--expression-engine', choices=('builtin', 'numexpr'), default='builtin', help='Selects how equations and conditions are evaluated: compiled once (default, falls back to numexpr if not supported) or with numexpr (for array-style expressions, can be overridden by step\'s "expression_engine")')
+	parser.add_argument('--matching-threads', type=int, help='Limits threads matching patterns in parallel (default: number of CPUs, {})'.format(RestoreController._matching_threads))
+	parser.add_argument('--stable-frames', type=int, default=3, help='Ends waits (before steps, clicks, patterns) as soon as so many consecutive frames are equal (default: 3, 0 means fixed sleeps, can be overridden by step\'s "stable_frames"). Not with backend "scrot": it always sleeps for the whole wait')
+	parser.add_argument('--min-wait', type=float, default=.2, metavar='SECONDS', help='Waits at least so long before frames are compared, an application may not react to input at once (default: 0.2, can be overridden by step\'s "min_wait")')
+	parser.add_argument('--pattern-cache-size', type=int, metavar='MB', help='Limits memory for decoded image patterns (default: 256)')
+	parser.add_argument('--with-xvfb', nargs='?', const='1280x1024x24', metavar='GEOMETRY', help='Launches own Xvfb (default geometry: 1280x1024x24) and reads screen from its memory-mapped framebuffer')
+	parser.add_argument('--with-runner', nargs='?', const='', metavar='SOCKET', help='Runs in a long-lived runner with warm devices and caches (starts it if needed) on socket (default: $PYGUIBOT_RUNNER_SOCKET or $XDG_RUNTIME_DIR/pyguibot-runner-<uid>-<display>.sock)')
 	kwargs = vars(parser.parse_known_args()[0])  # Breaks here if something goes wrong
+	xvfb_geometry = kwargs.pop('with_xvfb')
+	runner_path = kwargs.pop('with_runner')
+	kwargs['verbose'] = {logging.INFO: 1, logging.DEBUG: 2}.get(logging.getLogger(__name__).level, 0)
+
+	if runner_path is not None and kwargs['path'] is not None:
+		from controllers.runner import RunnerClient
+		status_fd = kwargs.pop('status_fd')
+		kwargs['path'] = os.path.realpath(kwargs['path'])
+		server_args = [
+			x for key in ('screen_backend', 'pattern_cache_size', 'matching_threads') if kwargs[key] is not None
+			for x in ('--' + key.replace('_', '-'), kwargs[key])
+		] + (['--with-xvfb', xvfb_geometry] if xvfb_geometry is not None else [])  # Are applied if the runner is started by this call
+		exit_code = RunnerClient(runner_path or None, display=(None if xvfb_geometry is None else 'xvfb-' + xvfb_geometry)).run(kwargs, status_fd=status_fd, server_args=server_args)
+		if exit_code is not None:
+			sys.exit(exit_code)
+		logging.getLogger(__name__).warning('Runner is not available, running in this process')
+		kwargs['status_fd'] = status_fd
 
 	try:
-		RestoreController(**kwargs).loop()
+		with (VirtualDisplay(xvfb_geometry) if xvfb_geometry is not None else contextlib.nullcontext()) as display:
+			if display is not None:
+				Screen.framebuffer_path = display.framebuffer_path
+				kwargs['screen_backend'] = kwargs['screen_backend'] or 'xvfb'
+			RestoreController(**kwargs).loop()
 	except KeyboardInterrupt:
 		pass
 
 
+def run_import_time():
+	"""Measures cold import of this module, exits with 1 if it is over budget (heavy libraries should be imported on first use)"""
+	import argparse
+	from helpers.timer import check_import_time
+	parser = argparse.ArgumentParser(description=run_import_time.__doc__)
+	parser.add_argument('--budget', type=float, default=150., metavar='MS', help='Fails if import takes longer (default: 150)')
+	kwargs = vars(parser.parse_known_args()[0])  # Breaks here if something goes wrong
+
+	sys.exit(0 if check_import_time('controllers.restore', budget=kwargs['budget']) else 1)
+
+
 def main():
 	import argparse
 	parser = argparse.ArgumentParser(add_help=False)
@@ -0,0 +1,306 @@
+#!/bin/sh
+# -*- coding: utf-8 -*-
+# vim: noexpandtab
+"exec" "python3" "-B" "$0" "$@"
+# (c) gehrmann
+
+
+
+__doc__ = """
+This module provides a long-lived runner of scenarios (a daemon on a local Unix socket) and its thin client
+
+The runner keeps imported modules, devices (X connections) and decoded patterns warm between runs, so that
+a run starts in milliseconds instead of seconds. Runs are executed one after another (devices are shared).
+
+A client connects, passes its stdout, stderr (and status channel, if any) as file descriptors, sends a request
+{"kwargs": {...}, "cwd": ..., "env": {...}} as a framed JSON-record and waits for {"exit": code}.
+Statuses of lines and changed variables are written by the runner directly into the passed status channel
+(or as "Status=" and "Env=" lines into the passed stderr). The client sends {"stop": true} (or just disconnects)
+in order to interrupt a run: it is stopped before its next step (or in a sleep), never inside of switching
+the working directory, variables and file descriptors of the runner.
+
+Devices of the runner stay bound to the display it was started on, so every display has its own runner
+(the display is a part of the socket's name) and a request from another display is refused (the client runs it itself).
+A runner which owns its Xvfb (--with-xvfb) runs every request on that Xvfb.
+
+Environment variables:
+	LOGGING_<MODULE> -- Logging level ( NOTSET | DEBUG | INFO | WARNING | ERROR | CRITICAL )
+	PYGUIBOT_RUNNER_SOCKET -- Path of runner's socket (default: $XDG_RUNTIME_DIR/pyguibot-runner-<uid>-<display>.sock)
+"""
+
+import contextlib
+import logging
+import os
+import re
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import traceback
+
+if __name__ == '__main__':
+	# Sets utf-8 (instead of latin1) as default encoding for every IO
+	# import importlib; importlib.reload(sys); sys.setdefaultencoding('utf-8')
+	# Runs in application's working directory
+	sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)) + '/..')
+	# Working interruption by Ctrl-C
+	signal.signal(signal.SIGINT, signal.default_int_handler)
+	# Configures logging
+	logging.basicConfig(
+		level=logging.WARN, datefmt='%H:%M:%S',
+		format='%(asctime)s.%(msecs)03d %(pathname)s:%(lineno)d [%(levelname)s]  %(message)s',
+	)
+logging.getLogger(__name__).setLevel(getattr(logging, os.environ.get('LOGGING_' + __name__.replace('.', '_').upper(), 'WARNING')))
+
+from helpers.channel import ChannelReader, ChannelWriter
+
+
+def get_default_socket_path(display=None):
+	"""Returns path of runner's socket for display (default: $DISPLAY)"""
+	display = os.environ.get('DISPLAY', '') if display is None else display
+	return os.environ.get('PYGUIBOT_RUNNER_SOCKET') or os.path.join(
+		os.environ.get('XDG_RUNTIME_DIR') or tempfile.gettempdir(),
+		'pyguibot-runner-{}-{}.sock'.format(os.getuid(), re.sub(r'[^\w.-]', '_', display) or 'none'),
+	)
+
+
+class RunnerServer(object):
+	"""Accepts run requests on a Unix socket, runs them (one after another) in this warm process"""
+
+	def __init__(self, path=None, owns_display=False, **kwargs):
+		self._path = path or get_default_socket_path()
+		self._owns_display = owns_display  # Is set if runner has started its own Xvfb
+		self._display = None  # Display which devices are bound to
+		self._kwargs = kwargs  # Process-wide defaults of RestoreController (screen backend, caches, threads)
+
+	def serve(self):
+		from controllers.restore import RestoreController  # Imported once (with devices), stays warm for every run
+		self._display = os.environ.get('DISPLAY')
+
+		# Removes a stale socket (if no runner listens on it)
+		if os.path.exists(self._path):
+			with contextlib.closing(socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)) as probe:
+				if probe.connect_ex(self._path) == 0:
+					raise Exception('Runner is already listening on "{}"'.format(self._path))
+			os.unlink(self._path)
+
+		with contextlib.closing(socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)) as listener:
+			with self._with_umask(0o077):
+				listener.bind(self._path)
+			listener.listen(8)
+			logging.getLogger(__name__).info('Runner is listening on "%s"', self._path)
+			try:
+				while True:
+					connection, _address = listener.accept()
+					with contextlib.closing(connection):
+						try:
+							self._serve_connection(connection, RestoreController)
+						except Exception as e:
+							logging.getLogger(__name__).error('Connection is dropped: %r', e)
+			except KeyboardInterrupt:
+				pass
+			finally:
+				if os.path.exists(self._path):
+					os.unlink(self._path)
+
+	"""Helpers"""
+
+	@staticmethod
+	@contextlib.contextmanager
+	def _with_umask(mask):
+		mask = os.umask(mask)
+		try:
+			yield
+		finally:
+			os.umask(mask)
+
+	def _serve_connection(self, connection, RestoreController):
+		_message, fds, _flags, _address = socket.recv_fds(connection, 1, 3)
+		reader, writer = ChannelReader(os.dup(connection.fileno())), ChannelWriter(os.dup(connection.fileno()))
+		try:
+			records = iter(reader)
+			request = next(records)
+			env = request.setdefault('env', dict(os.environ))
+			if self._owns_display:
+				env['DISPLAY'] = self._display  # Every run (and its shell commands) goes to own Xvfb
+			elif env.get('DISPLAY') != self._display:
+				writer.send(dict(error='Runner is bound to display {!r}, not to {!r}'.format(self._display, env.get('DISPLAY'))))
+				return
+			stdout_fd, stderr_fd = fds[:2]
+			status_fd = fds[2] if len(fds) > 2 else None
+
+			# Interrupts the run (between its steps, never inside of switching the context) if client asks for it or disconnects
+			stop_event = threading.Event()
+			def watch():
+				for record in records:
+					if record.get('stop'):
+						break
+				stop_event.set()
+			watch_thread = threading.Thread(target=watch)
+			watch_thread.daemon = True
+			watch_thread.start()
+
+			with self._with_request_context(request, stdout_fd, stderr_fd):
+				exit_code = self._run(RestoreController, dict(self._kwargs, **{k: v for k, v in request['kwargs'].items() if v is not None}, status_fd=(os.dup(status_fd) if status_fd is not None else None), stop_event=stop_event))  # Run closes its copy
+
+			writer.send(dict(exit=exit_code))
+		finally:
+			for fd in fds:
+				os.close(fd)
+			reader.close()
+			with contextlib.suppress(OSError):
+				writer.close()
+
+	@contextlib.contextmanager
+	def _with_request_context(self, request, stdout_fd, stderr_fd):
+		"""Runs with client's stdout, stderr, working directory and variables, restores own ones afterwards"""
+		cwd, environ = os.getcwd(), dict(os.environ)
+		sys.stdout.flush(); sys.stderr.flush()
+		saved_fds = os.dup(1), os.dup(2)
+		os.dup2(stdout_fd, 1)
+		os.dup2(stderr_fd, 2)
+		try:
+			os.chdir(request.get('cwd', cwd))
+			os.environ.clear()
+			os.environ.update(request.get('env', environ))
+			yield
+		finally:
+			with contextlib.suppress(OSError):
+				sys.stdout.flush()
+			with contextlib.suppress(OSError):
+				sys.stderr.flush()
+			for fd, saved_fd in zip((1, 2), saved_fds):
+				os.dup2(saved_fd, fd)
+				os.close(saved_fd)
+			os.environ.clear()
+			os.environ.update(environ)
+			os.chdir(cwd)
+
+	def _run(self, RestoreController, kwargs):
+		"""Runs a scenario, returns its exit code"""
+		logging.getLogger('controllers.restore').setLevel((logging.WARNING, logging.INFO, logging.DEBUG)[min(kwargs.get('verbose') or 0, 2)])
+		try:
+			RestoreController(**kwargs).loop()
+			return 0
+		except KeyboardInterrupt:
+			return 0
+		except SystemExit as e:
+			return e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+		except Exception:
+			with contextlib.suppress(OSError):
+				traceback.print_exc()
+			return 1
+
+
+class RunnerClient(object):
+	"""Sends a run request to the runner (starts it if needed), waits till the run is over"""
+
+	def __init__(self, path=None, display=None, spawn_timeout=10.):
+		self._path = path or get_default_socket_path(display)
+		self._spawn_timeout = spawn_timeout
+
+	def run(self, kwargs, status_fd=None, server_args=()):
+		"""Runs RestoreController(**kwargs) in the runner, returns exit code (or None if the runner is not available)"""
+		connection = self._connect() or self._spawn(server_args)
+		if connection is None:
+			return None
+
+		with contextlib.closing(connection):
+			socket.send_fds(connection, [b'\0'], [sys.stdout.fileno(), sys.stderr.fileno()] + ([status_fd] if status_fd is not None else []))
+			if status_fd is not None:
+				os.close(status_fd)  # Is owned by runner now
+			reader, writer = ChannelReader(os.dup(connection.fileno())), ChannelWriter(os.dup(connection.fileno()))
+			try:
+				writer.send(dict(kwargs=kwargs, cwd=os.getcwd(), env=dict(os.environ)))
+
+				# Asks the runner to stop on Ctrl-C (or SIGINT from GUI), but still waits for its exit code
+				def on_interrupt(signum, frame):
+					with contextlib.suppress(OSError):
+						writer.send(dict(stop=True))
+				previous_handler = signal.signal(signal.SIGINT, on_interrupt)
+				try:
+					for record in reader:
+						if 'exit' in record:
+							return record['exit']
+						if 'error' in record:
+							logging.getLogger(__name__).warning('Runner has refused the run: %s', record['error'])
+							return None
+				finally:
+					signal.signal(signal.SIGINT, previous_handler)
+				logging.getLogger(__name__).error('Runner has disconnected during the run')
+				return 1
+			finally:
+				reader.close()
+				with contextlib.suppress(OSError):
+					writer.close()
+
+	"""Helpers"""
+
+	def _connect(self):
+		connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		try:
+			connection.connect(self._path)
+		except OSError:
+			connection.close()
+			return None
+		return connection
+
+	def _spawn(self, server_args):
+		"""Starts a runner (detached from this process), returns a connection to it"""
+		command = [sys.executable, '-B', os.path.realpath(__file__), '-r', 'serve', '--socket', self._path] + [str(x) for x in server_args]
+		logging.getLogger(__name__).info('Starting runner: %s', command)
+		subprocess.Popen(
+			command,
+			start_new_session=True,  # Outlives this process and is not interrupted with it
+			stdin=subprocess.DEVNULL,
+			stdout=subprocess.DEVNULL,
+			stderr=subprocess.DEVNULL,
+		)
+		timeout = time.monotonic() + self._spawn_timeout
+		while time.monotonic() < timeout:
+			connection = self._connect()
+			if connection is not None:
+				return connection
+			time.sleep(.05)
+		logging.getLogger(__name__).warning('Runner has not started in %ss', self._spawn_timeout)
+
+
+def run_serve():
+	"""Runs the runner"""
+	import argparse
+	parser = argparse.ArgumentParser(description=__doc__)
+	parser.add_argument('--socket', help='Path of socket (default: {})'.format(get_default_socket_path()))
+	parser.add_argument('--screen-backend', help='Selects how screen shots are made')
+	parser.add_argument('--pattern-cache-size', type=int, metavar='MB', help='Limits memory for decoded image patterns (default: 256)')
+	parser.add_argument('--matching-threads', type=int, help='Limits threads matching patterns in parallel (default: number of CPUs)')
+	parser.add_argument('--with-xvfb', nargs='?', const='1280x1024x24', metavar='GEOMETRY', help='Launches own Xvfb (default geometry: 1280x1024x24) and reads screen from its memory-mapped framebuffer')
+	kwargs = vars(parser.parse_known_args()[0])  # Breaks here if something goes wrong
+	xvfb_geometry = kwargs.pop('with_xvfb')
+	path = kwargs.pop('socket') or get_default_socket_path(None if xvfb_geometry is None else 'xvfb-' + xvfb_geometry)
+	kwargs = {k: v for k, v in kwargs.items() if v is not None}
+
+	from models.devices import VirtualDisplay, Screen
+	with (VirtualDisplay(xvfb_geometry) if xvfb_geometry is not None else contextlib.nullcontext()) as display:
+		if display is not None:
+			Screen.framebuffer_path = display.framebuffer_path
+			kwargs['screen_backend'] = kwargs.get('screen_backend') or 'xvfb'
+		RunnerServer(path, owns_display=(display is not None), **kwargs).serve()
+
+
+def main():
+	import argparse
+	parser = argparse.ArgumentParser(add_help=False)
+	parser.add_argument('-r', '--run-function', default='serve', choices=[k[len('run_'):] for k in globals() if k.startswith('run_')], help='Function to run (without "run_"-prefix)')
+	parser.add_argument('-v', '--verbose', action='count', help='Raises logging level')
+	kwargs = vars(parser.parse_known_args()[0])  # Breaks here if something goes wrong
+
+	# Raises verbosity level for script (through arguments -v and -vv)
+	logging.getLogger(__name__).setLevel((logging.WARNING, logging.INFO, logging.DEBUG)[min(kwargs['verbose'] or 0, 2)])
+
+	globals()['run_' + kwargs['run_function']]()
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,212 @@
+#!/bin/sh
+# -*- coding: utf-8 -*-
+# vim: noexpandtab
+"exec" "python3" "-B" "$0" "$@"
+# (c) gehrmann
+
+
+
+__doc__ = """
+This module provides a cache for values derived from files (decoded images, thumbnails, etc.)
+
+Environment variables:
+	LOGGING_<MODULE> -- Logging level ( NOTSET | DEBUG | INFO | WARNING | ERROR | CRITICAL )
+"""
+
+import collections
+import hashlib
+import logging
+import os
+import sys
+import tempfile
+import threading
+
+if __name__ == '__main__':
+	# Sets utf-8 (instead of latin1) as default encoding for every IO
+	# import importlib; importlib.reload(sys); sys.setdefaultencoding('utf-8')
+	# Runs in application's working directory
+	os.chdir((os.path.dirname(os.path.realpath(__file__)) or '.') + '/..'); sys.path.insert(0, os.path.realpath(os.getcwd()))
+	# Working interruption by Ctrl-C
+	import signal; signal.signal(signal.SIGINT, signal.default_int_handler)
+	# Configures logging
+	logging.basicConfig(
+		level=logging.WARN, datefmt='%H:%M:%S',
+		format='%(asctime)s.%(msecs)03d %(pathname)s:%(lineno)d [%(levelname)s]  %(message)s',
+	)
+logging.getLogger(__name__).setLevel(getattr(logging, os.environ.get('LOGGING_' + __name__.replace('.', '_').upper(), 'WARNING')))
+
+
+class FileCache(object):
+	"""Thread-safe LRU-cache for values derived from files, keyed by resolved path, file's mtime and size
+
+	If a file is changed, its cached value is invalidated. If a capacity is set, least recently used values are evicted.
+	If a directory is set, values (serialized into bytes) are also kept there, so they survive restarts.
+
+	Example:
+
+		>>> cache = FileCache(capacity=1024, get_size=len)
+		>>> value = cache.get(__file__, load=lambda path: open(path).read()[:10])
+		>>> value = cache.get(__file__, load=lambda path: open(path).read()[:10])
+		>>> value = cache.get_many([__file__, __file__], load=lambda paths: ''.join(open(x).read()[:10] for x in paths))
+		>>> cache.hits, cache.misses
+		(1, 2)
+
+	"""
+
+	_directory_prune_interval = 64  # Stores to the directory between removals of outdated files
+
+	def __init__(self, capacity=None, get_size=None, directory=None, directory_capacity=None, serialize=None, deserialize=None):
+		self._capacity = capacity  # In units of get_size() (for example, bytes), None means unlimited
+		self._get_size = get_size or (lambda value: (1))
+		self._items = collections.OrderedDict()  # {(paths, key): (signature, value, size)}, the oldest first
+		self._used = 0
+		self._lock = threading.RLock()
+		self._directory = directory  # None means in memory only
+		self._directory_capacity = directory_capacity  # In bytes, None means unlimited
+		self._directory_stores = 0
+		self._serialize = serialize  # Converts value into bytes
+		self._deserialize = deserialize  # Converts bytes into value
+		self.hits = 0
+		self.misses = 0
+
+		if directory is not None:
+			os.makedirs(directory, exist_ok=True)
+			self._prune_directory()
+
+	def __len__(self):
+		return len(self._items)
+
+	def __repr__(self):
+		return '<{self.__class__.__name__} items={items} used={self._used} capacity={self._capacity} hits={self.hits} misses={self.misses}>'.format(items=len(self._items), **locals())
+
+	@property
+	def capacity(self):
+		return self._capacity
+
+	@capacity.setter
+	def capacity(self, value):
+		with self._lock:
+			self._capacity = value
+			self._evict()
+
+	def get(self, path, load, key=None):
+		"""Returns value for path (and optional extra key), calls load(path) if it is not cached or file was changed"""
+		return self._get((path, ), (lambda paths: (load(paths[0]))), key)
+
+	def get_many(self, paths, load, key=None):
+		"""Returns value derived from several paths (and optional extra key), calls load(paths) if it is not cached or some file was changed"""
+		return self._get(tuple(paths), load, key)
+
+	def clear(self):
+		with self._lock:
+			self._items.clear()
+			self._used = 0
+
+	"""Helpers"""
+
+	def _get(self, paths, load, key):
+		paths = tuple(os.path.realpath(x) for x in paths)
+		try:
+			signature = tuple((x.st_mtime_ns, x.st_size) for x in (os.stat(x) for x in paths))
+		except OSError:
+			return load(paths)  # Lets loader to raise its own exception
+
+		with self._lock:
+			item = self._items.get((paths, key), None)
+			if item is not None and item[0] == signature:
+				self._items.move_to_end((paths, key))
+				self.hits += 1
+				return item[1]
+			self.misses += 1
+
+		value = self._load_from_directory(paths, signature, key)
+		if value is None:
+			value = load(paths)
+			self._store_to_directory(paths, signature, key, value)
+
+		with self._lock:
+			self._discard((paths, key))
+			size = self._get_size(value)
+			self._items[paths, key] = (signature, value, size)
+			self._used += size
+			self._evict()
+		return value
+
+	def _get_directory_path(self, paths, signature, key):
+		"""Returns path of file in directory for value (a changed file gives another name, outdated ones are pruned later)"""
+		return os.path.join(self._directory, hashlib.sha1(repr((paths, signature, key)).encode('utf-8', 'surrogateescape')).hexdigest())
+
+	def _load_from_directory(self, paths, signature, key):
+		if self._directory is None:
+			return None
+		path = self._get_directory_path(paths, signature, key)
+		try:
+			with open(path, 'rb') as src:
+				value = self._deserialize(src.read())
+			os.utime(path)  # Marks as recently used
+			return value
+		except Exception as e:
+			if not isinstance(e, FileNotFoundError):
+				logging.getLogger(__name__).debug('Value is not loaded from "%s": %r', path, e)
+			return None
+
+	def _store_to_directory(self, paths, signature, key, value):
+		if self._directory is None:
+			return
+		path = self._get_directory_path(paths, signature, key)
+		dst = None
+		try:
+			data = self._serialize(value)
+			with tempfile.NamedTemporaryFile('wb', dir=self._directory, prefix='.', delete=False) as dst:
+				dst.write(data)
+			os.replace(dst.name, path)  # Atomically
+		except Exception as e:
+			logging.getLogger(__name__).debug('Value is not stored to "%s": %r', path, e)
+			if dst is not None and os.path.exists(dst.name):
+				os.unlink(dst.name)
+			return
+		self._directory_stores += 1
+		if self._directory_stores % self._directory_prune_interval == 0:
+			self._prune_directory()
+
+	def _prune_directory(self):
+		"""Removes least recently used files from directory till its capacity is reached"""
+		if self._directory_capacity is None:
+			return
+		try:
+			entries = sorted((x.stat().st_mtime_ns, x.stat().st_size, x.path) for x in os.scandir(self._directory) if x.is_file() and not x.name.startswith('.'))
+			used = sum(x[1] for x in entries)
+			for mtime, size, path in entries:
+				if used <= self._directory_capacity:
+					break
+				os.unlink(path)
+				used -= size
+		except OSError as e:
+			logging.getLogger(__name__).debug('Directory "%s" is not pruned: %r', self._directory, e)
+
+	def _discard(self, item_key):
+		item = self._items.pop(item_key, None)
+		if item is not None:
+			self._used -= item[2]
+
+	def _evict(self):
+		"""Removes least recently used values till capacity is reached (the most recent one is kept anyway)"""
+		while self._capacity is not None and self._used > self._capacity and len(self._items) > 1:
+			self._discard(next(iter(self._items)))
+
+
+def run_doctest():
+	import doctest
+	doctest.testmod()
+
+
+def main():
+	import argparse
+	parser = argparse.ArgumentParser(add_help=False)
+	parser.add_argument('-r', '--run-function', default='doctest', choices=[k[len('run_'):] for k in globals() if k.startswith('run_')], help='Function to run (without "run_"-prefix)')
+	kwargs = vars(parser.parse_known_args()[0])  # Breaks here if something goes wrong
+
+	globals()['run_' + kwargs['run_function']]()
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,103 @@
+#!/bin/sh
+# -*- coding: utf-8 -*-
+# vim: noexpandtab
+"exec" "python3" "-B" "$0" "$@"
+# (c) gehrmann
+
+
+
+__doc__ = """
+This module provides a framed channel between processes (for example, runner -> GUI)
+
+Every record is a JSON-object prefixed with its length (4 bytes, big-endian).
+
+Environment variables:
+	LOGGING_<MODULE> -- Logging level ( NOTSET | DEBUG | INFO | WARNING | ERROR | CRITICAL )
+"""
+
+import json
+import logging
+import os
+import struct
+import sys
+
+if __name__ == '__main__':
+	# Sets utf-8 (instead of latin1) as default encoding for every IO
+	# import importlib; importlib.reload(sys); sys.setdefaultencoding('utf-8')
+	# Runs in application's working directory
+	os.chdir((os.path.dirname(os.path.realpath(__file__)) or '.') + '/..'); sys.path.insert(0, os.path.realpath(os.getcwd()))
+	# Working interruption by Ctrl-C
+	import signal; signal.signal(signal.SIGINT, signal.default_int_handler)
+	# Configures logging
+	logging.basicConfig(
+		level=logging.WARN, datefmt='%H:%M:%S',
+		format='%(asctime)s.%(msecs)03d %(pathname)s:%(lineno)d [%(levelname)s]  %(message)s',
+	)
+logging.getLogger(__name__).setLevel(getattr(logging, os.environ.get('LOGGING_' + __name__.replace('.', '_').upper(), 'WARNING')))
+
+_header = struct.Struct('>I')
+
+
+class ChannelWriter(object):
+	"""Writes records as length-prefixed JSON-frames into a file descriptor (takes it over)
+
+	Example:
+
+		>>> src, dst = os.pipe()
+		>>> writer, reader = ChannelWriter(dst), ChannelReader(src)
+		>>> writer.send(dict(status=[[0, 2, 'completed']], env=dict(X='1')))
+		>>> writer.close()
+		>>> list(reader)
+		[{'status': [[0, 2, 'completed']], 'env': {'X': '1'}}]
+
+	"""
+
+	def __init__(self, fd):
+		self._file = os.fdopen(fd, 'wb')
+
+	def send(self, record):
+		data = json.dumps(record, separators=(',', ':')).encode('utf-8')
+		self._file.write(_header.pack(len(data)) + data)
+		self._file.flush()
+
+	def close(self):
+		self._file.close()
+
+
+class ChannelReader(object):
+	"""Reads records written by ChannelWriter from a file descriptor (takes it over), iteration stops at the end of stream"""
+
+	def __init__(self, fd):
+		self._file = os.fdopen(fd, 'rb')
+
+	def __iter__(self):
+		while True:
+			header = self._file.read(_header.size)
+			if len(header) < _header.size:
+				break
+			size, = _header.unpack(header)
+			data = self._file.read(size)
+			if len(data) < size:
+				logging.getLogger(__name__).warning('Channel is closed in the middle of a record')
+				break
+			yield json.loads(data.decode('utf-8'))
+
+	def close(self):
+		self._file.close()
+
+
+def run_doctest():
+	import doctest
+	doctest.testmod()
+
+
+def main():
+	import argparse
+	parser = argparse.ArgumentParser(add_help=False)
+	parser.add_argument('-r', '--run-function', default='doctest', choices=[k[len('run_'):] for k in globals() if k.startswith('run_')], help='Function to run (without "run_"-prefix)')
+	kwargs = vars(parser.parse_known_args()[0])  # Breaks here if something goes wrong
+
+	globals()['run_' + kwargs['run_function']]()
+
+if __name__ == '__main__':
+	main()
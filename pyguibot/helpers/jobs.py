@@ -0,0 +1,205 @@
+#!/bin/sh
+# -*- coding: utf-8 -*-
+# vim: noexpandtab
+"exec" "python3" "-B" "$0" "$@"
+# (c) gehrmann
+
+
+
+__doc__ = """
+This module provides a manager of background jobs (shell commands which are not waited for)
+
+Every job has a name (given or generated: 1, 2, ..., skipping names of tracked jobs), runs in its own process group
+and writes its stdout and stderr only into its log file (no thread or pipe is read by this process). If max_jobs is set,
+not more than max_jobs jobs run at once and a new job waits (blocked on running jobs, not longer than its timeout)
+till a running one is over (no limit by default, a job may be an application which runs till the end of a scenario).
+Finished jobs are reaped on every start, their exit codes are kept till join.
+
+Environment variables:
+	LOGGING_<MODULE> -- Logging level ( NOTSET | DEBUG | INFO | WARNING | ERROR | CRITICAL )
+"""
+
+import contextlib
+import logging
+import os
+import re
+import select
+import signal
+import subprocess
+import sys
+import time
+
+if __name__ == '__main__':
+	# Sets utf-8 (instead of latin1) as default encoding for every IO
+	# import importlib; importlib.reload(sys); sys.setdefaultencoding('utf-8')
+	# Runs in application's working directory
+	os.chdir((os.path.dirname(os.path.realpath(__file__)) or '.') + '/..'); sys.path.insert(0, os.path.realpath(os.getcwd()))
+	# Working interruption by Ctrl-C
+	signal.signal(signal.SIGINT, signal.default_int_handler)
+	# Configures logging
+	logging.basicConfig(
+		level=logging.WARN, datefmt='%H:%M:%S',
+		format='%(asctime)s.%(msecs)03d %(pathname)s:%(lineno)d [%(levelname)s]  %(message)s',
+	)
+logging.getLogger(__name__).setLevel(getattr(logging, os.environ.get('LOGGING_' + __name__.replace('.', '_').upper(), 'WARNING')))
+
+
+class JobError(Exception):
+	pass
+
+
+class Jobs(object):
+	"""Starts shell commands in background, limits how many of them run at once, joins and kills them by name
+
+	Example:
+
+		>>> import tempfile
+		>>> with tempfile.TemporaryDirectory() as path:
+		...     jobs = Jobs(path, max_jobs=2)
+		...     jobs.start('echo seeded', env=dict(os.environ), name='seed'), jobs.start('exit 3', env=dict(os.environ))
+		...     jobs.join('seed'), jobs.join('1'), open(jobs.get_log_path('seed')).read()
+		...     jobs.start('sleep 10', env=dict(os.environ)), jobs.kill('2'), jobs.join()
+		('seed', '1')
+		(0, 3, 'seeded\\n')
+		('2', -15, {})
+		>>> with tempfile.TemporaryDirectory() as path:
+		...     jobs = Jobs(path, max_jobs=2)
+		...     jobs.start('sleep 10', env=dict(os.environ), name='1'), jobs.start('sleep 10', env=dict(os.environ))
+		...     try:
+		...         jobs.start('true', env=dict(os.environ), timeout=.1)
+		...     except JobError as e:
+		...         print(e)
+		...     sorted(jobs.kill())
+		('1', '2')
+		Job "3" waits for one of 2 running jobs longer than 0.1s
+		['1', '2']
+
+	"""
+
+	_unsafe_regexp = re.compile(r'[^\w.-]')  # Characters replaced in names of log files
+
+	def __init__(self, path, max_jobs=None):
+		self._path = path  # Directory of log files
+		self._max_jobs = max_jobs  # Is not limited if None
+		self._processes = dict()  # Processes by name (running or finished, till joined)
+		self._count = 0  # Number of started jobs without names (is used for their names)
+
+	def get_log_path(self, name):
+		return os.path.join(self._path, self._unsafe_regexp.sub('_', name) + '.log')
+
+	def start(self, command, env, name=None, timeout=None):
+		"""Starts command in background (waits up to timeout if max_jobs are running), returns its name"""
+		if not name:
+			self._count += 1
+			while str(self._count) in self._processes:  # Does not replace a job named so by user
+				self._count += 1
+			name = str(self._count)
+		if self._get_running(name):
+			raise JobError('Job "{}" is still running'.format(name))
+		self._wait_for_slot(name, timeout)
+
+		if not os.path.exists(self._path):
+			os.makedirs(self._path)
+		with open(self.get_log_path(name), 'wb') as log:  # Is inherited by the job, is closed here at once
+			self._processes[name] = subprocess.Popen(
+				command,
+				shell=True,
+				stdin=subprocess.DEVNULL,
+				stdout=log,
+				stderr=subprocess.STDOUT,
+				env=env,
+				start_new_session=True,  # Is killed with its children (as a process group)
+			)
+		logging.getLogger(__name__).info('Job "%s" is started (pid %s): %s', name, self._processes[name].pid, command)
+		return name
+
+	def join(self, name=None, timeout=None):
+		"""Waits till job (or every job if name is not set) is over, returns its exit code (or {name: exit code})"""
+		if name is None:
+			deadline = None if timeout is None else time.monotonic() + timeout
+			return {x: self.join(x, timeout=(None if deadline is None else max(0., deadline - time.monotonic()))) for x in list(self._processes)}
+		process = self._get(name)
+		try:
+			exit_code = process.wait(timeout=timeout)
+		except subprocess.TimeoutExpired:
+			raise JobError('Job "{}" is still running after {}s'.format(name, timeout))
+		del self._processes[name]
+		logging.getLogger(__name__).info('Job "%s" is over with exit code %s', name, exit_code)
+		return exit_code
+
+	def kill(self, name=None, timeout=5., signum=signal.SIGTERM):
+		"""Terminates job (or every job if name is not set) with signum, kills it if it is still running after timeout, returns its exit code (or {name: exit code})"""
+		if name is None:
+			return {x: self.kill(x, timeout=timeout, signum=signum) for x in list(self._processes)}
+		process = self._get(name)
+		for signum in (signum, signal.SIGKILL):
+			try:
+				os.killpg(process.pid, signum)
+			except ProcessLookupError:
+				pass
+			try:
+				process.wait(timeout=timeout)
+				break
+			except subprocess.TimeoutExpired:
+				logging.getLogger(__name__).warning('Job "%s" is still running after %ss, is killed', name, timeout)
+		return self.join(name)
+
+	def close(self):
+		"""Stops tracking jobs, the running ones keep running (like started with "&")"""
+		for name, process in self._get_running().items():
+			logging.getLogger(__name__).info('Job "%s" (pid %s) is left running, its output is in %s', name, process.pid, self.get_log_path(name))
+		self._processes.clear()
+
+	"""Helpers"""
+
+	def _get(self, name):
+		try:
+			return self._processes[name]
+		except KeyError:
+			raise JobError('Job "{}" is not started'.format(name))
+
+	def _wait_for_slot(self, name, timeout):
+		"""Blocks till less than max_jobs jobs are running, raises JobError after timeout"""
+		deadline = None if timeout is None else time.monotonic() + timeout
+		while self._max_jobs is not None:
+			running = self._get_running()
+			if len(running) < self._max_jobs:
+				return
+			remaining = None if deadline is None else deadline - time.monotonic()
+			if remaining is not None and remaining <= 0:
+				raise JobError('Job "{}" waits for one of {} running jobs longer than {}s'.format(name, len(running), timeout))
+			logging.getLogger(__name__).debug('Job "%s" waits till one of %s running jobs is over', name, len(running))
+			fds = []
+			try:
+				for process in running.values():
+					with contextlib.suppress(ProcessLookupError):  # Is already over (is reaped on the next pass)
+						fds.append(os.pidfd_open(process.pid))
+				if len(fds) == len(running):
+					select.select(fds, [], [], remaining)  # Pidfd of a process becomes readable when it is over
+			finally:
+				for fd in fds:
+					os.close(fd)
+
+	def _get_running(self, name=None):
+		"""Returns {name: process} of running jobs (or of job name if it is running), reaps finished ones (without waiting, they can be joined later)"""
+		return {
+			k: v for k, v in self._processes.items()
+			if (name is None or k == name) and v.poll() is None
+		}
+
+
+def run_doctest():
+	import doctest
+	doctest.testmod()
+
+
+def main():
+	import argparse
+	parser = argparse.ArgumentParser(add_help=False)
+	parser.add_argument('-r', '--run-function', default='doctest', choices=[k[len('run_'):] for k in globals() if k.startswith('run_')], help='Function to run (without "run_"-prefix)')
+	kwargs = vars(parser.parse_known_args()[0])  # Breaks here if something goes wrong
+
+	globals()['run_' + kwargs['run_function']]()
+
+if __name__ == '__main__':
+	main()
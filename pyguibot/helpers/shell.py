@@ -0,0 +1,247 @@
+#!/bin/sh
+# -*- coding: utf-8 -*-
+# vim: noexpandtab
+"exec" "python3" "-B" "$0" "$@"
+# (c) gehrmann
+
+
+
+__doc__ = """
+This module provides a pool of long-lived shells, which run commands without starting a new shell every time
+
+A worker is a /bin/sh reading requests from its stdin and writing replies into its fd 3 (both are framed by lines):
+a request is "export K=v" / "unset K" lines for changed variables and "__pyguibot_run <id> <quoted command>",
+a reply is "<exit code> <id>". Every command is evaluated in a subshell (a fork of the worker, without exec),
+so it can not change worker's directory or variables, and it writes into the same stdout and stderr as the worker.
+A prefix of commands is sent to every worker once.
+
+Environment variables:
+	LOGGING_<MODULE> -- Logging level ( NOTSET | DEBUG | INFO | WARNING | ERROR | CRITICAL )
+"""
+
+import logging
+import os
+import re
+import shlex
+import signal
+import sys
+import threading
+
+if __name__ == '__main__':
+	# Sets utf-8 (instead of latin1) as default encoding for every IO
+	# import importlib; importlib.reload(sys); sys.setdefaultencoding('utf-8')
+	# Runs in application's working directory
+	os.chdir((os.path.dirname(os.path.realpath(__file__)) or '.') + '/..'); sys.path.insert(0, os.path.realpath(os.getcwd()))
+	# Working interruption by Ctrl-C
+	signal.signal(signal.SIGINT, signal.default_int_handler)
+	# Configures logging
+	logging.basicConfig(
+		level=logging.WARN, datefmt='%H:%M:%S',
+		format='%(asctime)s.%(msecs)03d %(pathname)s:%(lineno)d [%(levelname)s]  %(message)s',
+	)
+logging.getLogger(__name__).setLevel(getattr(logging, os.environ.get('LOGGING_' + __name__.replace('.', '_').upper(), 'WARNING')))
+
+
+class ShellError(Exception):
+	"""Worker has died (or can not take variables), command should be run in a new shell"""
+
+
+class _ShellWorker(object):
+	"""Long-lived /bin/sh running one command at a time"""
+
+	_script = (
+		'__pyguibot_prefix={prefix}\n'
+		'__pyguibot_run() {{ (eval "$__pyguibot_prefix$2") 3>&- </dev/null; echo "$? $1" >&3; }}\n'
+	)
+	_name_regexp = re.compile(r'[A-Za-z_][A-Za-z0-9_]*$')  # Names which can be exported by shell
+
+	def __init__(self, env, prefix=''):
+		self._env = env  # Variables of worker's shell (as they were sent)
+		self._request_id = 0
+
+		request_src, request_dst = os.pipe()
+		reply_src, reply_dst = os.pipe()
+		try:
+			self.pid = os.posix_spawn('/bin/sh', ['/bin/sh', '-s'], env, file_actions=[
+				(os.POSIX_SPAWN_DUP2, request_src, 0),
+				(os.POSIX_SPAWN_DUP2, reply_dst, 3),
+			] + [
+				(os.POSIX_SPAWN_CLOSE, x) for x in self._get_inheritable_fds() if x > 3  # Such as a --status-fd pipe, whose reader would not see EOF while shell lives
+			], setsid=True)  # Has own process group (is killed together with its commands)
+		finally:
+			os.close(request_src)
+			os.close(reply_dst)
+		self._requests = os.fdopen(request_dst, 'w')
+		self._replies = os.fdopen(reply_src, 'r')
+		self._requests.write(self._script.format(prefix=shlex.quote(prefix)))
+
+	def run(self, command, env):
+		"""Runs command with variables env, returns its exit code"""
+		lines = []
+		if env is not self._env:  # Is the same snapshot if no variable was changed since the previous command
+			for key, value in env.items():
+				if self._env.get(key) != value:
+					lines.append('export {}={}\n'.format(self._check_name(key), shlex.quote(value)))
+			for key in self._env:
+				if key not in env:
+					lines.append('unset {}\n'.format(self._check_name(key)))
+			self._env = env
+		self._request_id += 1
+		lines.append('__pyguibot_run {} {}\n'.format(self._request_id, shlex.quote(command)))
+
+		try:
+			self._requests.write(''.join(lines))
+			self._requests.flush()
+		except BrokenPipeError:
+			raise ShellError('Shell {} has died'.format(self.pid))
+		while True:
+			reply = self._replies.readline()
+			if not reply:
+				raise ShellError('Shell {} has died'.format(self.pid))
+			exit_code, request_id = reply.split()
+			if int(request_id) == self._request_id:  # Skips stale replies (if any)
+				return int(exit_code)
+
+	def close(self, kill=False):
+		"""Stops shell (at once if kill, after the current command otherwise)"""
+		if kill:
+			try:
+				os.killpg(self.pid, signal.SIGKILL)
+			except ProcessLookupError:
+				pass
+		try:
+			self._requests.close()  # Shell exits at the end of its input
+		except BrokenPipeError:
+			pass
+		self._replies.close()
+		os.waitpid(self.pid, 0)
+
+	"""Helpers"""
+
+	@staticmethod
+	def _get_inheritable_fds():
+		"""Returns open file descriptors which a spawned process would inherit (fds 3 and above)"""
+		fds = []
+		for name in os.listdir('/proc/self/fd' if os.path.isdir('/proc/self/fd') else '/dev/fd'):
+			try:
+				if int(name) > 2 and os.get_inheritable(int(name)):
+					fds.append(int(name))
+			except OSError:
+				pass  # Is closed meanwhile (or was the listed directory itself)
+		return fds
+
+	def _check_name(self, name):
+		if self._name_regexp.match(name) is None:
+			raise ShellError('Variable "{}" can not be exported by shell'.format(name))
+		return name
+
+
+class ShellPool(object):
+	"""Runs commands in up to size long-lived shells (started on demand and reused), their variables are updated with deltas only
+
+	Example:
+
+		>>> with ShellPool(prefix='set -e; ') as shells:
+		...     shells.run('test "$X" = 1', env=dict(os.environ, X='1')), shells.run('false; true', env=dict(os.environ))
+		(0, 1)
+
+	"""
+
+	def __init__(self, size=1, prefix=''):
+		self._size = size
+		self._prefix = prefix
+		self._workers = []  # Idle workers
+		self._workers_count = 0
+		self._condition = threading.Condition()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.close()
+
+	def run(self, command, env):
+		"""Runs command (with prefix) in a free shell, returns its exit code"""
+		worker = self._acquire(env)
+		try:
+			try:
+				return worker.run(command, env)
+			except ShellError as e:
+				logging.getLogger(__name__).debug('%s, is replaced', e)
+				worker.close(kill=True)
+				worker = None
+				worker = _ShellWorker(env, prefix=self._prefix)  # Replaces died worker (or worker with variables it can not take)
+				return worker.run(command, env)
+		except BaseException:
+			if worker is not None:
+				worker.close(kill=True)  # Kills interrupted command with its shell
+				worker = None
+			raise
+		finally:
+			self._release(worker)
+
+	def close(self):
+		with self._condition:
+			workers, self._workers, self._workers_count = self._workers, [], 0
+		for worker in workers:
+			worker.close()
+
+	"""Helpers"""
+
+	def _acquire(self, env):
+		with self._condition:
+			while not self._workers and self._workers_count >= self._size:
+				self._condition.wait()
+			if self._workers:
+				return self._workers.pop()
+			self._workers_count += 1
+		try:
+			return _ShellWorker(env, prefix=self._prefix)
+		except BaseException:
+			self._release(None)
+			raise
+
+	def _release(self, worker):
+		with self._condition:
+			if worker is not None:
+				self._workers.append(worker)
+			else:
+				self._workers_count -= 1
+			self._condition.notify()
+
+
+def run_benchmark():
+	"""Compares running of a short command in a pooled shell with subprocess.Popen(shell=True) (per call)"""
+	import subprocess
+	import time
+	env = dict(os.environ)
+	number = 200
+
+	with ShellPool() as shells:
+		shells.run('true', env)  # Starts the worker
+		start = time.monotonic()
+		for _ in range(number):
+			shells.run('true', env)
+		print('pooled shell: {:.2f}ms'.format((time.monotonic() - start) / number * 1e3))
+
+	start = time.monotonic()
+	for _ in range(number):
+		subprocess.Popen('true', shell=True, env=dict(env)).wait()
+	print('new shell:    {:.2f}ms'.format((time.monotonic() - start) / number * 1e3))
+
+
+def run_doctest():
+	import doctest
+	doctest.testmod()
+
+
+def main():
+	import argparse
+	parser = argparse.ArgumentParser(add_help=False)
+	parser.add_argument('-r', '--run-function', default='doctest', choices=[k[len('run_'):] for k in globals() if k.startswith('run_')], help='Function to run (without "run_"-prefix)')
+	kwargs = vars(parser.parse_known_args()[0])  # Breaks here if something goes wrong
+
+	globals()['run_' + kwargs['run_function']]()
+
+if __name__ == '__main__':
+	main()
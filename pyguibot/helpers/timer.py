@@ -16,6 +16,7 @@ Environment variables:
 import datetime
 import logging
 import os
+import subprocess
 import sys
 import time
 
@@ -64,6 +65,34 @@ class Timer(object):
 		return (self._stop_time or time.time()) - self._start_time
 
 
+def get_import_times(module):
+	"""Imports module in a fresh interpreter (python -X importtime), returns [(cumulative_us, self_us, name), ...] from the slowest one"""
+	root = os.path.realpath(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+	process = subprocess.run(
+		[sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+		cwd=root, env=dict(os.environ, PYTHONPATH=os.pathsep.join([root] + [x for x in [os.environ.get('PYTHONPATH')] if x])),
+		stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, check=True,
+	)
+	times = []
+	for line in process.stderr.splitlines():
+		if line.startswith('import time:'):
+			self_us, cumulative_us, name = line[len('import time:'):].split('|')
+			if self_us.strip().isdigit():  # Skips the header
+				times.append((int(cumulative_us), int(self_us), name.rstrip()))
+	return sorted(times, reverse=True)
+
+
+def check_import_time(module, budget, top=15):
+	"""Prints out the slowest imports of module, returns True if its cold import takes not longer than budget (in ms)"""
+	times = get_import_times(module)
+	total = next(x for x, _, name in times if name.strip() == module) / 1000.
+	print('{:>10}  {:>10}  {}'.format('cumulative', 'self', 'module'))
+	for cumulative_us, self_us, name in times[:top]:
+		print('{:>8.1f}ms  {:>8.1f}ms  {}'.format(cumulative_us / 1000., self_us / 1000., name))
+	print('Import of {} took {:.1f}ms ({} budget of {:.0f}ms)'.format(module, total, 'within' if total <= budget else 'OVER', budget))
+	return total <= budget
+
+
 def run_timer():
 	with Timer() as timer:
 		logging.getLogger(__name__).debug('abc')
@@ -206,13 +206,49 @@ class ObservableList(list, _NestedObservablesMixin):
 		# return hash(repr(self))
 
 	def __setitem__(self, index, value):
-		if (not isinstance(index, slice) and len(self) <= index) or self[index] != value:
-			previous = (self._unbind_changed({((index.start, index.stop) if isinstance(index, slice) else (index, index + 1)): [self[index]]}), )
+		if isinstance(index, slice):
+			from_index, to_index, step = index.indices(len(self))
+			if step != 1:  # Extended slice, reports the whole list
+				previous = {(0, len(self)): self[:]}
+				super(ObservableList, self).__setitem__(index, value)
+				current = {(0, len(self)): self[:]}
+				if previous != current:
+					self.changed(self, previous=(previous, ), current=(current, ))
+				return
+			to_index, value = max(from_index, to_index), list(value)
+			if self[from_index:to_index] != value:
+				previous = (self._unbind_changed({(from_index, to_index): self[from_index:to_index]}), )
+				super(ObservableList, self).__setitem__(slice(from_index, to_index), value)
+				current = (self._bind_changed({(from_index, from_index + len(value)): value}), )
+				self.changed(self, previous=previous, current=current)
+			return
+		if index < 0:
+			index += len(self)
+		if len(self) <= index or self[index] != value:
+			previous = (self._unbind_changed({(index, index + 1): [self[index]]}), )
 			super(ObservableList, self).__setitem__(index, value)
-			current = (self._bind_changed({((index.start, index.stop) if isinstance(index, slice) else (index, index + 1)): [self[index]]}), )
+			current = (self._bind_changed({(index, index + 1): [self[index]]}), )
 			self.changed(self, previous=previous, current=current)
 
 	def __delitem__(self, index):
+		if isinstance(index, slice):
+			from_index, to_index, step = index.indices(len(self))
+			if step != 1:  # Extended slice, reports the whole list
+				previous = {(0, len(self)): self[:]}
+				super(ObservableList, self).__delitem__(index)
+				current = {(0, len(self)): self[:]}
+				if previous != current:
+					self.changed(self, previous=(previous, ), current=(current, ))
+				return
+			to_index = max(from_index, to_index)
+			if from_index < to_index:
+				previous = (self._unbind_changed({(from_index, to_index): self[from_index:to_index]}), )
+				super(ObservableList, self).__delitem__(slice(from_index, to_index))
+				current = (self._bind_changed({(from_index, from_index): []}), )
+				self.changed(self, previous=previous, current=current)
+			return
+		if index < 0:
+			index += len(self)
 		previous = (self._unbind_changed({(index, index + 1): [self[index]]}), )
 		super(ObservableList, self).__delitem__(index)
 		current = (self._bind_changed({(index, index): []}), )
@@ -253,8 +289,8 @@ class ObservableList(list, _NestedObservablesMixin):
 		self.changed(self, previous=previous, current=current)
 
 	def insert(self, index, value):
+		index = max(0, index + len(self)) if index < 0 else min(index, len(self))  # Reports positions, not raw indices
 		super(ObservableList, self).insert(index, value)
-		index = min(index, len(self) - 1)
 		previous, current = (self._unbind_changed({(index, index): []}), ), (self._bind_changed({(index, index + 1): [value]}), )
 		self.changed(self, previous=previous, current=current)
 
@@ -266,6 +302,8 @@ class ObservableList(list, _NestedObservablesMixin):
 	def pop(self, index=None):
 		if index is None:
 			index = len(self) - 1
+		elif index < 0:
+			index += len(self)
 		value = super(ObservableList, self).pop(index)
 		previous, current = (self._unbind_changed({(index, index + 1): [value]}), ), (self._bind_changed({(index, index): []}), )
 		self.changed(self, previous=previous, current=current)
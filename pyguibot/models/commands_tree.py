@@ -0,0 +1,314 @@
+#!/bin/sh
+# -*- coding: utf-8 -*-
+# vim: noexpandtab
+"exec" "python3" "-B" "$0" "$@"
+# (c) gehrmann
+
+
+
+__doc__ = """
+This module provides a Qt item model of scenario lines for the commands tree
+
+Rows are lines of a scenario, their text and icons are rendered on first request (so only for visible rows)
+and kept till the line is changed. Updates of lines are applied as inserted, removed and changed rows
+instead of a reset, so that the view keeps its selection and scroll position.
+
+Environment variables:
+	LOGGING_<MODULE> -- Logging level ( NOTSET | DEBUG | INFO | WARNING | ERROR | CRITICAL )
+"""
+
+import logging
+import os
+import sys
+
+if __name__ == '__main__':
+	# Sets utf-8 (instead of latin1) as default encoding for every IO
+	# import importlib; importlib.reload(sys); sys.setdefaultencoding('utf-8')
+	# Runs in application's working directory
+	os.chdir((os.path.dirname(os.path.realpath(__file__)) or '.') + '/..'); sys.path.insert(0, os.path.realpath(os.getcwd()))
+	# Working interruption by Ctrl-C
+	import signal; signal.signal(signal.SIGINT, signal.default_int_handler)
+	# Configures logging
+	logging.basicConfig(
+		level=logging.WARN, datefmt='%H:%M:%S',
+		format='%(asctime)s.%(msecs)03d %(pathname)s:%(lineno)d [%(levelname)s]  %(message)s',
+	)
+logging.getLogger(__name__).setLevel(getattr(logging, os.environ.get('LOGGING_' + __name__.replace('.', '_').upper(), 'WARNING')))
+
+from PyQt import QtCore, QtGui
+
+
+class CommandsTreeModel(QtCore.QAbstractItemModel):
+	"""Flat (one level) item model of scenario lines
+
+	Every row is rendered by render(line, event, patterns_paths) on first request, it returns dict(
+		text={column: str}, icons={column: QIcon}, foreground={column: color},
+	), line numbers, tool-tips and colors of statuses are added by the model itself.
+	"""
+
+	dropped = QtCore.pyqtSignal(int, int, int)  # (from_index, to_index, count), to_index is a row (before moving) to insert dragged rows before
+	_mime_type = 'application/x-pyguibot-rows'
+	_render_capacity = 1024  # Rendered rows to keep (rendered pixmaps can be big)
+
+	def __init__(self, render, columns, state_colors, status_texts, parent=None):
+		super(CommandsTreeModel, self).__init__(parent)
+		self._render = render
+		self._columns = columns
+		self._state_colors = state_colors  # {code: color or None}
+		self._status_texts = status_texts  # {code: text of the first column}
+		self._lines = []
+		self._events = []
+		self._patterns = []
+		self._variables = []  # Names of variables used by every row
+		self._variables_rows = None  # Index {name: [row, ...]}, is built again on request after rows are inserted or removed
+		self._statuses = []  # Status code for every row
+		self._rendered = []  # Rendered dict (or None) for every row
+		self._rendered_count = 0
+
+	"""Data"""
+
+	def load(self, lines, program):
+		"""Updates rows with lines and their compiled program, only changed rows are reported to views"""
+		lines, events, patterns, variables = list(lines), list(program), list(program.patterns), list(program.variables)
+
+		if not self._lines:
+			self.beginResetModel()
+			self._lines, self._events, self._patterns, self._variables = lines, events, patterns, variables
+			self._variables_rows = None
+			self._statuses = [None] * len(lines)
+			self._rendered, self._rendered_count = [None] * len(lines), 0
+			self.endResetModel()
+			return
+
+		# Skips equal head and tail, replaces the rest
+		count = min(len(self._lines), len(lines))
+		head = 0
+		while head < count and self._lines[head] == lines[head] and self._patterns[head] == patterns[head]:
+			head += 1
+		tail = 0
+		while tail < count - head and self._lines[-1 - tail] == lines[-1 - tail] and self._patterns[-1 - tail] == patterns[-1 - tail]:
+			tail += 1
+		if head + tail < len(self._lines) or head + tail < len(lines):
+			to_index = len(lines) - tail
+			self._replace(head, len(self._lines) - tail, lines[head:to_index], events[head:to_index], patterns[head:to_index], variables[head:to_index])
+
+	def replace(self, from_index, to_index, lines, program):
+		"""Replaces rows [from_index, to_index) with lines and their compiled program"""
+		self._replace(from_index, to_index, list(lines), list(program), list(program.patterns), list(program.variables))
+
+	def _replace(self, from_index, to_index, lines, events, patterns, variables):
+		"""Replaces rows [from_index, to_index) with lines, emits changed rows and then inserted (or removed) ones"""
+		common = min(to_index - from_index, len(lines))
+
+		# Changes rows in place
+		if common:
+			self._set_rows(from_index, from_index + common, lines[:common], events[:common], patterns[:common], variables[:common])
+			self.dataChanged.emit(self.index(from_index, 0), self.index(from_index + common - 1, self._columns - 1))
+
+		# Inserts superfluous lines
+		if len(lines) > common:
+			index = from_index + common
+			self.beginInsertRows(QtCore.QModelIndex(), index, from_index + len(lines) - 1)
+			self._lines[index:index] = lines[common:]
+			self._events[index:index] = events[common:]
+			self._patterns[index:index] = patterns[common:]
+			self._variables[index:index] = variables[common:]
+			self._variables_rows = None
+			self._statuses[index:index] = [None] * (len(lines) - common)
+			self._rendered[index:index] = [None] * (len(lines) - common)
+			self.endInsertRows()
+
+		# Removes superfluous rows
+		elif to_index - from_index > common:
+			index = from_index + common
+			self.beginRemoveRows(QtCore.QModelIndex(), index, to_index - 1)
+			self._rendered_count -= sum(1 for x in self._rendered[index:to_index] if x is not None)
+			for values in (self._lines, self._events, self._patterns, self._variables, self._statuses, self._rendered):
+				del values[index:to_index]
+			self._variables_rows = None
+			self.endRemoveRows()
+
+	def refresh(self, variables=None):
+		"""Renders rows using some of variables (or every row) again on next request"""
+		if variables is None:
+			if self._lines:
+				self._rendered, self._rendered_count = [None] * len(self._lines), 0
+				self.dataChanged.emit(self.index(0, 0), self.index(len(self._lines) - 1, self._columns - 1))
+			return
+
+		rows = sorted(set(row for name in variables for row in self._get_variables_rows().get(name, ())))
+		for row in rows:
+			if self._rendered[row] is not None:
+				self._rendered[row] = None
+				self._rendered_count -= 1
+
+		# Emits ranges of adjacent rows
+		from_index = None
+		for index, row in enumerate(rows):
+			if from_index is None:
+				from_index = row
+			if index + 1 == len(rows) or rows[index + 1] != row + 1:
+				self.dataChanged.emit(self.index(from_index, 0), self.index(row, self._columns - 1))
+				from_index = None
+
+	def set_status(self, row, code):
+		"""Sets status code of row, returns its index (invalid if there is no such row)"""
+		if not 0 <= row < len(self._lines):
+			return QtCore.QModelIndex()
+		if self._statuses[row] != code:
+			self._statuses[row] = code
+			self.dataChanged.emit(self.index(row, 0), self.index(row, self._columns - 1))
+		return self.index(row, 0)
+
+	def reset_statuses(self):
+		if any(x is not None for x in self._statuses):
+			self._statuses = [None] * len(self._lines)
+			self.dataChanged.emit(self.index(0, 0), self.index(len(self._lines) - 1, self._columns - 1))
+
+	def get_line(self, row):
+		return self._lines[row]
+
+	def get_event(self, row):
+		return self._events[row]
+
+	def is_comment(self, row):
+		return 'comments' in self._events[row]
+
+	"""Qt's model interface"""
+
+	def index(self, row, column, parent=QtCore.QModelIndex()):
+		if parent.isValid() or not (0 <= row < len(self._lines) and 0 <= column < self._columns):
+			return QtCore.QModelIndex()
+		return self.createIndex(row, column)
+
+	def parent(self, index=None):
+		if index is None:  # QObject.parent()
+			return super(CommandsTreeModel, self).parent()
+		return QtCore.QModelIndex()
+
+	def rowCount(self, parent=QtCore.QModelIndex()):
+		return 0 if parent.isValid() else len(self._lines)
+
+	def columnCount(self, parent=QtCore.QModelIndex()):
+		return self._columns
+
+	def headerData(self, section, orientation, role=QtCore.Qt.DisplayRole):
+		if orientation == QtCore.Qt.Horizontal and role == QtCore.Qt.DisplayRole:
+			return str(section)
+		return None
+
+	def flags(self, index):
+		if not index.isValid():
+			return QtCore.Qt.ItemIsDropEnabled  # Allows dropping only between rows
+		return QtCore.Qt.ItemIsEnabled | QtCore.Qt.ItemIsSelectable | QtCore.Qt.ItemIsDragEnabled
+
+	def data(self, index, role=QtCore.Qt.DisplayRole):
+		if not index.isValid():
+			return None
+		row, column = index.row(), index.column()
+
+		if role in (QtCore.Qt.ToolTipRole, QtCore.Qt.StatusTipRole):
+			return '#{}  {}'.format(row + 1, self._lines[row].rstrip(os.linesep))
+
+		rendered = self._get_rendered(row)
+		is_comment = self.is_comment(row)
+		code = self._statuses[row] or 'ready'
+
+		if role == QtCore.Qt.DisplayRole:
+			if column == 0:
+				return '{}. {}'.format(row + 1, rendered['text'].get(0, '')) if is_comment else self._status_texts.get(code, '')
+			return rendered['text'].get(column, '')
+		elif role == QtCore.Qt.DecorationRole:
+			return rendered['icons'].get(column, None)
+		elif role == QtCore.Qt.ForegroundRole:
+			if not is_comment and column == 1:
+				return QtGui.QBrush(QtGui.QColor(self._state_colors[code] or '#999'))
+			color = rendered['foreground'].get(column, None)
+			return QtGui.QBrush(QtGui.QColor(color)) if color is not None else None
+		elif role == QtCore.Qt.BackgroundRole:
+			if not is_comment and column in (2, 3) and self._state_colors[code] is not None:
+				return QtGui.QBrush(QtGui.QColor(self._state_colors[code]))
+		return None
+
+	def supportedDropActions(self):
+		return QtCore.Qt.MoveAction
+
+	def mimeTypes(self):
+		return [self._mime_type]
+
+	def mimeData(self, indexes):
+		rows = sorted(set(x.row() for x in indexes))
+		data = QtCore.QMimeData()
+		data.setData(self._mime_type, '{},{}'.format(rows[0], len(rows)).encode() if rows else b'')
+		return data
+
+	def dropMimeData(self, data, action, row, column, parent):
+		"""Reports dragged rows with "dropped"-signal, returns False, because rows are moved by the controller (in a scenario)"""
+		if action == QtCore.Qt.MoveAction and data.hasFormat(self._mime_type) and bytes(data.data(self._mime_type)):
+			from_index, count = [int(x) for x in bytes(data.data(self._mime_type)).decode().split(',')]
+			to_index = row if row >= 0 else (parent.row() if parent.isValid() else len(self._lines))
+			self.dropped.emit(from_index, to_index, count)
+		return False
+
+	"""Helpers"""
+
+	def _set_rows(self, from_index, to_index, lines, events, patterns, variables):
+		self._lines[from_index:to_index] = lines
+		self._events[from_index:to_index] = events
+		self._patterns[from_index:to_index] = patterns
+		if self._variables_rows is not None and self._variables[from_index:to_index] != variables:
+			self._variables_rows = None
+		self._variables[from_index:to_index] = variables
+		self._rendered_count -= sum(1 for x in self._rendered[from_index:to_index] if x is not None)
+		self._rendered[from_index:to_index] = [None] * (to_index - from_index)
+
+	def _get_variables_rows(self):
+		if self._variables_rows is None:
+			self._variables_rows = variables_rows = dict()
+			for row, names in enumerate(self._variables):
+				for name in names:
+					variables_rows.setdefault(name, []).append(row)
+		return self._variables_rows
+
+	def _get_rendered(self, row):
+		rendered = self._rendered[row]
+		if rendered is None:
+			# Forgets all rendered rows if too many (visible ones are rendered again on request)
+			if self._rendered_count >= self._render_capacity:
+				self._rendered, self._rendered_count = [None] * len(self._lines), 0
+			rendered = self._render(self._lines[row], self._events[row], self._patterns[row])
+			for key in ('text', 'icons', 'foreground'):
+				rendered.setdefault(key, dict())
+			self._rendered[row] = rendered
+			self._rendered_count += 1
+		return rendered
+
+
+def run_commands_tree():
+	"""Only for developing purposes: shows a view of many rows"""
+	from PyQt import QtWidgets
+	from models.program import Program
+	app = QtWidgets.QApplication(sys.argv)
+	lines = [('# Comment {}\n' if x % 10 == 0 else "{{'type': 'keyboard_type', 'value': 'Line {}'}}\n").format(x) for x in range(100000)]
+	program = Program([(dict(comments=x.rstrip()) if x.startswith('#') else dict(eval(x), level=0)) for x in lines])
+	model = CommandsTreeModel(
+		render=lambda line, event, patterns_paths: (dict(text={0: event.get('comments', ''), 2: event.get('type', ''), 3: event.get('value', '')})),
+		columns=5, state_colors=dict(ready=None), status_texts=dict(),
+	)
+	model.load(lines, program)
+	view = QtWidgets.QTreeView()
+	view.setModel(model)
+	view.show()
+	app.exec_()
+
+
+def main():
+	import argparse
+	parser = argparse.ArgumentParser(add_help=False)
+	parser.add_argument('-r', '--run-function', default='commands_tree', choices=[k[len('run_'):] for k in globals() if k.startswith('run_')], help='Function to run (without "run_"-prefix)')
+	kwargs = vars(parser.parse_known_args()[0])  # Breaks here if something goes wrong
+
+	globals()['run_' + kwargs['run_function']]()
+
+if __name__ == '__main__':
+	main()
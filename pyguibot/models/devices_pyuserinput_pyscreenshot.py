@@ -4,11 +4,17 @@
 "exec" "python3" "-B" "$0" "$@"
 # (c) gehrmann
 
+import ctypes
+import ctypes.util
 import logging
 import math
+import mmap
 import os
+import shutil
+import struct
 import subprocess
 import sys
+import tempfile
 import time
 
 # import pyautogui.screenshotUtil
@@ -48,6 +54,10 @@ __doc__ = """"""
 
 
 class Screen(object):
+	backend = os.environ.get('PYGUIBOT_SCREEN_BACKEND', 'scrot')  # Can be [ 'scrot' | 'xshm' | 'xvfb' ]
+	backends = ('scrot', 'xshm', 'xvfb')
+	framebuffer_path = os.environ.get('PYGUIBOT_XVFB_FRAMEBUFFER', None)  # XWD-file of Xvfb (for backend "xvfb")
+
 	@classmethod
 	def make_screenshot(cls, path):
 		"""Makes screenshot, returns PIL-image"""
@@ -98,11 +108,446 @@ class Screen(object):
 			finally:
 				os.unlink(dst.name)
 
+	@classmethod
+	def get_screenshot_array(cls, region=None):
+		"""Makes screenshot of the whole screen (or of region (x, y, width, height)), returns BGR numpy-array
+
+		Attention! In-process backends ("xshm", "xvfb") return the same buffer on every call with the same size,
+		copy it if it should survive the next screenshot.
+		"""
+		import numpy
+		if cls.backend == 'xshm':
+			return _XShmGrabber._get_instance().grab(region)
+		elif cls.backend == 'xvfb':
+			return _XvfbFramebuffer._get_instance(cls.framebuffer_path).grab(region)
+		elif cls.backend == 'scrot':
+			array = numpy.array(cls.get_screenshot().convert('RGB'))[..., ::-1]  # Reverts color order: RGB -> BGR
+			if region is not None:
+				x, y, width, height = region
+				array = array[y:y + height, x:x + width]
+			return numpy.ascontiguousarray(array)
+		raise Exception('Unknown screen backend "{}", can be one of: {}'.format(cls.backend, ', '.join(cls.backends)))
+
+	@classmethod
+	def get_screenshot_view(cls, region=None):
+		"""Returns read-only BGRA numpy-view of live screen pixels (only for backend "xvfb"), no copying"""
+		if cls.backend != 'xvfb':
+			raise Exception('Live view is supported only by screen backend "xvfb", not by "{}"'.format(cls.backend))
+		return _XvfbFramebuffer._get_instance(cls.framebuffer_path).view(region)
+
+	@classmethod
+	def get_screenshot_sample(cls, step=4, region=None):
+		"""Returns a cheap downscaled copy of the screen (every step-th pixel of every step-th row), suitable for fast comparisons"""
+		if cls.backend == 'xshm':
+			view = _XShmGrabber._get_instance().grab_bgra(region)
+		elif cls.backend == 'xvfb':
+			view = _XvfbFramebuffer._get_instance(cls.framebuffer_path).view(region)
+		else:
+			view = cls.get_screenshot_array(region)
+		return view[::step, ::step, :3].copy()
+
+	@classmethod
+	def wait_until_stable(cls, timeout, frames=3, interval=.03, step=4, tolerance=0, minimum=0.):
+		"""Waits till frames consecutive samples of the screen are equal (or till timeout), returns elapsed time
+
+		Sampling starts after minimum seconds (an application may not react to the previous input at once).
+		Up to tolerance differing sampled pixels are ignored (blinking cursor, etc.).
+		For slow backend "scrot" or frames=0 just sleeps for timeout.
+		"""
+		import numpy
+		if cls.backend == 'scrot' or not frames:
+			time.sleep(timeout)
+			return timeout
+		time_start = time.monotonic()
+		time.sleep(min(minimum, timeout))
+		previous, stable_frames = cls.get_screenshot_sample(step), 1
+		while stable_frames < frames:
+			elapsed = time.monotonic() - time_start
+			if elapsed >= timeout:
+				logging.getLogger(__name__).debug('Screen is not stable after %.3fs', elapsed)
+				return elapsed
+			time.sleep(min(interval, timeout - elapsed))
+			sample = cls.get_screenshot_sample(step)
+			stable_frames = (stable_frames + 1) if numpy.count_nonzero((sample != previous).any(axis=2)) <= tolerance else 1
+			previous = sample
+		elapsed = time.monotonic() - time_start
+		logging.getLogger(__name__).debug('Screen is stable after %.3fs', elapsed)
+		return elapsed
+
 	# def _print_backends():
 	#     """Prints out availables backends"""
 	#     print pyscreenshot.backends()
 
 
+class _XImage(ctypes.Structure):
+	"""Leading part of Xlib's XImage (enough to read a pixel buffer)"""
+	_fields_ = [
+		('width', ctypes.c_int),
+		('height', ctypes.c_int),
+		('xoffset', ctypes.c_int),
+		('format', ctypes.c_int),
+		('data', ctypes.c_void_p),
+		('byte_order', ctypes.c_int),
+		('bitmap_unit', ctypes.c_int),
+		('bitmap_bit_order', ctypes.c_int),
+		('bitmap_pad', ctypes.c_int),
+		('depth', ctypes.c_int),
+		('bytes_per_line', ctypes.c_int),
+		('bits_per_pixel', ctypes.c_int),
+		('red_mask', ctypes.c_ulong),
+		('green_mask', ctypes.c_ulong),
+		('blue_mask', ctypes.c_ulong),
+	]
+
+
+class _XErrorEvent(ctypes.Structure):
+	_fields_ = [
+		('type', ctypes.c_int),
+		('display', ctypes.c_void_p),
+		('resourceid', ctypes.c_ulong),
+		('serial', ctypes.c_ulong),
+		('error_code', ctypes.c_ubyte),
+		('request_code', ctypes.c_ubyte),
+		('minor_code', ctypes.c_ubyte),
+	]
+
+
+@ctypes.CFUNCTYPE(ctypes.c_int, ctypes.c_void_p, ctypes.POINTER(_XErrorEvent))
+def _on_x_error(display, event):
+	"""Collects codes of X errors (Xlib's default handler exits the process)"""
+	_XShmGrabber._errors.append(event.contents.error_code)
+	return 0
+
+
+class _XShmSegmentInfo(ctypes.Structure):
+	_fields_ = [
+		('shmseg', ctypes.c_ulong),
+		('shmid', ctypes.c_int),
+		('shmaddr', ctypes.c_void_p),
+		('readOnly', ctypes.c_int),
+	]
+
+
+class _XWindowAttributes(ctypes.Structure):
+	_fields_ = [
+		('x', ctypes.c_int),
+		('y', ctypes.c_int),
+		('width', ctypes.c_int),
+		('height', ctypes.c_int),
+		('border_width', ctypes.c_int),
+		('depth', ctypes.c_int),
+		('visual', ctypes.c_void_p),
+		('root', ctypes.c_ulong),
+		('class', ctypes.c_int),
+		('bit_gravity', ctypes.c_int),
+		('win_gravity', ctypes.c_int),
+		('backing_store', ctypes.c_int),
+		('backing_planes', ctypes.c_ulong),
+		('backing_pixel', ctypes.c_ulong),
+		('save_under', ctypes.c_int),
+		('colormap', ctypes.c_ulong),
+		('map_installed', ctypes.c_int),
+		('map_state', ctypes.c_int),
+		('all_event_masks', ctypes.c_long),
+		('your_event_mask', ctypes.c_long),
+		('do_not_propagate_mask', ctypes.c_long),
+		('override_redirect', ctypes.c_int),
+		('screen', ctypes.c_void_p),
+	]
+
+
+def _load_library(name, functions):
+	"""Loads shared library, declares signatures of functions as {name: (restype, argtypes)}, returns library"""
+	path = ctypes.util.find_library(name)
+	if path is None:
+		raise ImportError('Library "{}" is not found'.format(name))
+	library = ctypes.CDLL(path, use_errno=True)
+	for function_name, (restype, argtypes) in functions.items():
+		function = getattr(library, function_name)
+		function.restype, function.argtypes = restype, argtypes
+	return library
+
+
+class _XShmGrabber(object):
+	"""Grabs X root window (or its region) through MIT-SHM straight into re-used numpy-buffers"""
+
+	_ZPixmap = 2
+	_AllPlanes = ctypes.c_ulong(-1).value
+	_IPC_PRIVATE, _IPC_CREAT, _IPC_RMID = 0, 0o1000, 0
+	_errors = []  # Codes of errors reported by X server since the last check
+
+	@classmethod
+	def _get_instance(cls, _state=dict(instance=None)):
+		if _state['instance'] is None:
+			_state['instance'] = cls()
+		return _state['instance']
+
+	def __init__(self, display_name=None):
+		self._xlib = xlib = _load_library('X11', dict(
+			XOpenDisplay=(ctypes.c_void_p, [ctypes.c_char_p]),
+			XCloseDisplay=(ctypes.c_int, [ctypes.c_void_p]),
+			XDefaultRootWindow=(ctypes.c_ulong, [ctypes.c_void_p]),
+			XGetWindowAttributes=(ctypes.c_int, [ctypes.c_void_p, ctypes.c_ulong, ctypes.POINTER(_XWindowAttributes)]),
+			XDestroyImage=(ctypes.c_int, [ctypes.POINTER(_XImage)]),
+			XSync=(ctypes.c_int, [ctypes.c_void_p, ctypes.c_int]),
+			XSetErrorHandler=(ctypes.c_void_p, [ctypes.c_void_p]),
+		))
+		self._xext = _load_library('Xext', dict(
+			XShmQueryExtension=(ctypes.c_int, [ctypes.c_void_p]),
+			XShmCreateImage=(ctypes.POINTER(_XImage), [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int, ctypes.c_void_p, ctypes.POINTER(_XShmSegmentInfo), ctypes.c_uint, ctypes.c_uint]),
+			XShmAttach=(ctypes.c_int, [ctypes.c_void_p, ctypes.POINTER(_XShmSegmentInfo)]),
+			XShmDetach=(ctypes.c_int, [ctypes.c_void_p, ctypes.POINTER(_XShmSegmentInfo)]),
+			XShmGetImage=(ctypes.c_int, [ctypes.c_void_p, ctypes.c_ulong, ctypes.POINTER(_XImage), ctypes.c_int, ctypes.c_int, ctypes.c_ulong]),
+		))
+		self._libc = _load_library('c', dict(
+			shmget=(ctypes.c_int, [ctypes.c_int, ctypes.c_size_t, ctypes.c_int]),
+			shmat=(ctypes.c_void_p, [ctypes.c_int, ctypes.c_void_p, ctypes.c_int]),
+			shmdt=(ctypes.c_int, [ctypes.c_void_p]),
+			shmctl=(ctypes.c_int, [ctypes.c_int, ctypes.c_int, ctypes.c_void_p]),
+		))
+
+		xlib.XSetErrorHandler(ctypes.cast(_on_x_error, ctypes.c_void_p))  # Is process-wide, an X error raises an exception here instead of exiting
+		self._display = display = xlib.XOpenDisplay(display_name.encode() if display_name else None)
+		if not display:
+			raise Exception('Can not open display "{}"'.format(display_name or os.environ.get('DISPLAY', '')))
+		if not self._xext.XShmQueryExtension(display):
+			raise Exception('X server does not support MIT-SHM extension')
+		self._root = xlib.XDefaultRootWindow(display)
+		self._attributes = _XWindowAttributes()
+		self._update_attributes()
+		if self._attributes.depth not in (24, 32):
+			raise Exception('Only depths 24 and 32 are supported, not {}'.format(self._attributes.depth))
+
+		self._segments = dict()  # {(width, height): (image, segment_info, bgra_view, bgr_buffer)}
+		self._get_segment(1, 1)  # Checks pixel format of the visual at once
+
+	def close(self):
+		"""Releases shared memory segments and closes display"""
+		for image, segment_info, _, _ in self._segments.values():
+			self._xext.XShmDetach(self._display, ctypes.byref(segment_info))
+			self._xlib.XDestroyImage(image)
+			self._libc.shmdt(segment_info.shmaddr)
+		self._segments.clear()
+		self._xlib.XCloseDisplay(self._display)
+
+	@property
+	def size(self):
+		"""Returns (width, height) of the root window"""
+		return self._attributes.width, self._attributes.height
+
+	def grab_bgra(self, region=None):
+		"""Grabs screen (or region (x, y, width, height)), returns a BGRA-view into shared memory (re-used by next grab)"""
+		return self._grab(region)[2]
+
+	def grab(self, region=None):
+		"""Grabs screen (or region (x, y, width, height)), returns a BGR-array (re-used by next grab of the same size)"""
+		import numpy
+		image, segment_info, bgra_view, bgr_buffer = self._grab(region)
+		numpy.copyto(bgr_buffer, bgra_view[..., :3])
+		return bgr_buffer
+
+	"""Helpers"""
+
+	def _grab(self, region):
+		if region is None:
+			self._update_attributes()  # Follows changes of the screen size (xrandr)
+		for attempt in range(2):
+			x, y, width, height = self._clamp(region)
+			segment = image, segment_info, bgra_view, bgr_buffer = self._get_segment(width, height)
+			del self._errors[:]
+			if self._xext.XShmGetImage(self._display, self._root, image, x, y, self._AllPlanes) and not self._errors:
+				return segment
+			if attempt == 0:
+				self._update_attributes()  # The screen is probably resized (xrandr), region is clamped again
+		raise Exception('XShmGetImage failed for region {} (X error codes: {})'.format((x, y, width, height), self._errors))
+
+	def _update_attributes(self):
+		del self._errors[:]
+		if not self._xlib.XGetWindowAttributes(self._display, self._root, ctypes.byref(self._attributes)) or self._errors:
+			raise Exception('XGetWindowAttributes failed (X error codes: {})'.format(self._errors))
+
+	def _clamp(self, region):
+		"""Returns region (or the whole screen) clamped to the screen, like slicing of the other backends' arrays"""
+		screen_width, screen_height = self.size
+		if region is None:
+			return 0, 0, screen_width, screen_height
+		x, y, width, height = region
+		x0, y0 = min(max(0, x), screen_width), min(max(0, y), screen_height)
+		x1, y1 = min(max(x0, x + width), screen_width), min(max(y0, y + height), screen_height)
+		if x1 == x0 or y1 == y0:
+			raise ValueError('Region {} is outside of the screen {}'.format(region, (screen_width, screen_height)))
+		return x0, y0, x1 - x0, y1 - y0
+
+	def _get_segment(self, width, height):
+		"""Returns cached (or creates new) shared memory segment for an image of given size"""
+		import numpy
+		if (width, height) not in self._segments:
+			xlib, xext, libc = self._xlib, self._xext, self._libc
+			attributes = self._attributes
+
+			segment_info = _XShmSegmentInfo()
+			image = xext.XShmCreateImage(self._display, attributes.visual, attributes.depth, self._ZPixmap, None, ctypes.byref(segment_info), width, height)
+			if not image:
+				raise Exception('XShmCreateImage failed')
+			masks = image.contents.red_mask, image.contents.green_mask, image.contents.blue_mask
+			if image.contents.bits_per_pixel != 32 or masks != (0xff0000, 0xff00, 0xff):
+				xlib.XDestroyImage(image)
+				raise Exception('Only 32 bits per pixel (BGRA) are supported, not {} bits with masks {}'.format(image.contents.bits_per_pixel, [hex(x) for x in masks]))
+
+			size = image.contents.bytes_per_line * image.contents.height
+			segment_info.shmid = libc.shmget(self._IPC_PRIVATE, size, self._IPC_CREAT | 0o600)
+			if segment_info.shmid < 0:
+				xlib.XDestroyImage(image)
+				raise OSError(ctypes.get_errno(), 'shmget failed')
+			segment_info.shmaddr = image.contents.data = libc.shmat(segment_info.shmid, None, 0)
+			segment_info.readOnly = False
+			try:
+				del self._errors[:]
+				if not xext.XShmAttach(self._display, ctypes.byref(segment_info)):
+					raise Exception('XShmAttach failed')
+				xlib.XSync(self._display, False)
+				if self._errors:
+					raise Exception('XShmAttach failed (X error codes: {})'.format(self._errors))
+			finally:
+				libc.shmctl(segment_info.shmid, self._IPC_RMID, None)  # Segment will be removed after the last detach
+
+			buffer = (ctypes.c_uint8 * size).from_address(segment_info.shmaddr)
+			bgra_view = numpy.frombuffer(buffer, dtype=numpy.uint8).reshape(height, image.contents.bytes_per_line // 4, 4)[:, :width]
+			bgr_buffer = numpy.empty((height, width, 3), dtype=numpy.uint8)
+			self._segments[width, height] = (image, segment_info, bgra_view, bgr_buffer)
+		return self._segments[width, height]
+
+
+class _XvfbFramebuffer(object):
+	"""Maps framebuffer of Xvfb (an XWD-file, see "Xvfb -fbdir") once and exposes screen pixels as numpy-views"""
+
+	_header_fields = (
+		'header_size', 'file_version', 'pixmap_format', 'pixmap_depth', 'pixmap_width', 'pixmap_height', 'xoffset',
+		'byte_order', 'bitmap_unit', 'bitmap_bit_order', 'bitmap_pad', 'bits_per_pixel', 'bytes_per_line', 'visual_class',
+		'red_mask', 'green_mask', 'blue_mask', 'bits_per_rgb', 'colormap_entries', 'ncolors',
+		'window_width', 'window_height', 'window_x', 'window_y', 'window_bdrwidth',
+	)
+	_xwd_file_version = 7
+	_xwd_color_size = 12  # sizeof(XWDColor)
+
+	@classmethod
+	def _get_instance(cls, path, _state=dict()):
+		if path is None:
+			raise Exception('Path to framebuffer of Xvfb is not set (use $PYGUIBOT_XVFB_FRAMEBUFFER or launch own Xvfb)')
+		if path not in _state:
+			_state[path] = cls(path)
+		return _state[path]
+
+	def __init__(self, path):
+		import numpy
+		with open(path, 'rb') as src:
+			self._mmap = mmap.mmap(src.fileno(), 0, access=mmap.ACCESS_READ)  # Mapping stays valid after file is closed
+
+		self.header = header = next((
+			x for x in (dict(zip(self._header_fields, struct.unpack_from(byte_order + '25I', self._mmap))) for byte_order in '><')
+			if x['file_version'] == self._xwd_file_version
+		), None)
+		if header is None:
+			raise Exception('File "{}" is not an XWD-file'.format(path))
+		if header['bits_per_pixel'] != 32:
+			raise Exception('Only 32 bits per pixel are supported, not {} (launch Xvfb with "-screen 0 <width>x<height>x24")'.format(header['bits_per_pixel']))
+
+		width, height, bytes_per_line = header['pixmap_width'], header['pixmap_height'], header['bytes_per_line']
+		offset = header['header_size'] + header['ncolors'] * self._xwd_color_size
+		pixels = numpy.frombuffer(self._mmap, dtype=numpy.uint8, count=bytes_per_line * height, offset=offset).reshape(height, bytes_per_line // 4, 4)[:, :width]
+		self._bgra_view = pixels if header['byte_order'] == 0 else pixels[..., ::-1]  # LSBFirst: B, G, R, X; MSBFirst: X, R, G, B
+		self._bgr_buffers = dict()  # {(width, height): bgr_buffer}
+
+	@property
+	def size(self):
+		"""Returns (width, height) of the screen"""
+		return self.header['pixmap_width'], self.header['pixmap_height']
+
+	def view(self, region=None):
+		"""Returns read-only BGRA-view of live pixels of the screen (or of region (x, y, width, height))"""
+		x, y, width, height = region if region is not None else ((0, 0) + self.size)
+		return self._bgra_view[y:y + height, x:x + width]
+
+	def grab(self, region=None):
+		"""Copies current pixels of the screen (or of region (x, y, width, height)), returns a BGR-array (re-used by next grab of the same size)"""
+		import numpy
+		view = self.view(region)
+		bgr_buffer = self._bgr_buffers.get(view.shape[:2])
+		if bgr_buffer is None:
+			bgr_buffer = self._bgr_buffers[view.shape[:2]] = numpy.empty(view.shape[:2] + (3, ), dtype=numpy.uint8)
+		numpy.copyto(bgr_buffer, view[..., :3])
+		return bgr_buffer
+
+
+class VirtualDisplay(object):
+	"""Launches own Xvfb with a memory-mapped framebuffer, owns it till stop
+
+	Example:
+
+		>>> with VirtualDisplay('1280x1024x24') as display:
+		... 	Screen.backend, Screen.framebuffer_path = 'xvfb', display.framebuffer_path
+
+	"""
+
+	def __init__(self, geometry='1280x1024x24'):
+		self._geometry = geometry
+		self._process = None
+		self._directory = None
+		self._previous_display = None
+		self.display = None
+		self.framebuffer_path = None
+
+	def __enter__(self):
+		self.start()
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.stop()
+
+	def start(self):
+		"""Launches Xvfb, waits till it is ready, sets $DISPLAY for the current process (and its children)"""
+		self._directory = tempfile.mkdtemp(prefix='pyguibot-xvfb-')
+		read_fd, write_fd = os.pipe()
+		try:
+			self._process = subprocess.Popen(
+				['Xvfb', '-displayfd', str(write_fd), '-screen', '0', self._geometry, '-fbdir', self._directory, '-nolisten', 'tcp'],
+				pass_fds=(write_fd, ),
+				stdout=open(os.devnull, 'w'),
+				stderr=open(os.devnull, 'w'),
+				start_new_session=True,  # Does not receive Ctrl-C of the terminal
+			)
+			os.close(write_fd)
+			with os.fdopen(read_fd) as src:
+				display_number = src.readline().strip()  # Is written by Xvfb when it is ready to accept connections
+		except Exception:
+			self.stop()
+			raise
+		if not display_number:
+			self.stop()
+			raise Exception('Xvfb was not started (geometry "{}")'.format(self._geometry))
+
+		self.display = ':' + display_number
+		self.framebuffer_path = os.path.join(self._directory, 'Xvfb_screen0')
+		self._previous_display, os.environ['DISPLAY'] = os.environ.get('DISPLAY', None), self.display
+		logging.getLogger(__name__).info('Xvfb is running on display %s', self.display)
+
+	def stop(self):
+		"""Terminates Xvfb, restores $DISPLAY"""
+		if self._process is not None:
+			self._process.terminate()
+			self._process.wait()
+			self._process = None
+		if self.display is not None:
+			if self._previous_display is None:
+				os.environ.pop('DISPLAY', None)
+			else:
+				os.environ['DISPLAY'] = self._previous_display
+			self.display = None
+		if self._directory is not None:
+			shutil.rmtree(self._directory, ignore_errors=True)
+			self._directory = None
+
+
 class Keyboard(pykeyboard.PyKeyboard):
 	""""""
 
@@ -212,6 +657,21 @@ def run_slide_mouse():
 		time.sleep(1)
 
 
+def run_screen_backends():
+	"""Grabs screen with every backend, prints out timings and differences (can be run under Xvfb)"""
+	import numpy
+	arrays = dict()
+	for backend in [x for x in Screen.backends if x != 'xvfb' or Screen.framebuffer_path is not None]:
+		Screen.backend = backend
+		Screen.get_screenshot_array()  # Warms up
+		time_start = time.time()
+		for _ in range(10):
+			arrays[backend] = Screen.get_screenshot_array().copy()
+		print('{backend}: {:.1f}ms per screenshot, shape {}'.format((time.time() - time_start) * 100, arrays[backend].shape, **locals()))
+	if len(set(x.shape for x in arrays.values())) == 1:
+		print('Max difference:', max(int(numpy.abs(x.astype(int) - y.astype(int)).max()) for x in arrays.values() for y in arrays.values()))
+
+
 def main():
 	import argparse
 	parser = argparse.ArgumentParser()
@@ -0,0 +1,288 @@
+#!/bin/sh
+# -*- coding: utf-8 -*-
+# vim: noexpandtab
+"exec" "python3" "-B" "$0" "$@"
+# (c) gehrmann
+
+
+
+__doc__ = """
+This module provides journaled persistence of scenarios
+
+Lines of a scenario are kept in memory (one document per path and process). Changes of lines are appended
+to a journal of the scenario (in ~/.cache/pyguibot/journals, named by a hash of scenario's real path, so nothing
+is written next to the scenario) as JSON-records [from_index, to_index, [line, ...]], so a change costs I/O
+of its size only. Other processes read only records they have not seen yet.
+
+The journal is compacted into the scenario in background (written into a temporary file and renamed),
+when it is idle for a while or too big, and at exit. Its first record {"base": signature} refers to
+the scenario it is based on, so if the scenario is changed by somebody else, the outdated journal is ignored.
+Till then the scenario file itself has old contents (only readers using Document see the changes).
+
+Environment variables:
+	LOGGING_<MODULE> -- Logging level ( NOTSET | DEBUG | INFO | WARNING | ERROR | CRITICAL )
+"""
+
+import atexit
+import contextlib
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import sys
+import tempfile
+import threading
+
+if __name__ == '__main__':
+	# Sets utf-8 (instead of latin1) as default encoding for every IO
+	# import importlib; importlib.reload(sys); sys.setdefaultencoding('utf-8')
+	# Runs in application's working directory
+	os.chdir((os.path.dirname(os.path.realpath(__file__)) or '.') + '/..'); sys.path.insert(0, os.path.realpath(os.getcwd()))
+	# Working interruption by Ctrl-C
+	import signal; signal.signal(signal.SIGINT, signal.default_int_handler)
+	# Configures logging
+	logging.basicConfig(
+		level=logging.WARN, datefmt='%H:%M:%S',
+		format='%(asctime)s.%(msecs)03d %(pathname)s:%(lineno)d [%(levelname)s]  %(message)s',
+	)
+logging.getLogger(__name__).setLevel(getattr(logging, os.environ.get('LOGGING_' + __name__.replace('.', '_').upper(), 'WARNING')))
+
+
+class Document(object):
+	"""Lines of a scenario file, changes are appended to a journal and compacted into the file in background
+
+	Example:
+
+		>>> directory = tempfile.mkdtemp()
+		>>> path = os.path.join(directory, 'test.pyguibot')
+		>>> document = Document.get(path)
+		>>> version = document.save(['a\\n', 'b\\n'])
+		>>> document.read(since=version)  # Nothing is copied
+		(1, None)
+		>>> version = document.write([(1, 1, ['c\\n']), (0, 1, [])], version=version, lines=['c\\n', 'b\\n'])
+		>>> document.read()[1], open(path).read(), len(open(Document.get_journal_path(path)).readlines())
+		(['c\\n', 'b\\n'], 'a\\nb\\n', 3)
+		>>> document.compact()
+		>>> open(path).read(), os.path.getsize(Document.get_journal_path(path))
+		('c\\nb\\n', 0)
+
+	Changes of an ObservableList (even with negative indices) are replayed from journal by other processes:
+
+		>>> from models.abstract import ObservableList
+		>>> version, lines = document.read()
+		>>> lines, changes = ObservableList(lines), []
+		>>> lines.changed.bind(lambda model=None, previous=(None, ), current=(None, ): (changes.append(list(previous[0])[0] + tuple(current[0].values()))))
+		>>> lines.pop(-1), lines.insert(-1, 'd\\n')
+		('b\\n', None)
+		>>> version = document.write(changes, version=version, lines=lines)
+		>>> Document(path).read()[1], lines
+		(['d\\n', 'c\\n'], ['d\\n', 'c\\n'])
+
+	"""
+
+	_journal_directory = os.path.join(os.path.expanduser('~'), '.cache', 'pyguibot', 'journals')  # Is written only by this user
+	_documents = dict()  # {path: document}, process-wide
+	_documents_lock = threading.Lock()
+	compaction_delay = 1.  # Compacts journal if there were no changes for so many seconds
+	compaction_size = 2**20  # Compacts journal at once if it is bigger (in bytes)
+
+	def __init__(self, path):
+		self._path = path
+		self._journal_path = self.get_journal_path(path)
+		self._lock = threading.RLock()
+		self._lines = []
+		self._version = 0  # Is incremented on every change of lines (own or read from journal)
+		self._signature = None  # Signature of the scenario file lines are based on (None if not read yet or not exists)
+		self._journal_offset = 0  # Bytes of journal already applied to lines
+		self._journal_is_valid = True  # False if journal is based on another scenario file
+		self._timer = None
+
+	@classmethod
+	def get(cls, path):
+		"""Returns the document of path (creates it on first call)"""
+		path = os.path.realpath(path)
+		with cls._documents_lock:
+			if path not in cls._documents:
+				if not cls._documents:
+					atexit.register(cls.compact_all)
+				cls._documents[path] = cls(path)
+			return cls._documents[path]
+
+	@classmethod
+	def get_journal_path(cls, path):
+		return os.path.join(cls._journal_directory, hashlib.sha1(os.path.realpath(path).encode('utf-8', 'surrogateescape')).hexdigest() + '.journal')
+
+	@classmethod
+	def compact_all(cls):
+		"""Compacts journals of every document (is called at exit)"""
+		with cls._documents_lock:
+			documents = list(cls._documents.values())
+		for document in documents:
+			document.compact()
+
+	def read(self, since=None):
+		"""Returns (version, lines), reads only changes since the previous call, lines are None (not copied) if version is still since"""
+		with self._lock:
+			self._sync()
+			return self._version, (list(self._lines) if self._version != since else None)
+
+	def write(self, changes, version, lines):
+		"""Appends changes [(from_index, to_index, lines), ...] made to lines of version, so that lines are the result
+
+		If the document was changed since that version (for example, by another process), lines replace it as a whole.
+		Returns the new version (of lines).
+		"""
+		with self._lock:
+			self._sync()
+			if self._signature is None:  # Scenario file does not exist yet
+				return self.save(lines)
+
+		with self._lock, self._with_journal_lock() as journal:
+			self._sync()
+			if version != self._version:
+				logging.getLogger(__name__).warning('Scenario "%s" was changed meanwhile, replacing it', self._path)
+				changes = [(0, len(self._lines), list(lines))]
+
+			records = [json.dumps([from_index, to_index, list(values)]) + '\n' for from_index, to_index, values in changes]
+			if journal.seek(0, os.SEEK_END) == 0 or not self._journal_is_valid:
+				# Starts a new journal (based on current scenario file)
+				journal.truncate(0)
+				self._journal_offset, self._journal_is_valid = 0, True
+				records.insert(0, json.dumps(dict(base=self._signature)) + '\n')
+			data = ''.join(records).encode('utf-8', 'surrogateescape')
+			os.write(journal.fileno(), data)  # Appends at once
+			self._journal_offset += len(data)
+
+			for from_index, to_index, values in changes:
+				self._lines[from_index:to_index] = values
+			self._version += 1
+
+			self._schedule_compaction(at_once=self._journal_offset >= self.compaction_size)
+			return self._version
+
+	def save(self, lines):
+		"""Replaces scenario file with lines (atomically), forgets journal, returns the new version"""
+		with self._lock, self._with_journal_lock(create=False) as journal:
+			self._store(lines)
+			if journal is not None:
+				journal.truncate(0)
+			self._lines, self._journal_offset, self._journal_is_valid = list(lines), 0, True
+			self._version += 1
+			return self._version
+
+	def compact(self):
+		"""Writes journaled changes into scenario file"""
+		with self._lock:
+			if self._timer is not None:
+				self._timer.cancel()
+				self._timer = None
+			with self._with_journal_lock(create=False) as journal:
+				self._sync()
+				if journal is None or journal.seek(0, os.SEEK_END) == 0:
+					return
+				if self._journal_is_valid and self._signature is not None:
+					self._store(self._lines)
+				journal.truncate(0)
+				self._journal_offset, self._journal_is_valid = 0, True
+				logging.getLogger(__name__).debug('Journal of "%s" is compacted', self._path)
+
+	"""Helpers"""
+
+	@contextlib.contextmanager
+	def _with_journal_lock(self, create=True):
+		"""Opens journal and locks it against other processes (yields None if it does not exist and should not be created)"""
+		if not create and not os.path.exists(self._journal_path):
+			yield None
+			return
+		os.makedirs(self._journal_directory, mode=0o700, exist_ok=True)
+		with open(self._journal_path, 'a+b') as journal:
+			fcntl.flock(journal, fcntl.LOCK_EX)
+			try:
+				yield journal
+			finally:
+				fcntl.flock(journal, fcntl.LOCK_UN)
+
+	def _get_signature(self):
+		try:
+			stat = os.stat(self._path)
+		except OSError:
+			return None
+		return [stat.st_ino, stat.st_mtime_ns, stat.st_size]
+
+	def _sync(self):
+		"""Reads scenario file if it was changed, applies records of journal which were not applied yet"""
+		signature = self._get_signature()
+		if signature != self._signature or signature is None:
+			# Reads the whole scenario again
+			lines = []
+			if signature is not None:
+				with open(self._path) as src:
+					lines = src.readlines()
+			if lines != self._lines:
+				self._lines = lines
+				self._version += 1
+			self._signature, self._journal_offset, self._journal_is_valid = signature, 0, True
+
+		# Applies new complete records
+		try:
+			with open(self._journal_path, 'rb') as src:
+				if src.seek(0, os.SEEK_END) < self._journal_offset:  # Was compacted by another process and then scenario was restored
+					self._journal_offset, self._journal_is_valid = 0, True
+				src.seek(self._journal_offset)
+				data = src.read()
+		except FileNotFoundError:
+			return
+		for record in data.split(b'\n')[:-1]:  # The last one is incomplete (or empty)
+			self._journal_offset += len(record) + 1
+			if not self._journal_is_valid:
+				continue
+			record = json.loads(record.decode('utf-8', 'surrogateescape'))
+			if isinstance(record, dict):
+				if record.get('base') != self._signature:
+					logging.getLogger(__name__).warning('Journal "%s" is outdated, ignoring it', self._journal_path)
+					self._journal_is_valid = False
+			else:
+				from_index, to_index, values = record
+				self._lines[from_index:to_index] = values
+				self._version += 1
+
+	def _store(self, lines):
+		"""Writes lines into a temporary file and renames it to scenario file"""
+		directory, filename = os.path.split(self._path)
+		dst = None
+		try:
+			with tempfile.NamedTemporaryFile('w', dir=directory, prefix='.' + filename + '.', delete=False) as dst:
+				print(''.join(lines), end='', file=dst)
+			if os.path.exists(self._path):
+				os.chmod(dst.name, os.stat(self._path).st_mode & 0o7777)
+			os.replace(dst.name, self._path)
+		except BaseException:
+			if dst is not None and os.path.exists(dst.name):
+				os.unlink(dst.name)
+			raise
+		self._signature = self._get_signature()
+
+	def _schedule_compaction(self, at_once=False):
+		if self._timer is not None:
+			self._timer.cancel()
+		self._timer = timer = threading.Timer(0. if at_once else self.compaction_delay, self.compact)
+		timer.daemon = True
+		timer.start()
+
+
+def run_doctest():
+	import doctest
+	doctest.testmod()
+
+
+def main():
+	import argparse
+	parser = argparse.ArgumentParser(add_help=False)
+	parser.add_argument('-r', '--run-function', default='doctest', choices=[k[len('run_'):] for k in globals() if k.startswith('run_')], help='Function to run (without "run_"-prefix)')
+	kwargs = vars(parser.parse_known_args()[0])  # Breaks here if something goes wrong
+
+	globals()['run_' + kwargs['run_function']]()
+
+if __name__ == '__main__':
+	main()
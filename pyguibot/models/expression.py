@@ -0,0 +1,289 @@
+#!/bin/sh
+# -*- coding: utf-8 -*-
+# vim: noexpandtab
+"exec" "python3" "-B" "$0" "$@"
+# (c) gehrmann
+
+
+
+__doc__ = """
+This module provides a small safe engine for expressions of "equation" and "condition" steps
+
+An expression (like "{X} + 1 > 5 and {Y} == 'done'") is parsed once into a tree of closures,
+which is cached by its text and evaluated against a store of variables (os.environ or any mapping)
+without substituting values into the text and parsing it again.
+
+Values of variables are converted from strings into numbers (or booleans) when read, so "{X} + 1" works
+with X="1" as it did when the value was substituted into the text. Variables inside of string literals
+(like "'{Y}' == 'done'") are substituted as texts, the same way. Supported are arithmetic, comparison,
+boolean and bitwise operators, "a if c else b" and a few functions (abs, min, max, round, floor, ceil,
+sqrt, exp, log, where, ...). Other expressions (for example, array-style ones) are left to numexpr.
+
+Environment variables:
+	LOGGING_<MODULE> -- Logging level ( NOTSET | DEBUG | INFO | WARNING | ERROR | CRITICAL )
+"""
+
+import ast
+import functools
+import logging
+import math
+import operator
+import os
+import re
+import sys
+
+if __name__ == '__main__':
+	# Sets utf-8 (instead of latin1) as default encoding for every IO
+	# import importlib; importlib.reload(sys); sys.setdefaultencoding('utf-8')
+	# Runs in application's working directory
+	os.chdir((os.path.dirname(os.path.realpath(__file__)) or '.') + '/..'); sys.path.insert(0, os.path.realpath(os.getcwd()))
+	# Working interruption by Ctrl-C
+	import signal; signal.signal(signal.SIGINT, signal.default_int_handler)
+	# Configures logging
+	logging.basicConfig(
+		level=logging.WARN, datefmt='%H:%M:%S',
+		format='%(asctime)s.%(msecs)03d %(pathname)s:%(lineno)d [%(levelname)s]  %(message)s',
+	)
+logging.getLogger(__name__).setLevel(getattr(logging, os.environ.get('LOGGING_' + __name__.replace('.', '_').upper(), 'WARNING')))
+
+from models.template import Template
+
+
+class ExpressionError(ValueError):
+	"""Expression is not supported by the engine (or is not valid)"""
+
+
+def _where(condition, x, y):
+	return x if condition else y
+
+
+def _invert(x):
+	return (not x) if isinstance(x, bool) else ~x  # Is logical "not" for booleans (like in numexpr)
+
+
+class _Texts(object):
+	"""Mapping-like view of variables as texts (for templates in string literals)"""
+
+	def __init__(self, get):
+		self._get = get
+
+	def get(self, name, default=None):
+		return self._get(name, as_text=True)
+
+
+class Expression(object):
+	"""Expression compiled into closures, evaluated against a mapping of variables
+
+	Example:
+
+		>>> Expression.compile('{X} + 1').evaluate(dict(X='1'))
+		2
+		>>> Expression.compile('{env[X]} / 4 >= .5 and not {Y}').evaluate(dict(X='2', Y='False'))
+		True
+		>>> Expression.compile("{X} or 0").evaluate(dict(), default=None)
+		0
+		>>> Expression.compile("where({N} % 2 == 0, 'even', 'odd')").evaluate(dict(N='7'))
+		'odd'
+		>>> Expression.compile("'{Y}' == 'done' and '{{Y}}' != '{Y}'").evaluate(dict(Y='done'))
+		True
+		>>> sorted(Expression.compile('max({A}, {B}) ** 2').names)
+		['A', 'B']
+		>>> Expression.compile('{X} + 1') is Expression.compile('{X} + 1')
+		True
+		>>> Expression.compile('__import__("os")')  # doctest: +IGNORE_EXCEPTION_DETAIL
+		Traceback (most recent call last):
+		...
+		ExpressionError: Function "__import__" is not supported
+
+	"""
+
+	_variable_regexp = re.compile(r'\{(?:env\[)?(\w+)\]?\}')  # {X} or {env[X]}, the same as in Program
+	_token_regexp = re.compile(  # String literals (kept as they are) or variables outside of them
+		r'(?P<string>[rRbBuUfF]{0,2}(?:' + '|'.join(
+			(quote + r'(?:[^\\]|\\.)*?' + quote) if len(quote) == 3 else (quote + r'(?:[^\\\n' + quote + r']|\\.)*' + quote)
+			for quote in ("'''", '"""', "'", '"')
+		) + r'))|' + _variable_regexp.pattern
+	)
+	_variable_prefix = '_variable_'
+	_missing = object()
+
+	_binary_operators = {
+		ast.Add: operator.add,
+		ast.Sub: operator.sub,
+		ast.Mult: operator.mul,
+		ast.Div: operator.truediv,
+		ast.FloorDiv: operator.floordiv,
+		ast.Mod: operator.mod,
+		ast.Pow: operator.pow,
+		ast.BitAnd: operator.and_,
+		ast.BitOr: operator.or_,
+		ast.BitXor: operator.xor,
+		ast.LShift: operator.lshift,
+		ast.RShift: operator.rshift,
+	}
+	_unary_operators = {
+		ast.UAdd: operator.pos,
+		ast.USub: operator.neg,
+		ast.Not: operator.not_,
+		ast.Invert: _invert,
+	}
+	_comparison_operators = {
+		ast.Eq: operator.eq,
+		ast.NotEq: operator.ne,
+		ast.Lt: operator.lt,
+		ast.LtE: operator.le,
+		ast.Gt: operator.gt,
+		ast.GtE: operator.ge,
+		ast.In: lambda x, y: (x in y),
+		ast.NotIn: lambda x, y: (x not in y),
+	}
+	_functions = dict(
+		abs=abs, min=min, max=max, round=round, int=int, float=float, str=str, bool=bool, len=len,
+		floor=math.floor, ceil=math.ceil, sqrt=math.sqrt, exp=math.exp, log=math.log, log10=math.log10,
+		sin=math.sin, cos=math.cos, tan=math.tan, arcsin=math.asin, arccos=math.acos, arctan=math.atan, arctan2=math.atan2,
+		where=_where,
+	)
+
+	def __init__(self, text):
+		self.text = text
+		try:
+			tree = ast.parse(self._token_regexp.sub(lambda x: (x.group('string') or (self._variable_prefix + x.group(2))), text).strip(), mode='eval')
+		except SyntaxError as e:
+			raise ExpressionError('Expression "{}" is not valid: {}'.format(text, e.msg))
+		self.names = frozenset()
+		self._evaluate = self._compile(tree.body)
+
+	@classmethod
+	@functools.lru_cache(maxsize=1024)
+	def compile(cls, text):
+		"""Returns compiled expression of text (cached), raises ExpressionError if it is not supported"""
+		return cls(text)
+
+	def evaluate(self, variables, default=_missing):
+		"""Returns value of expression, every {X} is read from variables (default is used if X is not there, KeyError is raised if not given)"""
+		def get(name, as_text=False):
+			value = variables.get(name, default)
+			if value is self._missing:
+				raise KeyError(name)
+			return self._convert(value) if isinstance(value, str) and not as_text else value
+		return self._evaluate(get)
+
+	"""Helpers"""
+
+	@staticmethod
+	@functools.lru_cache(maxsize=4096)
+	def _convert(value):
+		"""Converts string value of a variable like it was a literal in the expression (number, boolean), keeps other strings"""
+		try:
+			return int(value)
+		except ValueError:
+			pass
+		try:
+			return float(value)
+		except ValueError:
+			pass
+		return {'True': True, 'False': False, 'None': None}.get(value.strip(), value)
+
+	def _compile(self, node):
+		"""Returns closure of node, it takes a function returning values of variables"""
+		if isinstance(node, ast.Constant):
+			value = node.value
+			if isinstance(value, bytes) and (b'{' in value or b'}' in value):
+				raise ExpressionError('Expression "{}" is not supported: variables in bytes'.format(self.text))
+			if isinstance(value, str) and ('{' in value or '}' in value):
+				template = Template.compile(value)  # Is rendered like it was substituted into the text
+				self.names |= template.names
+				return lambda get: (template.render(_Texts(get)))
+			return lambda get: (value)
+
+		elif isinstance(node, ast.Name):
+			if not node.id.startswith(self._variable_prefix):
+				raise ExpressionError('Name "{}" is not supported, use {{{}}} for variables'.format(node.id, node.id))
+			name = node.id[len(self._variable_prefix):]
+			self.names |= {name}
+			return lambda get: (get(name))
+
+		elif isinstance(node, ast.BinOp) and type(node.op) in self._binary_operators:
+			function, left, right = self._binary_operators[type(node.op)], self._compile(node.left), self._compile(node.right)
+			return lambda get: (function(left(get), right(get)))
+
+		elif isinstance(node, ast.UnaryOp) and type(node.op) in self._unary_operators:
+			function, operand = self._unary_operators[type(node.op)], self._compile(node.operand)
+			return lambda get: (function(operand(get)))
+
+		elif isinstance(node, ast.BoolOp):
+			operands = [self._compile(x) for x in node.values]
+			if isinstance(node.op, ast.And):
+				def evaluate(get):
+					for operand in operands:
+						value = operand(get)
+						if not value:
+							return value
+					return value
+			else:
+				def evaluate(get):
+					for operand in operands:
+						value = operand(get)
+						if value:
+							return value
+					return value
+			return evaluate
+
+		elif isinstance(node, ast.Compare) and all(type(x) in self._comparison_operators for x in node.ops):
+			left = self._compile(node.left)
+			comparisons = [(self._comparison_operators[type(x)], self._compile(y)) for x, y in zip(node.ops, node.comparators)]
+			def evaluate(get):
+				value = left(get)
+				for function, operand in comparisons:
+					other = operand(get)
+					if not function(value, other):
+						return False
+					value = other
+				return True
+			return evaluate
+
+		elif isinstance(node, ast.IfExp):
+			condition, body, orelse = self._compile(node.test), self._compile(node.body), self._compile(node.orelse)
+			return lambda get: (body(get) if condition(get) else orelse(get))
+
+		elif isinstance(node, ast.Call):
+			name = getattr(node.func, 'id', None)
+			if name not in self._functions or node.keywords:
+				raise ExpressionError('Function "{}" is not supported'.format(name if name is not None else ast.dump(node.func)))
+			function, arguments = self._functions[name], [self._compile(x) for x in node.args]
+			return lambda get: (function(*[x(get) for x in arguments]))
+
+		raise ExpressionError('Expression "{}" is not supported: {}'.format(self.text, type(node).__name__))
+
+
+def run_benchmark():
+	"""Compares evaluation of a compiled expression with substitution and numexpr.evaluate() (per call)"""
+	import timeit
+	variables = dict(os.environ, X='41')
+	text = '{X} + 1 > 5 and {X} % 2 == 1'
+	number = 10000
+	expression = Expression.compile(text)
+	print('compiled: {:.2f}us'.format(timeit.timeit(lambda: expression.evaluate(variables), number=number) / number * 1e6))
+	try:
+		import numexpr
+	except ImportError:
+		return
+	numexpr_text = '({env[X]} + 1 > 5) & ({env[X]} % 2 == 1)'  # The same, but with numexpr's "&"
+	print('numexpr:  {:.2f}us'.format(timeit.timeit(lambda: numexpr.evaluate(numexpr_text.format(env=variables)), number=number // 10) / (number // 10) * 1e6))
+
+
+def run_doctest():
+	import doctest
+	doctest.testmod()
+
+
+def main():
+	import argparse
+	parser = argparse.ArgumentParser(add_help=False)
+	parser.add_argument('-r', '--run-function', default='doctest', choices=[k[len('run_'):] for k in globals() if k.startswith('run_')], help='Function to run (without "run_"-prefix)')
+	kwargs = vars(parser.parse_known_args()[0])  # Breaks here if something goes wrong
+
+	globals()['run_' + kwargs['run_function']]()
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,176 @@
+#!/bin/sh
+# -*- coding: utf-8 -*-
+# vim: noexpandtab
+"exec" "python3" "-B" "$0" "$@"
+# (c) gehrmann
+
+
+
+__doc__ = """
+This module provides template matching of image patterns on screen shots
+
+Exhaustive matching runs cv2.matchTemplate over the whole screen shot at full resolution.
+Pyramid matching searches a downscaled screen shot with a downscaled pattern first
+and refines only the best candidates at full resolution.
+Changed regions allow to re-match only those parts of a screen shot which differ from the previous one.
+
+Environment variables:
+	LOGGING_<MODULE> -- Logging level ( NOTSET | DEBUG | INFO | WARNING | ERROR | CRITICAL )
+"""
+
+import logging
+import numpy
+import os
+import sys
+
+if __name__ == '__main__':
+	# Sets utf-8 (instead of latin1) as default encoding for every IO
+	# import importlib; importlib.reload(sys); sys.setdefaultencoding('utf-8')
+	# Runs in application's working directory
+	os.chdir((os.path.dirname(os.path.realpath(__file__)) or '.') + '/..'); sys.path.insert(0, os.path.realpath(os.getcwd()))
+	# Working interruption by Ctrl-C
+	import signal; signal.signal(signal.SIGINT, signal.default_int_handler)
+	# Configures logging
+	logging.basicConfig(
+		level=logging.WARN, datefmt='%H:%M:%S',
+		format='%(asctime)s.%(msecs)03d %(pathname)s:%(lineno)d [%(levelname)s]  %(message)s',
+	)
+logging.getLogger(__name__).setLevel(getattr(logging, os.environ.get('LOGGING_' + __name__.replace('.', '_').upper(), 'WARNING')))
+
+try:
+	import cv2
+except ImportError:
+	print('', file=sys.stderr)
+	print('', file=sys.stderr)
+	print('  Library is not found. Try to install it using:', file=sys.stderr)
+	print('    # pip install opencv-python', file=sys.stderr)
+	print('', file=sys.stderr)
+	print('', file=sys.stderr)
+	raise
+
+# Methods where the best match has the maximal correlation (only they can be refined from candidates)
+_maximizing_methods = ('TM_CCOEFF', 'TM_CCOEFF_NORMED', 'TM_CCORR', 'TM_CCORR_NORMED')
+
+
+def build_pyramid(image, levels, min_size=1):
+	"""Returns [image, image/2, image/4, ...] with up to levels downscaled images, stops before a side gets smaller than min_size"""
+	pyramid = [image]
+	while len(pyramid) <= levels and min(pyramid[-1].shape[:2]) // 2 >= min_size:
+		pyramid.append(cv2.resize(pyramid[-1], None, fx=.5, fy=.5, interpolation=cv2.INTER_AREA))
+	return pyramid
+
+
+def match_exhaustive(screenshot, pattern, method):
+	"""Matches pattern over the whole screen shot, returns dict(method, min_correlation, max_correlation, min_location, max_location)"""
+	return dict([['method', method]] + list(zip(
+		('min_correlation', 'max_correlation', 'min_location', 'max_location'),
+		cv2.minMaxLoc(cv2.matchTemplate(screenshot, pattern, getattr(cv2, method))),  # ~0.7s for each call of "cv2.matchTemplate" on a full screen
+	)))
+
+
+def match_pyramid(screenshot_pyramid, pattern_pyramid, method, candidates_count=5):
+	"""Matches coarse-to-fine, returns the same dict as match_exhaustive()
+
+	Searches on the coarsest level available for both pyramids, then refines the best candidates_count windows at full resolution.
+	Falls back to exhaustive matching if no downscaled level is available or the method can not be refined.
+	"""
+	level = min(len(screenshot_pyramid), len(pattern_pyramid)) - 1
+	screenshot, pattern = screenshot_pyramid[0], pattern_pyramid[0]
+	if level <= 0 or method not in _maximizing_methods:
+		return match_exhaustive(screenshot, pattern, method)
+
+	# Looks for candidates on a downscaled screen shot
+	coarse_pattern = pattern_pyramid[level]
+	result = cv2.matchTemplate(screenshot_pyramid[level], coarse_pattern, getattr(cv2, method))
+	height, width = coarse_pattern.shape[:2]
+	floor = float(result.min())
+	candidates = []
+	for _ in range(candidates_count):
+		_, max_correlation, _, (x, y) = cv2.minMaxLoc(result)
+		if candidates and max_correlation <= floor:
+			break
+		candidates.append((x, y))
+		# Suppresses neighbours of the found candidate
+		result[max(0, y - height // 2):y + height // 2 + 1, max(0, x - width // 2):x + width // 2 + 1] = floor
+
+	# Refines candidates at full resolution
+	scale = 2 ** level
+	margin = 2 * scale  # Covers rounding of downscaled sizes
+	height, width = pattern.shape[:2]
+	best = None
+	for x, y in candidates:
+		x0, y0 = max(0, x * scale - margin), max(0, y * scale - margin)
+		x1, y1 = min(screenshot.shape[1] - width, x * scale + margin), min(screenshot.shape[0] - height, y * scale + margin)
+		if x1 < x0 or y1 < y0:
+			continue
+		correlation = match_exhaustive(screenshot[y0:y1 + height, x0:x1 + width], pattern, method)
+		correlation['min_location'] = (correlation['min_location'][0] + x0, correlation['min_location'][1] + y0)
+		correlation['max_location'] = (correlation['max_location'][0] + x0, correlation['max_location'][1] + y0)
+		if best is None or correlation['max_correlation'] > best['max_correlation']:
+			best = correlation
+	return best if best is not None else match_exhaustive(screenshot, pattern, method)
+
+
+def get_changed_regions(previous, current, margin=(0, 0), tile_size=16):
+	"""Compares two frames tile by tile, returns [(x, y, width, height), ...] covering changed tiles (empty if frames are equal)
+
+	Every region is expanded by margin (width, height), so that a pattern of size (margin + 1) overlapping a change fits into it.
+	Nearby changed tiles are merged into one region.
+	"""
+	height, width = current.shape[:2]
+	if previous is None or previous.shape != current.shape:
+		return [(0, 0, width, height)]
+
+	# Marks changed tiles
+	changed = previous != current
+	if changed.ndim == 3:
+		changed = changed.any(axis=2)
+	rows, columns = -(-height // tile_size), -(-width // tile_size)
+	padded = numpy.zeros((rows * tile_size, columns * tile_size), dtype=bool)
+	padded[:height, :width] = changed
+	tiles = padded.reshape(rows, tile_size, columns, tile_size).any(axis=(1, 3)).astype(numpy.uint8)
+	if not tiles.any():
+		return []
+
+	# Expands changed tiles by margin and merges overlapping ones into regions
+	margin_columns, margin_rows = [-(-x // tile_size) for x in margin]
+	tiles = cv2.dilate(tiles, numpy.ones((2 * margin_rows + 1, 2 * margin_columns + 1), dtype=numpy.uint8))
+	_count, _labels, stats, _centroids = cv2.connectedComponentsWithStats(tiles, connectivity=8)
+	regions = []
+	for x, y, columns, rows, _area in stats[1:]:
+		x0, y0 = x * tile_size, y * tile_size
+		x1, y1 = min(width, (x + columns) * tile_size), min(height, (y + rows) * tile_size)
+		regions.append((int(x0), int(y0), int(x1 - x0), int(y1 - y0)))
+	return regions
+
+
+def run_compare():
+	"""Compares pyramid and exhaustive matching on a screen shot and a pattern cropped from it (only for developing purposes)"""
+	import argparse
+	import time
+	parser = argparse.ArgumentParser()
+	parser.add_argument('-s', '--screenshot', required=True, help='Path to screen shot')
+	parser.add_argument('-p', '--pattern', required=True, help='Path to pattern')
+	parser.add_argument('-l', '--levels', type=int, default=2, help='Pyramid levels')
+	kwargs = vars(parser.parse_known_args()[0])  # Breaks here if something goes wrong
+
+	screenshot, pattern = cv2.imread(kwargs['screenshot'], cv2.IMREAD_COLOR), cv2.imread(kwargs['pattern'], cv2.IMREAD_COLOR)
+	for method in ('TM_CCOEFF_NORMED', 'TM_CCORR_NORMED'):
+		time_start = time.time()
+		exhaustive = match_exhaustive(screenshot, pattern, method)
+		time_exhaustive, time_start = time.time() - time_start, time.time()
+		pyramid = match_pyramid(build_pyramid(screenshot, kwargs['levels']), build_pyramid(pattern, kwargs['levels'], min_size=8), method)
+		time_pyramid = time.time() - time_start
+		print('{method}: exhaustive {0[max_correlation]:.1%} at {0[max_location]} in {time_exhaustive:.3f}s, pyramid {1[max_correlation]:.1%} at {1[max_location]} in {time_pyramid:.3f}s'.format(exhaustive, pyramid, **locals()))
+
+
+def main():
+	import argparse
+	parser = argparse.ArgumentParser(add_help=False)
+	parser.add_argument('-r', '--run-function', default='compare', choices=[k[len('run_'):] for k in globals() if k.startswith('run_')], help='Function to run (without "run_"-prefix)')
+	kwargs = vars(parser.parse_known_args()[0])  # Breaks here if something goes wrong
+
+	globals()['run_' + kwargs['run_function']]()
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,248 @@
+#!/bin/sh
+# -*- coding: utf-8 -*-
+# vim: noexpandtab
+"exec" "python3" "-B" "$0" "$@"
+# (c) gehrmann
+
+
+
+__doc__ = """
+This module provides a compiled (parsed once) representation of a scenario
+
+Program keeps immutable events, an index of labels and for every line the next line of a shallower level,
+so that "goto", "jump", "break" and skipping of a failed branch do not need to parse or walk lines again.
+
+Compiled programs are cached on disk in a per-user directory (~/.cache/pyguibot/programs, keyed by the real path
+of the scenario, never next to it: scenarios are shared, a pickled cache from somebody else could run any code),
+if only some lines are changed, only they are parsed again.
+
+Environment variables:
+	LOGGING_<MODULE> -- Logging level ( NOTSET | DEBUG | INFO | WARNING | ERROR | CRITICAL )
+"""
+
+import bisect
+import collections
+import hashlib
+import logging
+import os
+import pickle
+import re
+import sys
+import tempfile
+import types
+
+if __name__ == '__main__':
+	# Sets utf-8 (instead of latin1) as default encoding for every IO
+	# import importlib; importlib.reload(sys); sys.setdefaultencoding('utf-8')
+	# Runs in application's working directory
+	os.chdir((os.path.dirname(os.path.realpath(__file__)) or '.') + '/..'); sys.path.insert(0, os.path.realpath(os.getcwd()))
+	# Working interruption by Ctrl-C
+	import signal; signal.signal(signal.SIGINT, signal.default_int_handler)
+	# Configures logging
+	logging.basicConfig(
+		level=logging.WARN, datefmt='%H:%M:%S',
+		format='%(asctime)s.%(msecs)03d %(pathname)s:%(lineno)d [%(levelname)s]  %(message)s',
+	)
+logging.getLogger(__name__).setLevel(getattr(logging, os.environ.get('LOGGING_' + __name__.replace('.', '_').upper(), 'WARNING')))
+
+
+class Program(object):
+	"""Immutable sequence of parsed events with a labels index and precomputed ends of branches
+
+	Example:
+
+		>>> program = Program([
+		...     dict(type='label', value='loop', level=0),
+		...     dict(type='condition', value='{X} < 5', level=0),
+		...     dict(type='equation', value='X = {X} + 1', level=1),
+		...     dict(comments='# Comment', level=0),
+		...     dict(type='goto', value='-loop', level=1),
+		...     dict(type='label', value='end', level=0),
+		... ])
+		>>> program.find_label('loop'), program.find_label('-loop', index=4), program.find_label('+end', index=4), program.find_label('-end', index=4)
+		(0, 0, 5, None)
+		>>> program.skip(1, level=1), program.skip(2, level=1), program.skip(2, level=0)
+		(5, 5, 6)
+		>>> program.variables[1], program.variables[3]
+		(frozenset({'X'}), frozenset())
+		>>> import ast
+		>>> program = Program.compile(['{"type": "delay", "value": "1"}', ' {"type": '], restore=(lambda x: (dict(ast.literal_eval(x.strip()), level=0))))
+		>>> program[1]['level'], program[1]['error'].split(':')[0]  # Is raised when the line is reached
+		(1, 'SyntaxError')
+
+	"""
+
+	_cache_version = 2
+	_cache_directory = os.path.join(os.path.expanduser('~'), '.cache', 'pyguibot', 'programs')  # Is written only by this user
+	_variable_regexp = re.compile(r'\{(?:env\[)?(\w+)\]?\}')  # {X} or {env[X]}
+
+	def __init__(self, events, directory=None):
+		self._events = events = tuple(types.MappingProxyType(dict(x)) for x in events)
+		count = len(events)
+
+		# Resolves paths of patterns relative to directory (None if a path contains variables, they are substituted at run time)
+		self._patterns = tuple(
+			tuple((os.path.join(directory, x) if directory is not None and '{' not in x else None) for x in event['patterns']) if 'patterns' in event else None
+			for event in events
+		)
+
+		# Names of variables used by every event (in values, messages and paths of patterns)
+		self._variables = tuple(
+			frozenset(name for key in ('value', 'message') if key in event for name in self._variable_regexp.findall(str(event[key]))) |
+			frozenset(name for x in event.get('patterns', ()) for name in self._variable_regexp.findall(x))
+			for event in events
+		)
+
+		# Indexes labels: {label: [index, ...]}
+		labels = collections.defaultdict(list)
+		for index, event in enumerate(events):
+			if event.get('type', '') == 'label':
+				labels[event.get('value', '')].append(index)
+		self._labels = dict(labels)
+
+		# For every line: index of the first event (not a comment) at or after it
+		self._next_statements = next_statements = [count] * (count + 1)
+		for index in range(count - 1, -1, -1):
+			next_statements[index] = index if 'comments' not in events[index] else next_statements[index + 1]
+
+		# For every event: index of the first following event of a shallower level (where its branch ends)
+		self._branch_ends = branch_ends = [count] * count
+		stack = []  # Indices of events waiting for a shallower one, their levels are non-decreasing
+		for index, event in enumerate(events):
+			if 'comments' in event:
+				continue
+			while stack and events[stack[-1]]['level'] > event['level']:
+				branch_ends[stack.pop()] = index
+			stack.append(index)
+
+	def __getstate__(self):
+		return dict(self.__dict__, _events=tuple(dict(x) for x in self._events))
+
+	def __setstate__(self, state):
+		self.__dict__.update(state, _events=tuple(types.MappingProxyType(x) for x in state['_events']))
+
+	@classmethod
+	def compile(cls, lines, restore, directory=None, _parsed=None):
+		"""Parses every line with restore(line) (or takes it from _parsed {line: event}), returns a program
+
+		A line which can not be parsed becomes an event {"level": ..., "error": ...}, which fails only when it is reached.
+		"""
+		_parsed = _parsed or dict()
+		return cls([(dict(_parsed[x]) if x in _parsed and 'error' not in _parsed[x] else cls._restore(restore, x)) for x in lines], directory=directory)
+
+	@classmethod
+	def load(cls, lines, restore, path=None):
+		"""Returns compiled program of lines read from path, re-uses and updates its on-disk cache"""
+		if path is None or not os.path.isfile(path):
+			return cls.compile(lines, restore)  # From stdin or nowhere
+
+		path = os.path.realpath(path)
+		directory = os.path.dirname(path)
+		cache_path = os.path.join(cls._cache_directory, hashlib.sha1(path.encode('utf-8', 'surrogateescape')).hexdigest() + '.pickle')
+		digest = hashlib.sha1(''.join(lines).encode('utf-8', 'surrogateescape')).hexdigest()
+
+		# Loads cache
+		try:
+			for x in (cls._cache_directory, cache_path):  # Is unpickled only if nobody else could write it
+				stat = os.lstat(x)
+				if stat.st_uid != os.getuid() or stat.st_mode & 0o022:
+					raise ValueError('Cache is not private')
+			with open(cache_path, 'rb') as src:
+				cache = pickle.load(src)
+			if cache['version'] != cls._cache_version or cache['path'] != path:
+				raise ValueError('Cache is outdated')
+		except Exception as e:
+			logging.getLogger(__name__).debug('Cache "%s" is not loaded: %r', cache_path, e)
+			cache = None
+		if cache is not None and cache['digest'] == digest:
+			logging.getLogger(__name__).debug('Program is loaded from cache "%s"', cache_path)
+			return cache['program']
+
+		# Compiles again, but parses only changed lines
+		program = cls.compile(lines, restore, directory=directory, _parsed=(
+			dict(zip(cache['lines'], cache['program'])) if cache is not None else None
+		))
+
+		# Stores cache (atomically, ignores errors), not if some lines can not be parsed (they are parsed again next time)
+		if any('error' in x for x in program):
+			return program
+		dst = None
+		try:
+			stat = os.stat(path)
+			os.makedirs(cls._cache_directory, mode=0o700, exist_ok=True)
+			with tempfile.NamedTemporaryFile('wb', dir=cls._cache_directory, prefix='.' + os.path.basename(cache_path) + '.', delete=False) as dst:
+				pickle.dump(dict(
+					version=cls._cache_version, path=path, mtime_ns=stat.st_mtime_ns, digest=digest,
+					lines=tuple(lines), program=program,
+				), dst, protocol=pickle.HIGHEST_PROTOCOL)
+			os.replace(dst.name, cache_path)
+		except OSError as e:
+			logging.getLogger(__name__).debug('Cache "%s" is not stored: %r', cache_path, e)
+			if dst is not None and os.path.exists(dst.name):
+				os.unlink(dst.name)
+		return program
+
+	@staticmethod
+	def _restore(restore, line):
+		try:
+			return restore(line)
+		except (SyntaxError, ValueError) as e:
+			logging.getLogger(__name__).info('Line %r can not be parsed: %r', line, e)
+			data = line.rstrip(os.linesep)
+			return dict(level=(len(data) - len(data.lstrip())), error='{}: {}'.format(type(e).__name__, e))
+
+	@property
+	def patterns(self):
+		"""Returns resolved paths of patterns for every event (None if event has no patterns or a path has to be substituted)"""
+		return self._patterns
+
+	@property
+	def variables(self):
+		"""Returns names of variables used by every event"""
+		return self._variables
+
+	def __len__(self):
+		return len(self._events)
+
+	def __getitem__(self, index):
+		return self._events[index]
+
+	def __iter__(self):
+		return iter(self._events)
+
+	def find_label(self, label, index=None):
+		"""Returns index of label ("+label" searches downward from index, "-label" upward) or None if not found"""
+		direction, label = (label[:1], label[1:]) if label[:1] in ('+', '-') else ('', label)
+		indices = self._labels.get(label, ())
+		if direction == '+':
+			position = bisect.bisect_right(indices, index)
+			return indices[position] if position < len(indices) else None
+		elif direction == '-':
+			position = bisect.bisect_left(indices, index)
+			return indices[position - 1] if position > 0 else None
+		return indices[0] if indices else None
+
+	def skip(self, index, level):
+		"""Returns index of the first event after index with a level lower than level (or length of program)"""
+		count = len(self._events)
+		next_index = self._next_statements[index + 1] if index + 1 <= count else count
+		while next_index < count and self._events[next_index]['level'] >= level:
+			next_index = self._branch_ends[next_index]  # Skips the whole branch of that event at once
+		return next_index
+
+
+def run_doctest():
+	import doctest
+	doctest.testmod()
+
+
+def main():
+	import argparse
+	parser = argparse.ArgumentParser(add_help=False)
+	parser.add_argument('-r', '--run-function', default='doctest', choices=[k[len('run_'):] for k in globals() if k.startswith('run_')], help='Function to run (without "run_"-prefix)')
+	kwargs = vars(parser.parse_known_args()[0])  # Breaks here if something goes wrong
+
+	globals()['run_' + kwargs['run_function']]()
+
+if __name__ == '__main__':
+	main()
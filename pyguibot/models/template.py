@@ -0,0 +1,184 @@
+#!/bin/sh
+# -*- coding: utf-8 -*-
+# vim: noexpandtab
+"exec" "python3" "-B" "$0" "$@"
+# (c) gehrmann
+
+
+
+__doc__ = """
+This module provides templates of step values and pattern paths with variables ({X} or {env[X]})
+
+A template is parsed once (and cached by its text) into a list of literal and variable segments,
+which is rendered by looking up only its variables in a store (os.environ or any mapping),
+without rewriting the text, copying the store or calling str.format() again.
+
+Templates with format specs or conversions (like {env[X]:>5} or {env[X]!r}) are rendered with str.format(), as before.
+
+Environment variables:
+	LOGGING_<MODULE> -- Logging level ( NOTSET | DEBUG | INFO | WARNING | ERROR | CRITICAL )
+"""
+
+import functools
+import logging
+import os
+import re
+import string
+import sys
+
+if __name__ == '__main__':
+	# Sets utf-8 (instead of latin1) as default encoding for every IO
+	# import importlib; importlib.reload(sys); sys.setdefaultencoding('utf-8')
+	# Runs in application's working directory
+	os.chdir((os.path.dirname(os.path.realpath(__file__)) or '.') + '/..'); sys.path.insert(0, os.path.realpath(os.getcwd()))
+	# Working interruption by Ctrl-C
+	import signal; signal.signal(signal.SIGINT, signal.default_int_handler)
+	# Configures logging
+	logging.basicConfig(
+		level=logging.WARN, datefmt='%H:%M:%S',
+		format='%(asctime)s.%(msecs)03d %(pathname)s:%(lineno)d [%(levelname)s]  %(message)s',
+	)
+logging.getLogger(__name__).setLevel(getattr(logging, os.environ.get('LOGGING_' + __name__.replace('.', '_').upper(), 'WARNING')))
+
+
+class Template(object):
+	"""Text with variables, parsed once into segments
+
+	Segments are literal strings and tuples (name, is_short), where is_short tells that variable was written as {X} (not {env[X]}).
+
+	Example:
+
+		>>> template = Template.compile('{X} + {env[Y]} = {{Z}}')
+		>>> template.segments
+		[('X', True), ' + ', ('Y', False), ' = {Z}']
+		>>> template.render(dict(X='1', Y='2'))
+		'1 + 2 = {Z}'
+		>>> template.render_keys_values(dict(X='1'), default='<none>')
+		'X[1] + <none> = {Z}'
+		>>> template.render(dict())
+		Traceback (most recent call last):
+		...
+		KeyError: 'X'
+		>>> Template.compile('{env[X]:>3}').render(dict(X='1'))
+		'  1'
+		>>> Template.compile('{X}') is Template.compile('{X}'), sorted(template.names)
+		(True, ['X', 'Y'])
+
+	"""
+
+	_short_regexp = re.compile(r'\{(\w+)\}')  # {X}, is a short form of {env[X]}
+	_field_regexp = re.compile(r'(\w+)$|env\[(\w+)\]$')  # X or env[X]
+	_missing = object()
+
+	def __init__(self, text):
+		self.text = text
+		self.segments = []
+		self._format_text = None  # Is set if template needs str.format() (format specs or conversions)
+
+		try:
+			fields = list(string.Formatter().parse(text))
+		except ValueError:
+			fields = None  # Is not a valid format string, str.format() raises the same error on render
+		for literal, field, format_spec, conversion in fields or []:
+			if literal:
+				if self.segments and isinstance(self.segments[-1], str):
+					self.segments[-1] += literal
+				else:
+					self.segments.append(literal)
+			if field is not None:
+				match = self._field_regexp.match(field)
+				if match is None or format_spec or conversion:
+					fields = None
+					break
+				self.segments.append((match.group(1) or match.group(2), match.group(1) is not None))
+		if fields is None:
+			self.segments, self._format_text = [], self._short_regexp.sub('{env[\\1]}', text)
+		self.names = frozenset(x[0] for x in self.segments if isinstance(x, tuple))
+
+	@classmethod
+	@functools.lru_cache(maxsize=4096)
+	def compile(cls, text):
+		"""Returns parsed template of text (cached)"""
+		return cls(text)
+
+	def render(self, variables, default=_missing):
+		"""Returns text with every {X} (or {env[X]}) replaced with its value (default if X is not set, KeyError is raised if not given)"""
+		if self._format_text is not None:
+			return self._format_text.format(env=self._with_default(variables, default))
+		return ''.join([
+			x if isinstance(x, str) else self._get(variables, x[0], default)
+			for x in self.segments
+		])
+
+	def render_keys_values(self, variables, default=_missing):
+		"""Returns text with every {X} replaced with X[value] (and every {env[X]} with its value)"""
+		if self._format_text is not None:
+			return self._short_regexp.sub('\\1[{env[\\1]}]', self.text).format(env=self._with_default(variables, default))
+		return ''.join([
+			x if isinstance(x, str) else (x[0] + '[' + self._get(variables, x[0], default) + ']') if x[1] else self._get(variables, x[0], default)
+			for x in self.segments
+		])
+
+	"""Helpers"""
+
+	def _get(self, variables, name, default):
+		value = variables.get(name, default)
+		if value is self._missing:
+			raise KeyError(name)
+		return value if isinstance(value, str) else format(value)
+
+	def _with_default(self, variables, default):
+		if default is self._missing:
+			return variables
+		return _DefaultMapping(variables, default)
+
+
+class _DefaultMapping(object):
+	"""Read-only view of mapping, returns default for missing keys (without copying mapping)"""
+
+	def __init__(self, mapping, default):
+		self._mapping = mapping
+		self._default = default
+
+	def __getitem__(self, key):
+		return self._mapping.get(key, self._default)
+
+
+def run_benchmark():
+	"""Compares rendering of a parsed template with a regexp rewrite and str.format() over a copy of os.environ (per call)"""
+	import collections
+	import timeit
+	variables = dict(os.environ, X='41', NAME='pattern')
+	text = 'images/{NAME}-{X}.png'
+	number = 10000
+
+	def substitute(value, env, default=None):
+		value = re.sub(r'\{(\w+)\}', '{env[\\1]}', value)
+		if default is not None:
+			env = collections.defaultdict((lambda x: (lambda: (x)))(default), env)  # Copies environment, like before
+		return value.format(env=env)
+
+	for default in (None, 'default'):
+		template = Template.compile(text)
+		print('default={!r:<10} parsed: {:.2f}us, substituted: {:.2f}us'.format(
+			default,
+			timeit.timeit(lambda: template.render(variables, **({} if default is None else dict(default=default))), number=number) / number * 1e6,
+			timeit.timeit(lambda: substitute(text, variables, default=default), number=number) / number * 1e6,
+		))
+
+
+def run_doctest():
+	import doctest
+	doctest.testmod()
+
+
+def main():
+	import argparse
+	parser = argparse.ArgumentParser(add_help=False)
+	parser.add_argument('-r', '--run-function', default='doctest', choices=[k[len('run_'):] for k in globals() if k.startswith('run_')], help='Function to run (without "run_"-prefix)')
+	kwargs = vars(parser.parse_known_args()[0])  # Breaks here if something goes wrong
+
+	globals()['run_' + kwargs['run_function']]()
+
+if __name__ == '__main__':
+	main()
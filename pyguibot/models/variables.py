@@ -0,0 +1,152 @@
+#!/bin/sh
+# -*- coding: utf-8 -*-
+# vim: noexpandtab
+"exec" "python3" "-B" "$0" "$@"
+# (c) gehrmann
+
+
+
+__doc__ = """
+This module provides a store of scenario variables (instead of os.environ)
+
+Values keep their types (equations store numbers and booleans, not their strings). Every change costs O(1):
+only changed keys are sent to observers (in batches if wanted), and the environment for child processes
+is a copy-on-write snapshot of texts, copied only if it was handed out before the change.
+
+Environment variables:
+	LOGGING_<MODULE> -- Logging level ( NOTSET | DEBUG | INFO | WARNING | ERROR | CRITICAL )
+"""
+
+import contextlib
+import logging
+import os
+import sys
+import threading
+
+if __name__ == '__main__':
+	# Sets utf-8 (instead of latin1) as default encoding for every IO
+	# import importlib; importlib.reload(sys); sys.setdefaultencoding('utf-8')
+	# Runs in application's working directory
+	os.chdir((os.path.dirname(os.path.realpath(__file__)) or '.') + '/..'); sys.path.insert(0, os.path.realpath(os.getcwd()))
+	# Working interruption by Ctrl-C
+	import signal; signal.signal(signal.SIGINT, signal.default_int_handler)
+	# Configures logging
+	logging.basicConfig(
+		level=logging.WARN, datefmt='%H:%M:%S',
+		format='%(asctime)s.%(msecs)03d %(pathname)s:%(lineno)d [%(levelname)s]  %(message)s',
+	)
+logging.getLogger(__name__).setLevel(getattr(logging, os.environ.get('LOGGING_' + __name__.replace('.', '_').upper(), 'WARNING')))
+
+from helpers.observable import Observable
+
+
+class Variables(object):
+	"""Mapping of variables with typed values, change notifications and copy-on-write snapshots for child processes
+
+	Example:
+
+		>>> variables = Variables(dict(HOME='/root'))
+		>>> changes = []
+		>>> variables.changed.bind(lambda values: (changes.append(values)))
+		>>> variables['X'] = 1
+		>>> environment = variables.snapshot()
+		>>> with variables.batch():
+		...     variables['X'] = 2
+		...     _ = variables.update(dict(Y=True, HOME='/root'))
+		>>> changes
+		[{'X': 1}, {'X': 2, 'Y': True}]
+		>>> environment, variables.snapshot()
+		({'HOME': '/root', 'X': '1'}, {'HOME': '/root', 'X': '2', 'Y': 'True'})
+		>>> variables.get('Z', 0), variables['X'] + 1
+		(0, 3)
+
+	"""
+
+	def __init__(self, values=None, **kwargs):
+		self._values = dict(values or (), **kwargs)
+		self._texts = {k: self.to_text(v) for k, v in self._values.items()}  # Environment of child processes
+		self._texts_are_shared = False  # Is set if texts were handed out as a snapshot (and should be copied before a change)
+		self._lock = threading.RLock()
+		self._batch_level = 0
+		self._batch_changes = dict()
+
+	@Observable
+	def changed(self, values):
+		"""Is called with {name: value} of changed variables only (once per batch)"""
+		return values
+
+	@staticmethod
+	def to_text(value):
+		return value if isinstance(value, str) else format(value)
+
+	def __getitem__(self, name):
+		return self._values[name]
+
+	def __contains__(self, name):
+		return name in self._values
+
+	def __iter__(self):
+		return iter(list(self._values))
+
+	def __len__(self):
+		return len(self._values)
+
+	def get(self, name, default=None):
+		return self._values.get(name, default)
+
+	def __setitem__(self, name, value):
+		self.update({name: value})
+
+	def update(self, values):
+		"""Sets values, returns names of variables which are really changed"""
+		with self._lock:
+			changes = {k: v for k, v in values.items() if k not in self._values or self._values[k] != v or type(self._values[k]) is not type(v)}
+			if not changes:
+				return []
+			if self._texts_are_shared:
+				self._texts, self._texts_are_shared = dict(self._texts), False  # Copies on write, the snapshot stays as it was
+			for name, value in changes.items():
+				self._values[name] = value
+				self._texts[name] = self.to_text(value)
+			if self._batch_level:
+				self._batch_changes.update(changes)
+				return list(changes)
+		self.changed(changes)
+		return list(changes)
+
+	def snapshot(self):
+		"""Returns variables as texts (for environment of child processes), must not be changed (is shared till the next change)"""
+		with self._lock:
+			self._texts_are_shared = True
+			return self._texts
+
+	@contextlib.contextmanager
+	def batch(self):
+		"""Collects changes and notifies observers once at the end"""
+		with self._lock:
+			self._batch_level += 1
+		try:
+			yield self
+		finally:
+			with self._lock:
+				self._batch_level -= 1
+				changes, self._batch_changes = (self._batch_changes, dict()) if not self._batch_level else (None, self._batch_changes)
+			if changes:
+				self.changed(changes)
+
+
+def run_doctest():
+	import doctest
+	doctest.testmod()
+
+
+def main():
+	import argparse
+	parser = argparse.ArgumentParser(add_help=False)
+	parser.add_argument('-r', '--run-function', default='doctest', choices=[k[len('run_'):] for k in globals() if k.startswith('run_')], help='Function to run (without "run_"-prefix)')
+	kwargs = vars(parser.parse_known_args()[0])  # Breaks here if something goes wrong
+
+	globals()['run_' + kwargs['run_function']]()
+
+if __name__ == '__main__':
+	main()